@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Benchmark: CPU cost of fanning one chat message out to a room.
+
+Compares the old per-connection send_json loop against the serialize-once
+broadcast path, both through the per-connection queues and through the
+websockets broadcast primitive. No server or network is needed; sockets
+are in-process websockets protocols writing to a null transport.
+
+Usage: python server/bench_broadcast.py [--messages 200] [--rooms 10,100,1000]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import warnings
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.connection_manager import RoomConnectionManager, native_broadcast
+
+MESSAGE = {
+    "user": "bench@example.com",
+    "message": "q2Vb0kq3mS1uYxv0m8bJ3Q5l5o8c7n0wq2Vb0kq3mS1uYxv0m8bJ3Q5l5o8c7n0w==",
+    "encrypted": True,
+    "timestamp": "2025-01-01T00:00:00",
+    "security_info": "Message encrypted with AES-256-CBC",
+}
+
+
+class NullTransport(asyncio.Transport):
+    """Transport that accepts writes and throws them away"""
+
+    def write(self, data):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def is_closing(self):
+        return False
+
+
+class FakeWebSocket:
+    """
+    Starlette-style socket over a real websockets protocol writing to a null
+    transport, so every path pays the real framing cost per connection.
+    """
+
+    def __init__(self, native: bool):
+        self.protocol = make_protocol()
+        if native:
+            # Exposed the way uvicorn exposes its bound asgi_send
+            self._send = self.protocol.send
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_json(self, message):
+        await self.protocol.send(json.dumps(message, separators=(",", ":")))
+
+    async def send_text(self, data):
+        await self.protocol.send(data)
+
+    async def send_bytes(self, data):
+        await self.protocol.send(data)
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+def make_protocol():
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        from websockets.legacy.protocol import State, WebSocketCommonProtocol
+    protocol = WebSocketCommonProtocol()
+    protocol.is_client = False
+    protocol.side = "server"
+    protocol.connection_made(NullTransport())
+    protocol.state = State.OPEN
+    # Normally the reader task; a pending future keeps the connection "open"
+    protocol.transfer_data_task = asyncio.get_running_loop().create_future()
+    return protocol
+
+
+async def bench_send_json_loop(members: int, messages: int) -> float:
+    """The original implementation: await send_json on every socket in turn"""
+    sockets = [FakeWebSocket(native=False) for _ in range(members)]
+    started = time.process_time()
+    for _ in range(messages):
+        for ws in sockets:
+            await ws.send_json(MESSAGE)
+    return time.process_time() - started
+
+
+async def bench_manager(members: int, messages: int, native: bool) -> float:
+    manager = RoomConnectionManager(max_queue=messages + 1)
+    for _ in range(members):
+        await manager.connect("room", FakeWebSocket(native))
+    connections = manager.get_connections("room")
+    started = time.process_time()
+    for _ in range(messages):
+        await manager.broadcast("room", MESSAGE)
+        # Let the writer tasks drain, as the event loop would between messages
+        await asyncio.sleep(0)
+    while any(not c.queue.empty() or c.sending for c in connections):
+        await asyncio.sleep(0)
+    elapsed = time.process_time() - started
+    for connection in connections:
+        connection.cancel()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--rooms", default="10,100,1000", help="comma separated room sizes")
+    args = parser.parse_args()
+
+    print("=" * 72)
+    print(f"Broadcast fan-out CPU per message ({args.messages} messages per room size)")
+    print("=" * 72)
+    print(f"{'members':>8} {'send_json loop':>16} {'queued frame':>16} {'native frame':>16} {'speedup':>9}")
+
+    for members in [int(n) for n in args.rooms.split(",")]:
+        loop_time = asyncio.run(bench_send_json_loop(members, args.messages))
+        queued_time = asyncio.run(bench_manager(members, args.messages, native=False))
+        if native_broadcast is not None:
+            native_time = asyncio.run(bench_manager(members, args.messages, native=True))
+        else:
+            native_time = float("nan")
+        best = min(queued_time, native_time) if native_time == native_time else queued_time
+        per_msg = lambda t: f"{t / args.messages * 1e6:12.1f} us"
+        print(f"{members:>8} {per_msg(loop_time):>16} {per_msg(queued_time):>16} "
+              f"{per_msg(native_time):>16} {loop_time / best:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
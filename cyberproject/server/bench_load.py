@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Load test: end-to-end behaviour of the /ws/{session_id} endpoint under fan-out.
+
+Starts the app in-process on a background thread (MongoDB is pointed at an
+unreachable address so the in-memory fallback is used), opens ROOMS x CLIENTS
+real WebSocket connections and drives each room at a fixed message rate.
+Reports delivery latency percentiles, delivered messages per second, memory
+per connection and server event-loop lag, and writes them as JSON.
+
+Usage: python server/bench_load.py [--rooms 10] [--clients 20] [--rate 5]
+                                   [--duration 10] [--output bench_load.json]
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import asyncio
+import argparse
+import platform
+import threading
+import statistics
+from datetime import datetime
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Must be set before the app is imported; a refused connection fails fast
+os.environ.setdefault("MONGODB_URL", "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=500")
+
+import uvicorn
+import websockets
+
+from server.ws_codec import CODECS, expand_message
+
+BENCH_PREFIX = "bench:"
+
+
+def rss_bytes() -> int:
+    """Resident set size of this process (Linux); 0 where /proc is unavailable"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class ServerThread:
+    """uvicorn on its own thread and event loop, so client load doesn't hide server lag"""
+
+    def __init__(self, app, ws_option="auto"):
+        self.config = uvicorn.Config(app, host="127.0.0.1", port=0, ws=ws_option, log_level="warning")
+        self.server = uvicorn.Server(self.config)
+        self.loop = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.server.serve())
+
+    def start(self) -> int:
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.05)
+        return self.server.servers[0].sockets[0].getsockname()[1]
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+async def measure_loop_lag(interval: float, samples: list, stop: threading.Event):
+    """Runs on the server loop: how late does a short sleep wake up?"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - started - interval))
+
+
+class Client:
+    def __init__(self, room: int, index: int, codec):
+        self.room = room
+        self.codec = codec
+        self.index = index
+        self.ws = None
+        self.latencies = []
+        self.received = 0
+
+    async def run(self):
+        async for raw in self.ws:
+            data = self.codec.decode(raw)
+            frames = [expand_message(f) for f in data["frames"]] if data.get("type") == "batch" else [data]
+            for frame in frames:
+                if frame.get("type") == "ping":
+                    await self.ws.send('{"type":"pong"}')
+                    continue
+                msg_id = frame.get("msg_id")
+                if isinstance(msg_id, str) and msg_id.startswith(BENCH_PREFIX):
+                    sent_ns = int(msg_id.rsplit(":", 1)[1])
+                    self.latencies.append((time.perf_counter_ns() - sent_ns) / 1e6)
+                    self.received += 1
+
+
+async def drive_room(clients, rate: float, duration: float, counter: list):
+    """Send `rate` messages per second into the room, rotating through its members"""
+    interval = 1.0 / rate
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+    next_send = loop.time()
+    n = 0
+    while loop.time() < deadline:
+        sender = clients[n % len(clients)]
+        msg_id = f"{BENCH_PREFIX}{sender.room}:{n}:{time.perf_counter_ns()}"
+        await sender.ws.send(json.dumps({"message": "load test message", "msg_id": msg_id}))
+        counter[0] += 1
+        n += 1
+        next_send += interval
+        await asyncio.sleep(max(0.0, next_send - loop.time()))
+
+
+async def run_benchmark(args, port: int, main_module, server: ServerThread) -> dict:
+    base = f"ws://127.0.0.1:{port}"
+    query = f"codec={args.codec}" + ("&coalesce=1" if args.coalesce else "")
+
+    # Sessions and tokens straight from the app; no email/OTP round trips
+    sessions = []
+    for _ in range(args.rooms):
+        session_id = os.urandom(16).hex()
+        await main_module.sessions.create(session_id, {"created_at": datetime.utcnow().isoformat()})
+        sessions.append(session_id)
+
+    gc.collect()
+    rss_before = rss_bytes()
+    clients = []
+    for room, session_id in enumerate(sessions):
+        for index in range(args.clients):
+            client = Client(room, index, CODECS[args.codec])
+            token = main_module.create_access_token({"sub": f"bench{room}-{index}@example.com"})
+            client.ws = await websockets.connect(f"{base}/ws/{session_id}?token={token}&{query}",
+                                                 max_queue=None, compression=None if args.no_deflate else "deflate")
+            clients.append(client)
+    readers = [asyncio.create_task(c.run()) for c in clients]
+    await asyncio.sleep(0.5)  # welcome frames
+    gc.collect()
+    rss_after = rss_bytes()
+
+    lag_samples = []
+    stop_probe = threading.Event()
+    probe = asyncio.run_coroutine_threadsafe(
+        measure_loop_lag(args.lag_interval / 1000, lag_samples, stop_probe), server.loop)
+
+    sent = [0]
+    by_room = [clients[i * args.clients:(i + 1) * args.clients] for i in range(args.rooms)]
+    started = time.perf_counter()
+    await asyncio.gather(*(drive_room(room, args.rate, args.duration, sent) for room in by_room))
+    # Let in-flight messages land
+    expected = sent[0] * args.clients
+    drain_deadline = time.perf_counter() + args.drain
+    while sum(c.received for c in clients) < expected and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    stop_probe.set()
+    probe.result(timeout=5)
+    for task in readers:
+        task.cancel()
+    await asyncio.gather(*(c.ws.close() for c in clients), return_exceptions=True)
+
+    latencies = [ms for c in clients for ms in c.latencies]
+    delivered = len(latencies)
+    connections = len(clients)
+    lag_ms = [s * 1000 for s in lag_samples]
+    return {
+        "sent": sent[0],
+        "expected_deliveries": expected,
+        "delivered": delivered,
+        "delivery_ratio": delivered / expected if expected else 1.0,
+        "elapsed_s": elapsed,
+        "deliveries_per_s": delivered / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p90": percentile(latencies, 0.90),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies) if latencies else float("nan"),
+            "mean": statistics.fmean(latencies) if latencies else float("nan"),
+        },
+        "memory": {
+            "rss_before_bytes": rss_before,
+            "rss_after_bytes": rss_after,
+            # Client and server share the process, so this counts both ends of each socket
+            "rss_per_connection_bytes": (rss_after - rss_before) / connections if connections else 0,
+        },
+        "server_loop_lag_ms": {
+            "p50": percentile(lag_ms, 0.50),
+            "p99": percentile(lag_ms, 0.99),
+            "max": max(lag_ms) if lag_ms else float("nan"),
+            "samples": len(lag_ms),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--clients", type=int, default=20, help="connections per room")
+    parser.add_argument("--rate", type=float, default=5.0, help="messages per second per room")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of sending")
+    parser.add_argument("--drain", type=float, default=5.0, help="max seconds to wait for stragglers")
+    parser.add_argument("--codec", default="json", choices=["json", "compact"])
+    parser.add_argument("--coalesce", action="store_true", help="clients opt in to batch frames")
+    parser.add_argument("--no-deflate", action="store_true", help="don't negotiate permessage-deflate")
+    parser.add_argument("--lag-interval", type=float, default=10.0, help="loop lag probe interval (ms)")
+    parser.add_argument("--output", default="bench_load.json")
+    args = parser.parse_args()
+
+    import server.main as main_module
+    from server.ws_compression import uvicorn_ws_option
+    # The load generator sends far faster than a person; keep rate-limit warnings from terminating it
+    main_module.security_monitor.max_messages_per_minute = 10 ** 9
+
+    server = ServerThread(main_module.app, uvicorn_ws_option())
+    port = server.start()
+    try:
+        results = asyncio.run(run_benchmark(args, port, main_module, server))
+    finally:
+        server.stop()
+
+    report = {
+        "benchmark": "bench_load",
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    latency = results["latency_ms"]
+    lag = results["server_loop_lag_ms"]
+    print("=" * 72)
+    print(f"{args.rooms} rooms x {args.clients} clients, {args.rate:g} msg/s per room for {args.duration:g}s")
+    print("=" * 72)
+    print(f"delivered       {results['delivered']}/{results['expected_deliveries']} "
+          f"({results['delivery_ratio']:.1%}), {results['deliveries_per_s']:.0f} msg/s")
+    print(f"latency (ms)    p50 {latency['p50']:.2f}  p90 {latency['p90']:.2f}  "
+          f"p99 {latency['p99']:.2f}  max {latency['max']:.2f}")
+    print(f"server lag (ms) p50 {lag['p50']:.2f}  p99 {lag['p99']:.2f}  max {lag['max']:.2f}")
+    print(f"memory          {results['memory']['rss_per_connection_bytes'] / 1024:.1f} KiB per connection (both ends)")
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,149 @@
-from fastapi import APIRouter
+import os
+import re
+import json
+import zlib
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
+from server.message_store import MESSAGE_EXPORT_BATCH_SIZE
+from server.sessions import is_member
+
 router = APIRouter()
 
+HISTORY_PAGE_MAX = 200
+
+# Transcript export: bytes gathered per chunk sent
+try:
+    EXPORT_CHUNK_BYTES = max(1024, int(os.getenv("EXPORT_CHUNK_BYTES", "65536")))
+except ValueError:
+    EXPORT_CHUNK_BYTES = 65536
+
+
+def get_message_store(request: Request):
+    """The store chat history is saved to; set up by the app at startup"""
+    store = getattr(request.app.state, "message_store", None)
+    breaker = getattr(request.app.state, "mongo_breaker", None)
+    # Fail fast while the database is known to be down rather than waiting on its timeouts
+    if store is None or (breaker is not None and breaker.is_open):
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Chat history is not available")
+    return store
+
+
+def get_current_user(request: Request, token: str) -> str:
+    user_email = request.app.state.verify_token(token)
+    if not user_email:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
+    return user_email
+
+
+async def check_room_access(request: Request, room: str, user_email: str):
+    """Only the session's creator and the users who joined it may read its messages"""
+    session = await request.app.state.sessions.get(room)
+    if session is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
+    if not is_member(session, user_email):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not a member of this session")
+
+
 class MessageSend(BaseModel):
     room: str
     text: str
 
+
 @router.post("/send")
 async def send_message(_: MessageSend):
     return {"msg": "chat stored (mock)"}
 
+
 @router.get("/history")
-async def get_chat_history(room: str):
-    # Return a couple of mock messages in expected shape
-    return [
-        {"user": "one", "text": "Hello from mock", "timestamp": "2025-01-01T00:00:00Z"},
-        {"user": "two", "text": f"Welcome to room {room}", "timestamp": "2025-01-01T00:00:05Z"}
-    ]
+async def get_chat_history(request: Request, room: str, token: str = Query(...),
+                           before: Optional[str] = Query(None, description="cursor of the oldest message seen"),
+                           limit: int = Query(50, ge=1, le=HISTORY_PAGE_MAX)):
+    """
+    One page of a room's messages, newest first. Pass the returned "next"
+    cursor as `before` to get the page before it; it is null on the last page.
+    The page is streamed from the database cursor as it is read.
+    """
+    user_email = get_current_user(request, token)
+    await check_room_access(request, room, user_email)
+    messages = get_message_store(request).history(room, before=before, limit=limit)
+    # Pull the first message now, so a bad cursor is a 400 rather than a broken stream
+    try:
+        first = await anext(messages, None)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        print(f"⚠️  History read failed for room {room}: {str(e)[:100]}")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Chat history is not available")
+
+    async def stream():
+        yield '{"messages":['
+        count, last = 0, first
+        if first is not None:
+            yield json.dumps(first)
+            count = 1
+            async for message in messages:
+                yield "," + json.dumps(message)
+                count += 1
+                last = message
+        next_cursor = last["cursor"] if count == limit else None
+        yield '],"next":' + json.dumps(next_cursor) + "}"
+
+    return StreamingResponse(stream(), media_type="application/json")
+
+
+async def transcript_lines(messages, decrypt=None):
+    """NDJSON lines in chunks of about EXPORT_CHUNK_BYTES, so memory stays flat however long the room is"""
+    chunk, size = [], 0
+    async for message in messages:
+        message.pop("cursor", None)
+        if decrypt is not None and message.get("encrypted"):
+            message["message"] = decrypt(message["message"])
+            message["encrypted"] = False
+        line = json.dumps(message, ensure_ascii=False) + "\n"
+        chunk.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield "".join(chunk).encode("utf-8")
+            chunk, size = [], 0
+    if chunk:
+        yield "".join(chunk).encode("utf-8")
+
+
+async def gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
 
+@router.get("/export")
+async def export_transcript(request: Request, room: str, token: str = Query(...),
+                            gzip: bool = Query(False, description="gzip the NDJSON"),
+                            decrypt: bool = Query(False, description="include plaintext instead of ciphertext"),
+                            batch_size: int = Query(MESSAGE_EXPORT_BATCH_SIZE, ge=1, le=10000)):
+    """
+    A room's whole saved transcript as NDJSON, one message per line, oldest
+    first. It streams straight from the database cursor, so an export of
+    millions of messages runs in constant memory.
+    """
+    user_email = get_current_user(request, token)
+    await check_room_access(request, room, user_email)
+    store = get_message_store(request)
+    print(f"📤 Transcript export of room {room} by {user_email} (decrypt={decrypt}, gzip={gzip})")
 
+    body = transcript_lines(store.export(room, batch_size=batch_size),
+                            request.app.state.decrypt_message if decrypt else None)
+    filename = "transcript-" + re.sub(r"[^A-Za-z0-9_-]", "_", room) + ".ndjson"
+    if gzip:
+        body = gzip_stream(body)
+        filename += ".gz"
+    return StreamingResponse(body, media_type="application/gzip" if gzip else "application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
@@ -0,0 +1,125 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+from pymongo.errors import ConnectionFailure
+
+logger = logging.getLogger(__name__)
+
+# Circuit breaker configuration from environment variables
+try:
+    # Consecutive connection failures / timeouts that open the breaker
+    MONGO_BREAKER_FAILURES = max(1, int(os.getenv("MONGO_BREAKER_FAILURES", "3")))
+    # Longest a single database call may take while the breaker is closed
+    MONGO_BREAKER_CALL_TIMEOUT = max(0.05, float(os.getenv("MONGO_BREAKER_CALL_TIMEOUT", "1")))
+    # Seconds between background probes while open
+    MONGO_BREAKER_PROBE_INTERVAL = max(0.1, float(os.getenv("MONGO_BREAKER_PROBE_INTERVAL", "2")))
+except ValueError:
+    MONGO_BREAKER_FAILURES, MONGO_BREAKER_CALL_TIMEOUT, MONGO_BREAKER_PROBE_INTERVAL = 3, 1.0, 2.0
+
+# Errors that mean the database can't be reached, as opposed to a bad query
+UNAVAILABLE_ERRORS = (ConnectionFailure, asyncio.TimeoutError, OSError)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+
+
+class Unavailable(Exception):
+    """The breaker is open, or the call just failed to reach the database"""
+
+
+class CircuitBreaker:
+    """
+    Stops requests from waiting out driver timeouts while the database is
+    down. After `failure_threshold` consecutive connection failures the
+    breaker opens and call() fails at once; a background task probes the
+    database and, once it answers, runs on_recover (e.g. a journal replay)
+    before closing again.
+    """
+
+    def __init__(self, probe: Callable[[], Awaitable[Any]], failure_threshold: int = MONGO_BREAKER_FAILURES,
+                 call_timeout: float = MONGO_BREAKER_CALL_TIMEOUT,
+                 probe_interval: float = MONGO_BREAKER_PROBE_INTERVAL, name: str = "mongo"):
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.call_timeout = call_timeout
+        self.probe_interval = probe_interval
+        self.name = name
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self.opened_at: Optional[float] = None
+        self.on_recover: Optional[Callable[[], Awaitable[None]]] = None
+        self._probe_task: Optional[asyncio.Task] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == STATE_OPEN
+
+    async def call(self, fn: Callable[..., Awaitable[Any]], *args) -> Any:
+        """fn(*args) under the call timeout; raises Unavailable instead of waiting on a dead database"""
+        if self.is_open:
+            self.rejected += 1
+            raise Unavailable(f"{self.name} circuit is open")
+        try:
+            result = await asyncio.wait_for(fn(*args), self.call_timeout)
+        except UNAVAILABLE_ERRORS as e:
+            self.record_failure(e)
+            raise Unavailable(str(e) or type(e).__name__) from e
+        self.failures = 0
+        return result
+
+    def record_failure(self, error: BaseException):
+        self.failures += 1
+        if self.failures >= self.failure_threshold and not self.is_open:
+            logger.warning(f"{self.name} circuit opened after {self.failures} failures: {error!r}")
+            self.trip()
+
+    def trip(self):
+        """Open the breaker and start probing for recovery"""
+        if self.is_open:
+            return
+        self.state = STATE_OPEN
+        self.trips += 1
+        self.opened_at = time.monotonic()
+        self._probe_task = asyncio.create_task(self._probe_until_recovered())
+
+    async def _probe_until_recovered(self):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            try:
+                await asyncio.wait_for(self.probe(), self.call_timeout)
+                if self.on_recover is not None:
+                    await self.on_recover()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug(f"{self.name} still unavailable: {e!r}")
+                continue
+            logger.info(f"{self.name} circuit closed after {time.monotonic() - self.opened_at:.1f}s")
+            self.state = STATE_CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self._probe_task = None
+            return
+
+    async def stop(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._probe_task = None
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "open_for": round(time.monotonic() - self.opened_at, 1) if self.opened_at is not None else 0,
+        }
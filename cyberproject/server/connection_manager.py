@@ -0,0 +1,707 @@
+import os
+import json
+import random
+import asyncio
+import logging
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+
+from fastapi import WebSocket, status
+
+from server.pubsub import PubSubBackend, InProcessPubSub
+from server.ws_codec import JSON_CODEC, CODECS
+from server.room_history import RoomHistory
+
+logger = logging.getLogger(__name__)
+
+# Overflow policies for a connection whose outbound queue is full
+OVERFLOW_DROP_OLDEST = "drop_oldest"    # Evict the oldest queued frame to make room
+OVERFLOW_DROP_MESSAGE = "drop_message"  # Discard the new frame
+OVERFLOW_DISCONNECT = "disconnect"      # Close the slow consumer
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_MESSAGE, OVERFLOW_DISCONNECT)
+
+# Outbound queue configuration from environment variables
+try:
+    WS_SEND_QUEUE_SIZE = max(1, int(os.getenv("WS_SEND_QUEUE_SIZE", "256")))
+except ValueError:
+    WS_SEND_QUEUE_SIZE = 256
+
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", OVERFLOW_DROP_OLDEST).lower()
+if WS_OVERFLOW_POLICY not in OVERFLOW_POLICIES:
+    logger.warning(f"Unknown WS_OVERFLOW_POLICY '{WS_OVERFLOW_POLICY}', using '{OVERFLOW_DROP_OLDEST}'")
+    WS_OVERFLOW_POLICY = OVERFLOW_DROP_OLDEST
+
+# Heartbeat configuration (seconds). A connection that has shown no sign of life (an
+# inbound frame, a protocol-level pong, or where pongs can't be seen, a completed send)
+# for WS_PING_INTERVAL + WS_PING_TIMEOUT is treated as half-open and evicted.
+# WS_IDLE_TIMEOUT closes connections with no chat traffic at all; 0 disables it.
+try:
+    WS_PING_INTERVAL = max(1.0, float(os.getenv("WS_PING_INTERVAL", "25")))
+    WS_PING_TIMEOUT = max(1.0, float(os.getenv("WS_PING_TIMEOUT", "20")))
+    WS_IDLE_TIMEOUT = max(0.0, float(os.getenv("WS_IDLE_TIMEOUT", "1800")))
+except ValueError:
+    WS_PING_INTERVAL, WS_PING_TIMEOUT, WS_IDLE_TIMEOUT = 25.0, 20.0, 1800.0
+
+# Optional outbound coalescing (clients opt in with ?coalesce=1): frames queued within
+# the window, up to the byte budget, go out together as one batch frame
+try:
+    WS_COALESCE_WINDOW_MS = max(0.0, float(os.getenv("WS_COALESCE_WINDOW_MS", "10")))
+    WS_COALESCE_MAX_BYTES = max(1024, int(os.getenv("WS_COALESCE_MAX_BYTES", "65536")))
+except ValueError:
+    WS_COALESCE_WINDOW_MS, WS_COALESCE_MAX_BYTES = 10.0, 65536
+
+# Admission limits, checked before a socket is accepted; 0 means unlimited.
+# Rejected clients are told to come back after WS_RETRY_AFTER to 2x WS_RETRY_AFTER seconds.
+try:
+    WS_MAX_CONNECTIONS = max(0, int(os.getenv("WS_MAX_CONNECTIONS", "10000")))
+    WS_MAX_CONNECTIONS_PER_ROOM = max(0, int(os.getenv("WS_MAX_CONNECTIONS_PER_ROOM", "500")))
+    WS_MAX_CONNECTIONS_PER_USER = max(0, int(os.getenv("WS_MAX_CONNECTIONS_PER_USER", "20")))
+    WS_RETRY_AFTER = max(1, int(os.getenv("WS_RETRY_AFTER", "5")))
+except ValueError:
+    WS_MAX_CONNECTIONS, WS_MAX_CONNECTIONS_PER_ROOM, WS_MAX_CONNECTIONS_PER_USER, WS_RETRY_AFTER = 10000, 500, 20, 5
+
+LIMIT_GLOBAL = "global"
+LIMIT_ROOM = "room"
+LIMIT_USER = "user"
+
+# Hand idle sockets straight to the websockets broadcast primitive when the server exposes it
+WS_NATIVE_BROADCAST = os.getenv("WS_NATIVE_BROADCAST", "true").lower() == "true"
+
+try:
+    from websockets.legacy.protocol import WebSocketCommonProtocol, broadcast as native_broadcast
+except Exception:
+    WebSocketCommonProtocol = None
+    native_broadcast = None
+
+# A prebuilt frame: str goes out as a text frame, bytes as a binary frame
+Frame = Union[str, bytes]
+
+
+def encode_frame(message: dict) -> str:
+    """Serialize a message exactly once as JSON, the canonical form shared between workers"""
+    return JSON_CODEC.encode(message)
+
+
+# Broadcast types that bypass the room sequence; see broadcast_ephemeral()
+EPHEMERAL_TYPES = ("events",)
+
+
+class ConnectionRejected(Exception):
+    """A connection limit is reached; the socket should be turned away without being registered"""
+
+    def __init__(self, limit: str, retry_after: int):
+        super().__init__(f"{limit} connection limit reached")
+        self.limit = limit
+        self.retry_after = retry_after
+
+    @property
+    def reason(self) -> str:
+        """Close-frame reason a client can parse: {"limit": ..., "retry_after": seconds}"""
+        return json.dumps({"limit": self.limit, "retry_after": self.retry_after}, separators=(",", ":"))
+
+
+# Heartbeat probe in every codec; clients answer with {"type": "pong"}
+PING_FRAMES = {name: codec.encode({"type": "ping"}) for name, codec in CODECS.items()}
+
+
+def _native_protocol(websocket: WebSocket):
+    """
+    Find the websockets protocol object behind a Starlette WebSocket, if any.
+    Uvicorn's websockets implementation hands its bound asgi_send to the app,
+    usually wrapped by one or two middleware closures.
+    """
+    if WebSocketCommonProtocol is None:
+        return None
+    candidates = [getattr(websocket, "_send", None)]
+    for _ in range(4):
+        next_candidates = []
+        for send in candidates:
+            owner = getattr(send, "__self__", None)
+            if isinstance(owner, WebSocketCommonProtocol):
+                return owner
+            for cell in getattr(send, "__closure__", None) or ():
+                try:
+                    value = cell.cell_contents
+                except ValueError:
+                    continue
+                if callable(value):
+                    next_candidates.append(value)
+        candidates = next_candidates
+    return None
+
+
+class ClientConnection:
+    """
+    A WebSocket paired with a bounded outbound queue and its own writer task.
+    Producers only enqueue, so a slow socket never blocks anyone else.
+    """
+
+    def __init__(self, manager: "RoomConnectionManager", session_id: Optional[str], websocket: WebSocket,
+                 max_queue: int = WS_SEND_QUEUE_SIZE, overflow_policy: str = WS_OVERFLOW_POLICY,
+                 user_email: Optional[str] = None, codec=JSON_CODEC, coalesce: bool = False):
+        self.manager = manager
+        # None for a multiplexed socket, whose frames are tagged with their room
+        self.session_id = session_id
+        self.rooms: Set[str] = set()
+        # Whether the last join() filled the client's gap from the room history
+        self.resumed = False
+        # Whether the manager's connection counters include this connection
+        self.counted = False
+        self.websocket = websocket
+        self.user_email = user_email
+        self.codec = codec
+        self.coalesce = coalesce
+        now = asyncio.get_running_loop().time()
+        self.last_seen = now      # Any inbound frame, pongs included
+        self.last_activity = now  # Real traffic only
+        self.overflow_policy = overflow_policy
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.closed = False
+        self.sending = False
+        self.protocol = _native_protocol(websocket) if WS_NATIVE_BROADCAST else None
+        # Protocol-level pings reach every client, not just those answering {"type": "ping"}
+        self.ping_protocol = self.protocol if WS_NATIVE_BROADCAST else _native_protocol(websocket)
+        self._close_code: Optional[int] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._pong_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def touch(self, activity: bool = True):
+        """Record an inbound frame; heartbeat replies pass activity=False"""
+        self.last_seen = asyncio.get_running_loop().time()
+        if activity:
+            self.last_activity = self.last_seen
+
+    def ping(self, timeout: float):
+        """
+        Ask a quiet client for a sign of life: the app-level ping frame for the
+        bundled client, and a protocol ping, whose pong counts as a heartbeat reply
+        """
+        self.enqueue(PING_FRAMES[self.codec.name])
+        if self.ping_protocol is not None and self._pong_task is None:
+            self._pong_task = asyncio.create_task(self._await_pong(timeout))
+
+    async def _await_pong(self, timeout: float):
+        try:
+            pong = await self.ping_protocol.ping()
+            await asyncio.wait_for(pong, timeout)
+        except Exception:
+            return
+        finally:
+            self._pong_task = None
+        self.touch(activity=False)
+
+    @property
+    def multiplexed(self) -> bool:
+        return self.session_id is None
+
+    def send(self, message: dict, room: Optional[str] = None) -> bool:
+        """Serialize a message for this connection only and queue it; multiplexed sockets get the room tag"""
+        if room is not None and self.multiplexed:
+            message = {"room": room, **message}
+        return self.enqueue(self.codec.encode(message))
+
+    def enqueue(self, frame: Frame) -> bool:
+        """Queue a prebuilt frame for delivery, applying the overflow policy when full"""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        self.dropped += 1
+        if self.overflow_policy == OVERFLOW_DROP_OLDEST:
+            try:
+                self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+            self.queue.put_nowait(frame)
+            return True
+        if self.overflow_policy == OVERFLOW_DISCONNECT:
+            logger.warning(f"Disconnecting slow consumer in session {self.session_id}")
+            self.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return False
+
+    def close(self, code: int = status.WS_1000_NORMAL_CLOSURE, flush: bool = False):
+        """
+        Stop accepting frames and close the socket. With flush=True the frames
+        already queued are delivered before the close frame.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._close_code = code
+        self.manager.remove(self)
+        if flush:
+            # Wake the writer with a sentinel once the pending frames are out
+            try:
+                self.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                self.queue.get_nowait()
+                self.queue.put_nowait(None)
+            return
+        # The writer may be stuck on a stalled socket, so stop it and close directly
+        if self._writer_task is not None and not self._writer_task.done():
+            self._writer_task.cancel()
+        asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await self.websocket.close(code=self._close_code)
+        except Exception:
+            pass
+
+    async def _send_frame(self, frame: Frame):
+        self.sending = True
+        if isinstance(frame, bytes):
+            await self.websocket.send_bytes(frame)
+        else:
+            await self.websocket.send_text(frame)
+        self.sending = False
+        if self.ping_protocol is None:
+            # No way to see pongs: a send that completes is the best sign the peer is there
+            self.last_seen = asyncio.get_running_loop().time()
+
+    async def _next_batch(self, first: Frame) -> Tuple[List[Frame], bool]:
+        """
+        Collect frames that arrive within the coalescing window, up to the byte
+        budget. Returns the frames and whether the close sentinel was reached.
+        """
+        frames, size = [first], len(first)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WS_COALESCE_WINDOW_MS / 1000
+        while size < WS_COALESCE_MAX_BYTES:
+            if self.queue.empty():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    frame = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                frame = self.queue.get_nowait()
+            if frame is None:
+                return frames, True
+            frames.append(frame)
+            size += len(frame)
+        return frames, False
+
+    async def _writer(self):
+        try:
+            while True:
+                frame = await self.queue.get()
+                if frame is None:
+                    break
+                if not self.coalesce:
+                    await self._send_frame(frame)
+                    continue
+                frames, closing = await self._next_batch(frame)
+                await self._send_frame(frames[0] if len(frames) == 1 else self.codec.batch(frames))
+                if closing:
+                    break
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            logger.info(f"Send failed in session {self.session_id}: {e}")
+            self.closed = True
+            self.manager.remove(self)
+            return
+
+        if self._close_code is not None:
+            await self._close_socket()
+
+    def can_write_directly(self) -> bool:
+        """
+        True when a frame can skip the queue without reordering or bypassing
+        backpressure: nothing is pending and the transport buffer is empty.
+        """
+        if self.protocol is None or self.coalesce or self.closed or self.sending or not self.queue.empty():
+            return False
+        transport = getattr(self.protocol, "transport", None)
+        return transport is not None and transport.get_write_buffer_size() == 0
+
+    async def wait_closed(self):
+        """Wait until the writer has flushed and closed the socket"""
+        if self._writer_task is not None:
+            await asyncio.shield(self._writer_task)
+
+    def cancel(self):
+        self.closed = True
+        if self._writer_task is not None and not self._writer_task.done():
+            self._writer_task.cancel()
+
+
+# WebSocket connection manager
+class RoomConnectionManager:
+    def __init__(self, max_queue: int = WS_SEND_QUEUE_SIZE, overflow_policy: str = WS_OVERFLOW_POLICY,
+                 pubsub: Optional[PubSubBackend] = None, ping_interval: float = WS_PING_INTERVAL,
+                 ping_timeout: float = WS_PING_TIMEOUT, idle_timeout: float = WS_IDLE_TIMEOUT,
+                 max_connections: int = WS_MAX_CONNECTIONS, max_per_room: int = WS_MAX_CONNECTIONS_PER_ROOM,
+                 max_per_user: int = WS_MAX_CONNECTIONS_PER_USER, retry_after: int = WS_RETRY_AFTER):
+        # session_id -> {WebSocket: ClientConnection} for sockets on this worker only
+        self.room_to_connections: Dict[str, Dict[WebSocket, ClientConnection]] = {}
+        # Multiplexed sockets, including those not subscribed to any room yet
+        self.multiplexed: Dict[WebSocket, ClientConnection] = {}
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        # Carries room frames to the other workers; in-process by default
+        self.pubsub: PubSubBackend = pubsub or InProcessPubSub()
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.idle_timeout = idle_timeout
+        self.evicted = 0
+        self.max_connections = max_connections
+        self.max_per_room = max_per_room
+        self.max_per_user = max_per_user
+        self.retry_after = retry_after
+        self.active = 0
+        # Secondary index for per-user delivery, limits and moderation
+        self.user_to_connections: Dict[str, Set[ClientConnection]] = {}
+        self.rejected: Counter = Counter()
+        # Slots held by handshakes that passed admission but haven't registered yet
+        self._pending: Counter = Counter()
+        # Recent broadcasts per room, for clients that reconnect
+        self.history = RoomHistory()
+        # Called with (user_email, session_id) once a user has no connections left in a session
+        self.on_user_left: Optional[Callable[[str, str], None]] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    async def start(self, pubsub: Optional[PubSubBackend] = None):
+        """Attach (optionally replacing) the pub/sub backend and start receiving remote frames"""
+        if pubsub is not None:
+            self.pubsub = pubsub
+        await self.pubsub.start(self._remote_frame)
+        for session_id in list(self.room_to_connections):
+            await self.pubsub.subscribe(session_id)
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        await self.pubsub.close()
+
+    def _over_limit(self, session_id: Optional[str], user_email: Optional[str]) -> Optional[str]:
+        if self.max_connections and self.active + self._pending[LIMIT_GLOBAL] >= self.max_connections:
+            return LIMIT_GLOBAL
+        if session_id is not None and self.max_per_room:
+            in_room = len(self.room_to_connections.get(session_id, ())) + self._pending[(LIMIT_ROOM, session_id)]
+            if in_room >= self.max_per_room:
+                return LIMIT_ROOM
+        if user_email and self.max_per_user:
+            if len(self.user_to_connections.get(user_email, ())) + self._pending[(LIMIT_USER, user_email)] >= self.max_per_user:
+                return LIMIT_USER
+        return None
+
+    def _reject(self, limit: str) -> ConnectionRejected:
+        self.rejected[limit] += 1
+        # Jitter spreads out the retries of a reconnect storm
+        return ConnectionRejected(limit, random.randint(self.retry_after, 2 * self.retry_after))
+
+    def _hold(self, session_id: Optional[str], user_email: Optional[str], delta: int):
+        keys = [LIMIT_GLOBAL]
+        if session_id is not None:
+            keys.append((LIMIT_ROOM, session_id))
+        if user_email:
+            keys.append((LIMIT_USER, user_email))
+        for key in keys:
+            self._pending[key] += delta
+            if self._pending[key] <= 0:
+                del self._pending[key]
+
+    async def _admit_and_accept(self, session_id: Optional[str], websocket: WebSocket,
+                                user_email: Optional[str], subprotocol: Optional[str]):
+        """
+        Check the limits before the handshake completes. Raises ConnectionRejected
+        without accepting; the slot is held while accept() is in flight.
+        """
+        limit = self._over_limit(session_id, user_email)
+        if limit is not None:
+            raise self._reject(limit)
+        self._hold(session_id, user_email, +1)
+        try:
+            await websocket.accept(subprotocol=subprotocol)
+        finally:
+            self._hold(session_id, user_email, -1)
+
+    def _count(self, connection: ClientConnection):
+        connection.counted = True
+        self.active += 1
+        if connection.user_email:
+            self.user_to_connections.setdefault(connection.user_email, set()).add(connection)
+
+    def _uncount(self, connection: ClientConnection):
+        if not connection.counted:
+            return
+        connection.counted = False
+        self.active -= 1
+        connections = self.user_to_connections.get(connection.user_email)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del self.user_to_connections[connection.user_email]
+
+    async def connect(self, session_id: str, websocket: WebSocket, user_email: Optional[str] = None,
+                      codec=JSON_CODEC, subprotocol: Optional[str] = None, coalesce: bool = False,
+                      epoch: Optional[str] = None, last_seq: Optional[int] = None) -> ClientConnection:
+        """Accept and register a single-room socket; raises ConnectionRejected over a limit"""
+        await self._admit_and_accept(session_id, websocket, user_email, subprotocol)
+        connection = ClientConnection(self, session_id, websocket, self.max_queue, self.overflow_policy,
+                                      user_email=user_email, codec=codec, coalesce=coalesce)
+        self._count(connection)
+        connection.start()
+        await self.join(connection, session_id, epoch=epoch, last_seq=last_seq, admitted=True)
+        return connection
+
+    async def connect_multiplexed(self, websocket: WebSocket, user_email: Optional[str] = None,
+                                  codec=JSON_CODEC, subprotocol: Optional[str] = None,
+                                  coalesce: bool = False) -> ClientConnection:
+        """Accept a socket that joins and leaves rooms itself; see join() and leave()"""
+        await self._admit_and_accept(None, websocket, user_email, subprotocol)
+        connection = ClientConnection(self, None, websocket, self.max_queue, self.overflow_policy,
+                                      user_email=user_email, codec=codec, coalesce=coalesce)
+        self._count(connection)
+        self.multiplexed[websocket] = connection
+        connection.start()
+        return connection
+
+    async def join(self, connection: ClientConnection, session_id: str,
+                   epoch: Optional[str] = None, last_seq: Optional[int] = None, admitted: bool = False):
+        """
+        Add a connection to a room. With the epoch and last sequence number a
+        client saw, the messages it missed are queued ahead of any new ones.
+        Raises ConnectionRejected when the room is full.
+        """
+        if connection.closed:
+            return
+        if not admitted and connection.websocket not in self.room_to_connections.get(session_id, ()):
+            if self.max_per_room and len(self.room_to_connections.get(session_id, ())) >= self.max_per_room:
+                raise self._reject(LIMIT_ROOM)
+        first_in_room = session_id not in self.room_to_connections
+        self.room_to_connections.setdefault(session_id, {})[connection.websocket] = connection
+        connection.rooms.add(session_id)
+        # No await between joining and queueing the replay, so nothing can slip in between
+        replay = self.history.replay(session_id, epoch, last_seq) if last_seq is not None else None
+        connection.resumed = replay is not None
+        for message in replay or ():
+            connection.send(message, room=session_id)
+        if first_in_room:
+            await self.pubsub.subscribe(session_id)
+
+    def leave(self, session_id: str, websocket: WebSocket) -> Optional[ClientConnection]:
+        """Take a socket out of one room without closing it"""
+        connections = self.room_to_connections.get(session_id)
+        if connections is None:
+            return None
+        connection = connections.pop(websocket, None)
+        if not connections:
+            del self.room_to_connections[session_id]
+            asyncio.ensure_future(self._release_room(session_id))
+        if connection is None:
+            return None
+        connection.rooms.discard(session_id)
+        user_email = connection.user_email
+        if user_email and self.on_user_left is not None:
+            if not any(session_id in c.rooms for c in self.user_to_connections.get(user_email, ())):
+                try:
+                    self.on_user_left(user_email, session_id)
+                except Exception as e:
+                    logger.warning(f"Cleanup for {user_email} in session {session_id} failed: {e}")
+        return connection
+
+    def disconnect(self, session_id: str, websocket: WebSocket):
+        connection = self.room_to_connections.get(session_id, {}).get(websocket) or self.multiplexed.get(websocket)
+        if connection is not None:
+            self.remove(connection)
+
+    def remove(self, connection: ClientConnection):
+        """Drop a connection from every room it is in"""
+        for session_id in list(connection.rooms):
+            self.leave(session_id, connection.websocket)
+        self.multiplexed.pop(connection.websocket, None)
+        self._uncount(connection)
+        if not connection.closed:
+            # Socket went away underneath us; nothing left to flush
+            connection.cancel()
+
+    async def _release_room(self, session_id: str):
+        # Someone may have joined again before this ran
+        if session_id in self.room_to_connections:
+            return
+        try:
+            await self.pubsub.unsubscribe(session_id)
+        except Exception as e:
+            logger.warning(f"Pub/sub unsubscribe failed for session {session_id}: {e}")
+
+    def get_connections(self, session_id: str) -> List[ClientConnection]:
+        return list(self.room_to_connections.get(session_id, {}).values())
+
+    def all_connections(self) -> List[ClientConnection]:
+        """Every connection on this worker once, however many rooms it is in"""
+        unique = {id(c): c for connections in self.room_to_connections.values() for c in connections.values()}
+        unique.update((id(c), c) for c in self.multiplexed.values())
+        return list(unique.values())
+
+    def connection_count(self) -> int:
+        return self.active
+
+    def user_connections(self, user_email: str, session_id: Optional[str] = None) -> List[ClientConnection]:
+        """A user's live connections, optionally only those in one room"""
+        connections = self.user_to_connections.get(user_email, ())
+        if session_id is None:
+            return list(connections)
+        return [c for c in connections if session_id in c.rooms]
+
+    def send_to_user(self, user_email: str, message: dict, session_id: Optional[str] = None) -> int:
+        """
+        Queue a message on every connection of one user (in one room, if given)
+        without touching anybody else's. Returns how many connections got it.
+        """
+        connections = self.user_connections(user_email, session_id)
+        for connection in connections:
+            connection.send(message, room=session_id)
+        return len(connections)
+
+    def terminate_user(self, user_email: str, session_id: Optional[str] = None,
+                       notice: Optional[dict] = None, code: int = 1008) -> int:
+        """
+        Cut a user off on every device: from one room, or from everything when
+        session_id is None. The notice is flushed before each socket closes; a
+        multiplexed socket only leaves the room unless it is cut off everywhere.
+        Returns the number of connections affected.
+        """
+        connections = self.user_connections(user_email, session_id)
+        for connection in connections:
+            if notice is not None:
+                connection.send(notice, room=session_id)
+            if session_id is not None and connection.multiplexed:
+                self.leave(session_id, connection.websocket)
+            else:
+                connection.close(code=code, flush=True)
+        return len(connections)
+
+    def stats(self) -> dict:
+        """Connection counters and headroom against the admission limits"""
+        largest_room = max((len(c) for c in self.room_to_connections.values()), default=0)
+        busiest_user = max((len(c) for c in self.user_to_connections.values()), default=0)
+        return {
+            "connections": self.active,
+            "rooms": len(self.room_to_connections),
+            "multiplexed": len(self.multiplexed),
+            "handshakes_in_flight": self._pending[LIMIT_GLOBAL],
+            "largest_room": largest_room,
+            "busiest_user": busiest_user,
+            "limits": {
+                LIMIT_GLOBAL: self.max_connections,
+                LIMIT_ROOM: self.max_per_room,
+                LIMIT_USER: self.max_per_user,
+            },
+            "headroom": {
+                LIMIT_GLOBAL: self.max_connections - self.active if self.max_connections else None,
+                LIMIT_ROOM: self.max_per_room - largest_room if self.max_per_room else None,
+                LIMIT_USER: self.max_per_user - busiest_user if self.max_per_user else None,
+            },
+            "rejected": dict(self.rejected),
+            "evicted": self.evicted,
+        }
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            try:
+                self.reap()
+            except Exception as e:
+                logger.warning(f"Heartbeat sweep failed: {e}")
+
+    def reap(self, now: Optional[float] = None) -> int:
+        """
+        One heartbeat sweep: evict half-open and idle connections and ping the
+        quiet ones. Returns the number of connections evicted.
+        """
+        if now is None:
+            now = asyncio.get_running_loop().time()
+        evicted = 0
+        for connection in self.all_connections():
+            if now - connection.last_seen > self.ping_interval + self.ping_timeout:
+                logger.info(f"Evicting unresponsive connection in session {connection.session_id}")
+                connection.close(code=status.WS_1001_GOING_AWAY)
+                evicted += 1
+            elif self.idle_timeout and now - connection.last_activity > self.idle_timeout:
+                logger.info(f"Closing idle connection in session {connection.session_id}")
+                connection.close(code=status.WS_1000_NORMAL_CLOSURE)
+                evicted += 1
+            elif now - connection.last_seen >= self.ping_interval:
+                connection.ping(self.ping_timeout)
+        self.evicted += evicted
+        return evicted
+
+    async def broadcast(self, session_id: str, message: dict) -> dict:
+        """
+        Number a message in the room's sequence, serialize it once and fan it
+        out to every connection in the room, on every worker. Returns the numbered message.
+        """
+        message = self.history.stamp(session_id, message)
+        await self.publish_frame(session_id, encode_frame(message), message)
+        return message
+
+    async def broadcast_ephemeral(self, session_id: str, message: dict):
+        """Fan out a message that isn't numbered or kept for replay (presence, typing, receipts)"""
+        await self.publish_frame(session_id, encode_frame(message), message)
+
+    async def publish_frame(self, session_id: str, frame: Frame, message: Optional[dict] = None):
+        """Deliver a prebuilt JSON frame to local sockets, then publish it once for the other workers"""
+        self.broadcast_frame(session_id, frame, message)
+        try:
+            await self.pubsub.publish(session_id, frame)
+        except Exception as e:
+            logger.warning(f"Pub/sub publish failed for session {session_id}: {e}")
+
+    def _remote_frame(self, session_id: str, frame: Frame):
+        """A broadcast from another worker: renumber it in this worker's sequence and deliver it"""
+        message = JSON_CODEC.decode(frame)
+        if message.get("type") in EPHEMERAL_TYPES:
+            self.broadcast_frame(session_id, frame, message)
+            return
+        message = self.history.stamp(session_id, message)
+        self.broadcast_frame(session_id, encode_frame(message), message)
+
+    def broadcast_frame(self, session_id: str, frame: Frame, message: Optional[dict] = None):
+        """
+        Deliver a prebuilt JSON frame to this worker's sockets in the room without waiting on delivery.
+        Connections on another codec get one re-encoded frame per codec, not per socket.
+        Idle sockets get it through websockets.broadcast, which encodes the
+        frame once for all of them; busy or slow ones fall back to their queue.
+        Multiplexed sockets get a copy tagged with the room, also built once per codec.
+        """
+        frames = {JSON_CODEC.name: frame}
+        direct: Dict[str, list] = {}
+        for connection in self.get_connections(session_id):
+            codec = connection.codec
+            key = codec.name + "+room" if connection.multiplexed else codec.name
+            codec_frame = frames.get(key)
+            if codec_frame is None:
+                codec_frame = frames.get(codec.name)
+                if codec_frame is None:
+                    if message is None:
+                        message = JSON_CODEC.decode(frame)
+                    codec_frame = frames[codec.name] = codec.encode(message)
+                if connection.multiplexed:
+                    codec_frame = frames[key] = codec.tag(codec_frame, session_id)
+            if connection.protocol is not None and not connection.protocol.open:
+                # Closed at the transport level; the writer may never notice
+                self.remove(connection)
+                self.evicted += 1
+                continue
+            if native_broadcast is not None and connection.can_write_directly():
+                direct.setdefault(key, []).append(connection.protocol)
+            else:
+                connection.enqueue(codec_frame)
+        for key, protocols in direct.items():
+            native_broadcast(protocols, frames[key])
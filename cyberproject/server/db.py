@@ -1,40 +1,87 @@
 import os
 import asyncio
 import logging
-from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo.errors import ServerSelectionTimeoutError, ConnectionFailure
-
-# Read MongoDB URI from environment, fallback to local default for dev
-MONGODB_URI = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
-
-# Create Motor client and database handle
-client: AsyncIOMotorClient = AsyncIOMotorClient(MONGODB_URI, serverSelectionTimeoutMS=5000)
-# Use the database name from environment variable or default to cyberproject
-DB_NAME = os.getenv("DATABASE_NAME", "cyberproject")
-DB = client[DB_NAME]
-
-# Expose collections
-users = DB["users"]
-messages = DB["messages"]
-qrcodes = DB["qrcodes"]
-
-# Ensure indexes on startup
-async def ensure_indexes() -> None:
-    await users.create_index("email", unique=True)
-    await messages.create_index([("room", 1), ("timestamp", 1)])
-    await qrcodes.create_index("token", unique=True)
-
-# Try to schedule index creation if an event loop is running
+from typing import List, Optional, Sequence, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import IndexModel
+
+from server.mongo_monitor import MONGO_COMMAND_MONITORING, command_monitor
+
+logger = logging.getLogger(__name__)
+
+# MongoDB configuration from environment variables
+MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
+DATABASE_NAME = os.getenv("DATABASE_NAME", "chat_app")
 try:
-    # Test connection to MongoDB Atlas
-    try:
-        client.admin.command('ping')
-        logging.info("Successfully connected to MongoDB Atlas")
-    except (ServerSelectionTimeoutError, ConnectionFailure) as e:
-        logging.error(f"Failed to connect to MongoDB Atlas: {e}")
-        
-    loop = asyncio.get_running_loop()
-    loop.create_task(ensure_indexes())
-except RuntimeError:
-    # No running loop at import time; main app should call ensure_indexes() on startup
-    pass
+    MONGO_MAX_POOL_SIZE = max(1, int(os.getenv("MONGO_MAX_POOL_SIZE", "50")))
+    # Connections opened at startup and kept open while idle
+    MONGO_MIN_POOL_SIZE = min(MONGO_MAX_POOL_SIZE, max(0, int(os.getenv("MONGO_MIN_POOL_SIZE", "2"))))
+    MONGO_TIMEOUT_MS = max(100, int(os.getenv("MONGO_TIMEOUT_MS", "5000")))
+except ValueError:
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_TIMEOUT_MS = 50, 2, 5000
+
+# (collection, indexes it should have)
+IndexSpec = Tuple[AsyncIOMotorCollection, Sequence[IndexModel]]
+
+# The one client for the whole process; created on first use
+_client: Optional[AsyncIOMotorClient] = None
+
+
+def get_client() -> AsyncIOMotorClient:
+    """The shared Motor client; creating it doesn't wait on the server"""
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(
+            MONGODB_URL,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+            connectTimeoutMS=MONGO_TIMEOUT_MS,
+            socketTimeoutMS=MONGO_TIMEOUT_MS,
+            # Per-route command counts and latencies, see /metrics/mongo
+            event_listeners=[command_monitor] if MONGO_COMMAND_MONITORING else [],
+        )
+    return _client
+
+
+def get_database(name: str = DATABASE_NAME) -> AsyncIOMotorDatabase:
+    return get_client()[name]
+
+
+async def connect(warm_connections: int = MONGO_MIN_POOL_SIZE):
+    """
+    Check the server answers and open `warm_connections` pooled sockets up
+    front, so the first requests after a cold start don't each pay for a
+    TCP + TLS + auth handshake.
+    """
+    client = get_client()
+    await client.admin.command("ping")
+    if warm_connections > 1:
+        # Concurrent commands can't share a socket, so each one checks out its own
+        await asyncio.gather(*(client.admin.command("ping") for _ in range(warm_connections)))
+
+
+def close_client():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+
+async def create_missing_indexes(collection: AsyncIOMotorCollection, indexes: Sequence[IndexModel]) -> List[str]:
+    """Create whichever of `indexes` the collection lacks, in one command; returns their names"""
+    existing = await collection.index_information()
+    missing = [index for index in indexes if index.document["name"] not in existing]
+    if not missing:
+        return []
+    return await collection.create_indexes(missing)
+
+
+async def ensure_indexes(specs: Sequence[IndexSpec]) -> List[str]:
+    """Bootstrap the indexes of several collections at once; names of the ones created"""
+    results = await asyncio.gather(*(create_missing_indexes(collection, indexes) for collection, indexes in specs))
+    created = [name for names in results for name in names]
+    if created:
+        logger.info(f"Created MongoDB indexes: {', '.join(created)}")
+    return created
@@ -0,0 +1,168 @@
+from datetime import datetime
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+# Every MongoDB index the app relies on, and the query shapes they exist for. Startup
+# applies INDEXES; test_indexes.py checks each of QUERY_SHAPES is served by an index,
+# with explain() against a real mongod or a prefix-matching stand-in without one.
+
+# Collection -> indexes. TTL indexes (expireAfterSeconds=0) delete a document once its expires_at passes.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True),
+    ],
+    "otps": [
+        # The unused OTP of an email and purpose, and replacing it
+        IndexModel([("email", ASCENDING), ("purpose", ASCENDING), ("used", ASCENDING)]),
+        # Rate limiting: OTPs sent in the last 15 minutes
+        IndexModel([("email", ASCENDING), ("purpose", ASCENDING), ("created_at", ASCENDING)]),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    "temp_passwords": [
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    "verification_tokens": [
+        IndexModel([("token", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)]),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    "qr_tokens": [
+        IndexModel([("token", ASCENDING)], unique=True),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    "sessions": [
+        IndexModel([("session_id", ASCENDING)], unique=True),
+        # Idle sessions: expires_at moves forward with activity
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    "messages": [
+        # _id breaks ties between messages stamped in the same millisecond
+        IndexModel([("room", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)]),
+    ],
+    "message_buckets": [
+        IndexModel([("room", ASCENDING), ("end", DESCENDING)]),
+        IndexModel([("room", ASCENDING), ("start", ASCENDING)]),
+    ],
+}
+
+
+class QueryShape(NamedTuple):
+    collection: str
+    name: str  # the code issuing it
+    filter: Dict[str, Any]
+    sort: Optional[List[Tuple[str, int]]] = None
+
+
+_T = datetime(2025, 1, 1)
+_ID = ObjectId("000000000000000000000000")
+
+# One representative query per lookup the app makes; values are placeholders
+QUERY_SHAPES: List[QueryShape] = [
+    QueryShape("users", "MongoStorage.get_user / update_password", {"email": "a@example.com"}),
+    QueryShape("otps", "MongoStorage.consume_otp / replace_otp",
+               {"email": "a@example.com", "purpose": "signup", "used": False}),
+    # The $match stage of the otp_window aggregation
+    QueryShape("otps", "MongoStorage.otp_window",
+               {"email": "a@example.com", "purpose": "signup", "created_at": {"$gte": _T}}),
+    QueryShape("temp_passwords", "MongoStorage.put_temp_password / pop_temp_password", {"email": "a@example.com"}),
+    QueryShape("verification_tokens", "MongoStorage.get_verification_token", {"token": "t"}),
+    QueryShape("verification_tokens", "MongoStorage.put_verification_token", {"email": "a@example.com"}),
+    QueryShape("qr_tokens", "MongoStorage.use_qr_token", {"token": "t", "used": False}),
+    QueryShape("sessions", "MongoStorage.get_session / touch_session / add_session_member",
+               {"session_id": "s", "expires_at": {"$gt": _T}}),
+    QueryShape("messages", "MongoMessageStore.history", {"room": "r"},
+               [("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    QueryShape("messages", "MongoMessageStore.history (next page)",
+               {"room": "r", "$or": [{"timestamp": {"$lt": _T}}, {"timestamp": _T, "_id": {"$lt": _ID}}]},
+               [("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    QueryShape("messages", "MongoMessageStore.export", {"room": "r"},
+               [("timestamp", ASCENDING), ("_id", ASCENDING)]),
+    QueryShape("message_buckets", "BucketedMessageStore.history", {"room": "r", "start": {"$lte": _T}},
+               [("end", DESCENDING)]),
+    QueryShape("message_buckets", "BucketedMessageStore.export", {"room": "r"}, [("start", ASCENDING)]),
+]
+
+
+def index_specs(database, collection_names: Optional[Dict[str, str]] = None,
+                only: Optional[Sequence[str]] = None) -> list:
+    """
+    (collection, indexes) pairs for server.db.ensure_indexes. collection_names
+    maps a registry name to the collection actually used (e.g. a configured
+    users collection); `only` limits it to some collections.
+    """
+    collection_names = collection_names or {}
+    return [(database[collection_names.get(name, name)], models) for name, models in INDEXES.items()
+            if only is None or name in only]
+
+
+def plan_stages(explain: dict) -> List[str]:
+    """Every stage of the winning plan in an explain() result"""
+    planner = explain.get("queryPlanner", explain)
+    plan = planner.get("winningPlan", {})
+    # Newer servers using the slot-based engine nest the classic plan one level down
+    plan = plan.get("queryPlan", plan)
+    stages, pending = [], [plan]
+    while pending:
+        stage = pending.pop()
+        if "stage" in stage:
+            stages.append(stage["stage"])
+        if "inputStage" in stage:
+            pending.append(stage["inputStage"])
+        pending.extend(stage.get("inputStages", ()))
+    return stages
+
+
+def uses_index(explain: dict) -> bool:
+    """True if the winning plan reads through an index and never scans the collection"""
+    stages = plan_stages(explain)
+    return "COLLSCAN" not in stages and any(stage in ("IXSCAN", "IDHACK", "EXPRESS_IXSCAN") for stage in stages)
+
+
+def _filter_fields(query: Dict[str, Any]) -> set:
+    fields = {field for field in query if not field.startswith("$")}
+    # Fields every branch of a top-level $or constrains count as well
+    if query.get("$or"):
+        fields |= set.intersection(*(_filter_fields(branch) for branch in query["$or"]))
+    return fields
+
+
+def matching_index(shape: QueryShape, indexes: Sequence[IndexModel] = None) -> Optional[str]:
+    """
+    Stand-in for the query planner: the name of an index whose leading keys
+    are fields the filter constrains (then, optionally, the sort keys), or
+    None if the query could only be answered by a collection scan.
+    """
+    fields = _filter_fields(shape.filter)
+    best, best_length = None, 0
+    for model in indexes if indexes is not None else INDEXES.get(shape.collection, ()):
+        keys = [field for field, _ in model.document["key"].items()]
+        length = 0
+        while length < len(keys) and keys[length] in fields:
+            length += 1
+        # An index can still serve the sort right after the equality prefix
+        if shape.sort and length and [f for f, _ in shape.sort] == keys[length:length + len(shape.sort)]:
+            length += len(shape.sort)
+        if length > best_length:
+            best, best_length = model.document["name"], length
+    return best
+
+
+async def explain_shape(database, shape: QueryShape, collection_names: Optional[Dict[str, str]] = None) -> dict:
+    collection = database[(collection_names or {}).get(shape.collection, shape.collection)]
+    cursor = collection.find(shape.filter)
+    if shape.sort:
+        cursor = cursor.sort(shape.sort)
+    return await cursor.explain()
+
+
+async def unindexed_queries(database, collection_names: Optional[Dict[str, str]] = None) -> List[str]:
+    """Explain every query shape against a real server; the ones that don't use an index"""
+    failures = []
+    for shape in QUERY_SHAPES:
+        explain = await explain_shape(database, shape, collection_names)
+        if not uses_index(explain):
+            failures.append(f"{shape.collection}: {shape.name} -> {' <- '.join(plan_stages(explain))}")
+    return failures
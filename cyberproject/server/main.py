@@ -1,16 +1,16 @@
-from fastapi import FastAPI, HTTPException, status, WebSocket, WebSocketDisconnect, Query
+from fastapi import FastAPI, HTTPException, status, WebSocket, WebSocketDisconnect, Query, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import Response, FileResponse
 from pydantic import BaseModel, EmailStr
 from passlib.hash import bcrypt
-from typing import Dict, List, Optional
+from typing import Dict, List, NamedTuple, Optional
 from uuid import uuid4
 import qrcode
 import io
+import asyncio
 import jwt
 from datetime import datetime, timedelta
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import json
 import re
@@ -37,6 +37,10 @@ except Exception as e:
     class SecurityMonitor:
         def analyze_message(self, *args, **kwargs):
             return []
+        def analyze_content(self, *args, **kwargs):
+            return []
+        def check_rate_limit(self, *args, **kwargs):
+            return []
         def add_warning(self, *args, **kwargs):
             pass
         def should_terminate_session(self, *args, **kwargs):
@@ -55,7 +59,25 @@ except Exception:
     pass
 load_dotenv()  # This will override with .env if it exists in current directory
 
+# Imported after the environment is loaded so WS_* settings are picked up
+from server.connection_manager import RoomConnectionManager, ConnectionRejected
+from server.pubsub import create_pubsub_backend, PUBSUB_BACKEND
+from server.ws_codec import negotiate_codec, receive_frame, CodecError, FrameTooLarge
+from server.room_actor import RoomActorRegistry
+from server.room_history import LRUSet
+from server.room_events import RoomEvents, EVENT_TYPES
+from server.message_store import (MessageWriter, create_message_store, ensure_indexes_when_available,
+                                  message_document, to_millis, MESSAGE_STORAGE)
+from server.chat import router as chat_router
+from server.db import (MONGODB_URL, DATABASE_NAME, MONGO_MIN_POOL_SIZE, get_client, close_client,
+                       connect as mongo_connect)
+from server.storage import (StorageBackend, MemoryStorage, BoundedDict, create_storage,
+                            STORAGE_BACKEND, STORAGE_MONGO, OTP_MAX_ATTEMPTS)
+from server.mongo_monitor import CommandRouteMiddleware, command_monitor
+from server.sessions import SessionRegistry
+
 app = FastAPI(title="Secure Chat App", version="2.0.0")
+app.include_router(chat_router, prefix="/chat")
 
 # Security configuration from environment variables
 SECRET_KEY = os.getenv("SECRET_KEY", "your-super-secret-jwt-key-change-this-in-production")
@@ -83,9 +105,7 @@ if len(_aes_iv_str) != 16:
 AES_SECRET_KEY = _aes_key_str.encode()
 AES_IV = _aes_iv_str.encode()
 
-# MongoDB configuration
-MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
-DATABASE_NAME = os.getenv("DATABASE_NAME", "chat_app")
+# MongoDB configuration (URL, database name and pool sizing live in server/db.py)
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "users")
 
 # Email/SMTP configuration
@@ -95,51 +115,47 @@ SMTP_USER = os.getenv("SMTP_USER", "")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "")
 SMTP_FROM_NAME = os.getenv("SMTP_FROM_NAME", "Private Chat")
 
+# Rooms a single multiplexed socket (/ws) may be subscribed to at once
+WS_MAX_ROOMS_PER_SOCKET = int(os.getenv("WS_MAX_ROOMS_PER_SOCKET", "50"))
+
+# Recent messages sent to a client joining a room: the default, and the most a client may ask
+# for with ?history=N (or "history" in a subscribe frame)
+WS_JOIN_HISTORY = int(os.getenv("WS_JOIN_HISTORY", "0"))
+WS_JOIN_HISTORY_MAX = int(os.getenv("WS_JOIN_HISTORY_MAX", "100"))
+
 # MongoDB client
 mongodb_client = None
 mongodb_connected = False
 
-# In-memory fallback storage (when MongoDB is unavailable)
-in_memory_users = {}
-in_memory_qr_tokens = {}
-in_memory_otps = {}
-in_memory_temp_passwords = {}
-in_memory_verification_tokens = {}  # For secure password reset flow
-in_memory_login_attempts = {}  # For login rate limiting
-
-# WebSocket connection manager
-class RoomConnectionManager:
-    def __init__(self):
-        # session_id -> list[WebSocket]
-        self.room_to_connections: Dict[str, List[WebSocket]] = {}
-
-    async def connect(self, session_id: str, websocket: WebSocket):
-        await websocket.accept()
-        self.room_to_connections.setdefault(session_id, []).append(websocket)
-
-    def disconnect(self, session_id: str, websocket: WebSocket):
-        connections = self.room_to_connections.get(session_id, [])
-        if websocket in connections:
-            connections.remove(websocket)
-        if not connections and session_id in self.room_to_connections:
-            del self.room_to_connections[session_id]
-
-    async def broadcast(self, session_id: str, message: dict):
-        connections = list(self.room_to_connections.get(session_id, []))
-        for connection in connections:
-            try:
-                await connection.send_json(message)
-            except:
-                # Remove dead connections
-                try:
-                    connections.remove(connection)
-                except Exception:
-                    pass
+# Users, OTPs, tokens and sessions (STORAGE_BACKEND=mongo|sqlite|memory); set up at startup,
+# in-memory when MongoDB is unavailable
+storage: StorageBackend = MemoryStorage()
+# Chat sessions in `storage`, expiring when idle, behind a per-worker cache
+sessions = SessionRegistry(storage)
+STORAGE_NAMES = {"mongo": "MongoDB", "sqlite": "SQLite", "memory": "In-Memory (temporary)"}
+in_memory_login_attempts = BoundedDict()  # For login rate limiting
 
 manager = RoomConnectionManager()
+# Presence, typing and read receipts, coalesced per room and sent without numbering
+room_events = RoomEvents(manager.broadcast_ephemeral)
+
+def user_left_session(user_email: str, session_id: str):
+    """A user's last connection to a session is gone"""
+    room_events.user_left(user_email, session_id)
+    # Tidy security tracking; rate-limit counters outlive the visit until their window passes
+    if hasattr(security_monitor, 'release_session_state'):
+        security_monitor.release_session_state(user_email, session_id)
+
+manager.on_user_left = user_left_session
+
+# Chat history is saved in batches behind the broadcast whenever MongoDB is configured; while it
+# is down the writer keeps retrying, buffering up to MESSAGE_BUFFER_MAX messages
+message_writer: Optional[MessageWriter] = None
+# Retries message index creation after a startup during an outage
+message_index_task: Optional[asyncio.Task] = None
 
-# In-memory session registry (can be moved to MongoDB later)
-SESSIONS: Dict[str, dict] = {}
+# (session_id, user, msg_id) of recent client messages, so retries aren't processed twice
+seen_message_ids = LRUSet()
 
 # Pydantic models
 class UserSignup(BaseModel):
@@ -395,7 +411,7 @@ async def send_email_otp(email: str, otp_code: str, purpose: str = "signup") ->
         return False
 
 async def store_otp(email: str, otp_code: str, purpose: str) -> bool:
-    """Store OTP in MongoDB or in-memory storage"""
+    """Store OTP, replacing any unused one for the same email and purpose"""
     expires_at = datetime.utcnow() + timedelta(minutes=5)
     
     otp_doc = {
@@ -408,157 +424,68 @@ async def store_otp(email: str, otp_code: str, purpose: str) -> bool:
         "attempts": 0
     }
     
-    if mongodb_connected:
-        try:
-            otps_collection = get_otps_collection()
-            # Delete any existing OTPs for this email and purpose
-            await otps_collection.delete_many({
-                "email": email,
-                "purpose": purpose,
-                "used": False
-            })
-            # Insert new OTP
-            await otps_collection.insert_one(otp_doc)
-            return True
-        except Exception as e:
-            print(f"Error storing OTP in MongoDB: {e}")
-            return False
-    else:
-        # In-memory storage
-        key = f"{email}:{purpose}"
-        in_memory_otps[key] = otp_doc
+    try:
+        await storage.replace_otp(otp_doc)
         return True
+    except Exception as e:
+        print(f"Error storing OTP: {e}")
+        return False
 
 async def verify_otp(email: str, otp_code: str, purpose: str) -> dict:
     """Verify OTP code"""
-    if mongodb_connected:
-        try:
-            otps_collection = get_otps_collection()
-            otp_doc = await otps_collection.find_one({
-                "email": email,
-                "purpose": purpose,
-                "used": False
-            })
-            
-            if not otp_doc:
-                return {"valid": False, "error": "OTP not found or already used"}
-            
-            # Check expiry
-            expires_at = otp_doc["expires_at"]
-            if datetime.utcnow() > expires_at:
-                await otps_collection.delete_one({"_id": otp_doc["_id"]})
-                return {"valid": False, "error": "OTP has expired"}
-            
-            # Check attempts
-            if otp_doc.get("attempts", 0) >= 5:
-                await otps_collection.delete_one({"_id": otp_doc["_id"]})
-                return {"valid": False, "error": "Too many failed attempts. Please request a new OTP."}
-            
-            # Verify code
-            if otp_doc["otp_code"] != otp_code:
-                # Increment attempts
-                await otps_collection.update_one(
-                    {"_id": otp_doc["_id"]},
-                    {"$inc": {"attempts": 1}}
-                )
-                return {"valid": False, "error": "Invalid OTP code"}
-            
-            # Mark as used
-            await otps_collection.update_one(
-                {"_id": otp_doc["_id"]},
-                {"$set": {"used": True, "used_at": datetime.utcnow()}}
-            )
-            
-            return {"valid": True}
-            
-        except Exception as e:
-            print(f"Error verifying OTP: {e}")
-            return {"valid": False, "error": "Verification error"}
-    else:
-        # In-memory verification
-        key = f"{email}:{purpose}"
-        otp_doc = in_memory_otps.get(key)
+    try:
+        # One atomic call marks the OTP used or counts the failed attempt; we get it as it was before
+        otp_doc = await storage.consume_otp(email, purpose, otp_code)
         
         if not otp_doc:
-            return {"valid": False, "error": "OTP not found"}
-        
-        if otp_doc["used"]:
-            return {"valid": False, "error": "OTP already used"}
+            return {"valid": False, "error": "OTP not found or already used"}
         
+        # Check expiry
         expires_at = otp_doc["expires_at"]
         if datetime.utcnow() > expires_at:
-            del in_memory_otps[key]
+            await storage.delete_otp(otp_doc)
             return {"valid": False, "error": "OTP has expired"}
         
-        if otp_doc.get("attempts", 0) >= 5:
-            del in_memory_otps[key]
+        # Check attempts
+        if otp_doc.get("attempts", 0) >= OTP_MAX_ATTEMPTS:
+            await storage.delete_otp(otp_doc)
             return {"valid": False, "error": "Too many failed attempts. Please request a new OTP."}
         
+        # Verify code
         if otp_doc["otp_code"] != otp_code:
-            otp_doc["attempts"] = otp_doc.get("attempts", 0) + 1
             return {"valid": False, "error": "Invalid OTP code"}
         
-        otp_doc["used"] = True
-        otp_doc["used_at"] = datetime.utcnow()
         return {"valid": True}
+        
+    except Exception as e:
+        print(f"Error verifying OTP: {e}")
+        return {"valid": False, "error": "Verification error"}
 
 async def check_otp_rate_limit(email: str, purpose: str) -> bool:
     """Check if user has exceeded rate limit (max 3 OTPs per 15 minutes)"""
-    if mongodb_connected:
-        try:
-            otps_collection = get_otps_collection()
-            fifteen_min_ago = datetime.utcnow() - timedelta(minutes=15)
-            count = await otps_collection.count_documents({
-                "email": email,
-                "purpose": purpose,
-                "created_at": {"$gte": fifteen_min_ago}
-            })
-            return count < 3
-        except:
-            return True
-    else:
-        # In-memory check
+    try:
         fifteen_min_ago = datetime.utcnow() - timedelta(minutes=15)
-        key_prefix = f"{email}:{purpose}"
-        count = sum(1 for key, doc in in_memory_otps.items() 
-                   if key.startswith(key_prefix) and doc["created_at"] >= fifteen_min_ago)
-        return count < 3
+        window = await storage.otp_window(email, purpose, fifteen_min_ago)
+        return window["count"] < 3
+    except:
+        return True
 
 # MongoDB utility functions
 async def connect_to_mongo():
     global mongodb_client
-    # Add timeout settings to prevent hanging
-    mongodb_client = AsyncIOMotorClient(
-        MONGODB_URL,
-        serverSelectionTimeoutMS=5000,  # 5 seconds timeout
-        connectTimeoutMS=5000,
-        socketTimeoutMS=5000
-    )
-    # Test the connection
-    await mongodb_client.admin.command('ping')
-    print(f"Connected to MongoDB at {MONGODB_URL}")
+    # The process-wide client (server/db.py); storage and chat history share its pool
+    mongodb_client = get_client()
+    # Test the connection and open the minimum pool up front
+    await mongo_connect()
+    print(f"Connected to MongoDB at {MONGODB_URL} ({MONGO_MIN_POOL_SIZE} connections warmed)")
 
 async def close_mongo_connection():
     global mongodb_client
     if mongodb_client is not None:
-        mongodb_client.close()
+        close_client()
+        mongodb_client = None
         print("MongoDB connection closed")
 
-def get_user_collection():
-    if mongodb_client is None:
-        raise RuntimeError("MongoDB not connected")
-    return mongodb_client[DATABASE_NAME][COLLECTION_NAME]
-
-def get_qr_tokens_collection():
-    if mongodb_client is None:
-        raise RuntimeError("MongoDB not connected")
-    return mongodb_client[DATABASE_NAME]["qr_tokens"]
-
-def get_otps_collection():
-    if mongodb_client is None:
-        raise RuntimeError("MongoDB not connected")
-    return mongodb_client[DATABASE_NAME]["otps"]
-
 # Password hashing helper function (handles bcrypt 72-byte limit)
 def hash_password(password: str, rounds: int = 12) -> str:
     """
@@ -620,43 +547,75 @@ def verify_token(token: str):
     except jwt.JWTError:
         return None
 
+def require_user(token: str = Query(...)) -> str:
+    """Dependency for operational endpoints: the same ?token= check as the /security endpoints"""
+    user_email = verify_token(token)
+    if not user_email:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    return user_email
+
+# Routers outside this module (server/chat.py) authenticate, decrypt and look up sessions through app.state
+app.state.verify_token = verify_token
+app.state.decrypt_message = decrypt_message
+app.state.sessions = sessions
+
 # Startup and shutdown events
 @app.on_event("startup")
 async def startup_event():
-    global mongodb_connected
-    try:
-        await connect_to_mongo()
-        mongodb_connected = True
-        
-        # Only create indexes if MongoDB is connected
+    global mongodb_connected, message_writer, message_index_task, storage, sessions
+    if STORAGE_BACKEND == STORAGE_MONGO:
         try:
-            # Create indexes for collections
-            user_collection = get_user_collection()
-            qr_tokens_collection = get_qr_tokens_collection()
-            
-            # Ensure unique email index for users
-            await user_collection.create_index("email", unique=True)
-            
-            # Ensure unique token index for QR tokens and TTL index for expiry
-            await qr_tokens_collection.create_index("token", unique=True)
-            await qr_tokens_collection.create_index("expires_at", expireAfterSeconds=0)  # TTL index
-            
-            # Create indexes for OTPs collection
-            otps_collection = get_otps_collection()
-            await otps_collection.create_index("email")
-            await otps_collection.create_index("expires_at", expireAfterSeconds=0)  # TTL index for auto-cleanup
-            await otps_collection.create_index([("email", 1), ("purpose", 1), ("used", 1)])
-        except Exception as index_error:
-            print(f"⚠️  Warning: Could not create indexes: {str(index_error)[:100]}")
-        
-        print("✅ MongoDB connected successfully")
-    except Exception as e:
-        mongodb_connected = False
-        print(f"⚠️  MongoDB connection failed: {str(e)[:100]}")
-        print("⚠️  Using in-memory storage (data will not persist)")
-    
+            await connect_to_mongo()
+            mongodb_connected = True
+            print("✅ MongoDB connected successfully")
+        except Exception as e:
+            mongodb_connected = False
+            print(f"⚠️  MongoDB connection failed: {str(e)[:100]}")
+            print("⚠️  Serving from in-memory storage until MongoDB is reachable (writes are journaled)")
+    
+    # MongoDB sits behind a circuit breaker: while it is down requests fail over to memory
+    # at once instead of waiting out driver timeouts, and writes are replayed when it is back
+    storage = create_storage(STORAGE_BACKEND, mongodb_client[DATABASE_NAME] if mongodb_client is not None else None,
+                             users_collection=COLLECTION_NAME)
+    # One document per message, or per-room buckets with MESSAGE_STORAGE=buckets. Set up even if
+    # MongoDB is down right now, so history is saved once it comes back. It shares the storage
+    # backend's circuit breaker, so chat history fails fast (and buffers) during an outage too
+    message_store = create_message_store(mongodb_client[DATABASE_NAME], breaker=getattr(storage, "breaker", None)) \
+        if mongodb_client is not None else None
+    
+    # Indexes (MongoDB) or tables (SQLite), bootstrapped concurrently; existing indexes are skipped
+    storage_error, index_error = await asyncio.gather(
+        storage.start(),
+        message_store.ensure_indexes() if mongodb_connected else asyncio.sleep(0),
+        return_exceptions=True
+    )
+    if isinstance(storage_error, Exception):
+        print(f"⚠️  Warning: Could not prepare {storage.name} storage: {str(storage_error)[:100]}")
+        if storage.name != STORAGE_MONGO:
+            print("⚠️  Using in-memory storage (data will not persist)")
+            storage = MemoryStorage()
+    if isinstance(index_error, Exception):
+        print(f"⚠️  Warning: Could not create message indexes: {str(index_error)[:100]}")
+    if message_store is not None and (isinstance(index_error, Exception) or not mongodb_connected):
+        # Created in the background once MongoDB answers
+        message_index_task = asyncio.create_task(ensure_indexes_when_available(message_store))
+    app.state.mongo_breaker = getattr(storage, "breaker", None)
+    sessions = SessionRegistry(storage)
+    app.state.sessions = sessions
+    
+    if message_store is not None:
+        message_writer = MessageWriter(message_store)
+        message_writer.start()
+        app.state.message_store = message_store
+
+    # Room fan-out across workers (in-process unless PUBSUB_BACKEND=redis)
+    await manager.start(create_pubsub_backend())
+    room_events.start()
+
     print("\n🔐 Security features enabled:")
-    print(f"   - Storage: {'MongoDB' if mongodb_connected else 'In-Memory (temporary)'}")
+    print(f"   - Storage: {STORAGE_NAMES.get(storage.name, storage.name)}")
+    print(f"   - Room Pub/Sub: {PUBSUB_BACKEND}")
+    print(f"   - Chat History: {f'MongoDB ({MESSAGE_STORAGE}, write-behind)' if message_writer else 'Not persisted'}")
     print(f"   - JWT Algorithm: {ALGORITHM}")
     print(f"   - Token Expiry: {ACCESS_TOKEN_EXPIRE_HOURS} hours")
     print(f"   - AES Encryption: {'Enabled' if len(AES_SECRET_KEY) == 32 else 'Warning: Key length incorrect'}")
@@ -672,8 +631,20 @@ async def startup_event():
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await room_actors.stop()
+    if message_index_task is not None:
+        message_index_task.cancel()
+    if message_writer is not None:
+        # Final flush of buffered history before the client goes away
+        await message_writer.stop()
+    await room_events.stop()
+    await manager.stop()
+    await storage.close()
     await close_mongo_connection()
 
+# Attribute MongoDB commands to the route that issued them
+app.add_middleware(CommandRouteMiddleware, router=app.router)
+
 # Enable CORS
 app.add_middleware(
     CORSMiddleware,
@@ -752,34 +723,18 @@ async def signup(user: UserSignup):
         "security_level": "bcrypt-12-rounds"
     }
     
-    # Use MongoDB if connected, otherwise use in-memory storage
-    if mongodb_connected:
-        try:
-            user_collection = get_user_collection()
-            
-            # Check if user already exists
-            existing_user = await user_collection.find_one({"email": user.email})
-            if existing_user:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="User already exists"
-                )
-            
-            # Insert user into MongoDB
-            await user_collection.insert_one(user_doc)
-        except Exception as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Database error: {str(e)}"
-            )
-    else:
-        # Use in-memory storage
-        if user.email in in_memory_users:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="User already exists"
-            )
-        in_memory_users[user.email] = user_doc
+    try:
+        created = await storage.create_user(user_doc)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
+    if not created:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="User already exists"
+        )
     
     return {"message": "User registered successfully with enhanced security"}
 
@@ -811,26 +766,18 @@ async def send_signup_otp(request: OTPRequest):
         )
     
     # Check if user already exists
-    if mongodb_connected:
-        try:
-            user_collection = get_user_collection()
-            existing_user = await user_collection.find_one({"email": email})
-            if existing_user:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="User already exists"
-                )
-        except Exception as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Database error: {str(e)}"
-            )
-    else:
-        if email in in_memory_users:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="User already exists"
-            )
+    try:
+        existing_user = await storage.get_user(email)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
+    if existing_user:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="User already exists"
+        )
     
     # Check rate limit
     if not await check_otp_rate_limit(email, "signup"):
@@ -852,24 +799,15 @@ async def send_signup_otp(request: OTPRequest):
     # Store OTP (also store password temporarily for signup completion)
     await store_otp(email, otp_code, "signup")
     
-    # Store password temporarily in memory (will be used after OTP verification)
-    if mongodb_connected:
-        try:
-            temp_passwords_collection = mongodb_client[DATABASE_NAME]["temp_passwords"]
-            await temp_passwords_collection.delete_many({"email": email})
-            await temp_passwords_collection.insert_one({
-                "email": email,
-                "password_hash": hash_password(password, rounds=12),
-                "created_at": datetime.utcnow(),
-                "expires_at": datetime.utcnow() + timedelta(minutes=10)
-            })
-        except:
-            pass  # Fallback to in-memory
-    else:
-        in_memory_temp_passwords[email] = {
-            "password_hash": hash_password(password, rounds=12),
-            "expires_at": datetime.utcnow() + timedelta(minutes=10)
-        }
+    # Store password hash temporarily (will be used after OTP verification)
+    try:
+        await storage.put_temp_password(email, hash_password(password, rounds=12),
+                                        datetime.utcnow() + timedelta(minutes=10))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
     
     return {
         "message": "OTP sent successfully",
@@ -891,26 +829,11 @@ async def verify_signup_otp(verification: OTPVerification):
             detail=result["error"]
         )
     
-    # Get stored password
-    password_hash = None
-    if mongodb_connected:
-        try:
-            temp_passwords_collection = mongodb_client[DATABASE_NAME]["temp_passwords"]
-            temp_doc = await temp_passwords_collection.find_one({"email": email})
-            if temp_doc:
-                password_hash = temp_doc["password_hash"]
-                # Delete temp password
-                await temp_passwords_collection.delete_one({"_id": temp_doc["_id"]})
-        except:
-            pass
-    
-    if not password_hash:
-        # Try in-memory
-        if email in in_memory_temp_passwords:
-            temp_data = in_memory_temp_passwords[email]
-            if datetime.utcnow() <= temp_data["expires_at"]:
-                password_hash = temp_data["password_hash"]
-            del in_memory_temp_passwords[email]
+    # Get stored password (and delete it)
+    try:
+        password_hash = await storage.pop_temp_password(email)
+    except Exception:
+        password_hash = None
     
     if not password_hash:
         raise HTTPException(
@@ -927,17 +850,18 @@ async def verify_signup_otp(verification: OTPVerification):
         "email_verified": True
     }
     
-    if mongodb_connected:
-        try:
-            user_collection = get_user_collection()
-            await user_collection.insert_one(user_doc)
-        except Exception as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Failed to create account: {str(e)}"
-            )
-    else:
-        in_memory_users[email] = user_doc
+    try:
+        created = await storage.create_user(user_doc)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to create account: {str(e)}"
+        )
+    if not created:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="User already exists"
+        )
     
     return {
         "message": "Account created successfully. Please login.",
@@ -951,15 +875,10 @@ async def send_forgot_otp(request: OTPRequest):
     
     # Check if user exists
     user_exists = False
-    if mongodb_connected:
-        try:
-            user_collection = get_user_collection()
-            user = await user_collection.find_one({"email": email})
-            user_exists = user is not None
-        except:
-            pass
-    else:
-        user_exists = email in in_memory_users
+    try:
+        user_exists = await storage.get_user(email) is not None
+    except:
+        pass
     
     # For security, don't reveal if user exists or not
     # Always send OTP (but only verify if user exists)
@@ -995,56 +914,30 @@ async def generate_verification_token(email: str) -> str:
     token = uuid4().hex
     expires_at = datetime.utcnow() + timedelta(minutes=15)  # 15 minutes validity
     
-    token_data = {
-        "email": email,
-        "expires_at": expires_at,
-        "created_at": datetime.utcnow()
-    }
-    
-    if mongodb_connected:
-        try:
-            tokens_collection = mongodb_client[DATABASE_NAME]["verification_tokens"]
-            await tokens_collection.delete_many({"email": email})  # Remove old tokens
-            await tokens_collection.insert_one({
-                "token": token,
-                "email": email,
-                "expires_at": expires_at,
-                "created_at": datetime.utcnow()
-            })
-        except:
-            pass  # Fallback to in-memory
-    
-    in_memory_verification_tokens[token] = token_data
+    try:
+        # Replaces any older token for this email
+        await storage.put_verification_token(token, email, expires_at)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
     return token
 
 async def verify_verification_token(token: str) -> dict:
     """Verify a password reset token"""
-    if mongodb_connected:
-        try:
-            tokens_collection = mongodb_client[DATABASE_NAME]["verification_tokens"]
-            token_doc = await tokens_collection.find_one({"token": token})
-            if not token_doc:
-                return {"valid": False, "error": "Invalid verification token"}
-            
-            expires_at = token_doc["expires_at"]
-            if datetime.utcnow() > expires_at:
-                await tokens_collection.delete_one({"token": token})
-                return {"valid": False, "error": "Verification token has expired"}
-            
-            return {"valid": True, "email": token_doc["email"]}
-        except:
-            pass
-    
-    # In-memory check
-    if token not in in_memory_verification_tokens:
+    try:
+        token_doc = await storage.get_verification_token(token)
+    except Exception:
+        token_doc = None
+    if not token_doc:
         return {"valid": False, "error": "Invalid verification token"}
     
-    token_data = in_memory_verification_tokens[token]
-    if datetime.utcnow() > token_data["expires_at"]:
-        del in_memory_verification_tokens[token]
+    if datetime.utcnow() > token_doc["expires_at"]:
+        await storage.delete_verification_token(token)
         return {"valid": False, "error": "Verification token has expired"}
     
-    return {"valid": True, "email": token_data["email"]}
+    return {"valid": True, "email": token_doc["email"]}
 
 @app.post("/verify_forgot_otp")
 async def verify_forgot_otp(verification: OTPVerification):
@@ -1062,15 +955,10 @@ async def verify_forgot_otp(verification: OTPVerification):
     
     # Check if user exists
     user_exists = False
-    if mongodb_connected:
-        try:
-            user_collection = get_user_collection()
-            user = await user_collection.find_one({"email": email})
-            user_exists = user is not None
-        except:
-            pass
-    else:
-        user_exists = email in in_memory_users
+    try:
+        user_exists = await storage.get_user(email) is not None
+    except:
+        pass
     
     if not user_exists:
         raise HTTPException(
@@ -1123,15 +1011,10 @@ async def reset_password_with_token(reset: PasswordResetWithToken):
     email = token_result["email"]
     
     # Delete used token
-    if mongodb_connected:
-        try:
-            tokens_collection = mongodb_client[DATABASE_NAME]["verification_tokens"]
-            await tokens_collection.delete_one({"token": verification_token})
-        except:
-            pass
-    
-    if verification_token in in_memory_verification_tokens:
-        del in_memory_verification_tokens[verification_token]
+    try:
+        await storage.delete_verification_token(verification_token)
+    except:
+        pass
     
     return await _reset_password_internal(email, new_password)
 
@@ -1155,36 +1038,18 @@ async def _reset_password_internal(email: str, new_password: str):
     hashed_password = hash_password(new_password, rounds=12)
     
     # Update password
-    if mongodb_connected:
-        try:
-            user_collection = get_user_collection()
-            result = await user_collection.update_one(
-                {"email": email},
-                {"$set": {
-                    "password_hash": hashed_password,
-                    "password_reset_at": datetime.utcnow()
-                }}
-            )
-            if result.matched_count == 0:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail="User not found"
-                )
-        except HTTPException:
-            raise
-        except Exception as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Failed to reset password: {str(e)}"
-            )
-    else:
-        if email not in in_memory_users:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="User not found"
-            )
-        in_memory_users[email]["password_hash"] = hashed_password
-        in_memory_users[email]["password_reset_at"] = datetime.utcnow()
+    try:
+        updated = await storage.update_password(email, hashed_password)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to reset password: {str(e)}"
+        )
+    if not updated:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
     
     return {
         "message": "Password reset successfully. Please login with your new password.",
@@ -1247,21 +1112,13 @@ async def login(user: UserLogin):
             detail=rate_limit["message"]
         )
     
-    db_user = None
-    
-    # Use MongoDB if connected, otherwise use in-memory storage
-    if mongodb_connected:
-        try:
-            user_collection = get_user_collection()
-            db_user = await user_collection.find_one({"email": email})
-        except Exception as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Database error: {str(e)}"
-            )
-    else:
-        # Use in-memory storage
-        db_user = in_memory_users.get(email)
+    try:
+        db_user = await storage.get_user(email)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Database error: {str(e)}"
+        )
     
     if not db_user:
         record_failed_login(email)
@@ -1316,8 +1173,7 @@ async def generate_qrcode(user_email: str = Query(..., description="User email f
                 detail="Failed to generate QR token"
             )
         
-        # Store token in MongoDB with expiry
-        qr_tokens_collection = get_qr_tokens_collection()
+        # Store token with expiry
         token_doc = {
             "token": encrypted_token,
             "user_email": user_email,
@@ -1326,7 +1182,7 @@ async def generate_qrcode(user_email: str = Query(..., description="User email f
             "used": False
         }
         
-        await qr_tokens_collection.insert_one(token_doc)
+        await storage.put_qr_token(token_doc)
         
         # Generate QR code with encrypted token (not raw email)
         qr = qrcode.QRCode(version=1, box_size=10, border=5)
@@ -1363,12 +1219,8 @@ async def validate_qr_token_endpoint(qr_token: QRToken):
                 detail=validation_result["error"]
             )
         
-        # Check if token exists in MongoDB and hasn't been used
-        qr_tokens_collection = get_qr_tokens_collection()
-        token_doc = await qr_tokens_collection.find_one({
-            "token": qr_token.token,
-            "used": False
-        })
+        # Mark the token used, if it exists and hasn't been used already
+        token_doc = await storage.use_qr_token(qr_token.token)
         
         if not token_doc:
             raise HTTPException(
@@ -1376,12 +1228,6 @@ async def validate_qr_token_endpoint(qr_token: QRToken):
                 detail="Token not found or already used"
             )
         
-        # Mark token as used
-        await qr_tokens_collection.update_one(
-            {"token": qr_token.token},
-            {"$set": {"used": True, "used_at": datetime.utcnow()}}
-        )
-        
         # Generate JWT token for the user
         user_email = validation_result["user_email"]
         token_data = {"sub": user_email}
@@ -1409,11 +1255,14 @@ class CreateSessionResponse(BaseModel):
     join_url: str
 
 @app.post("/create_session", response_model=CreateSessionResponse)
-async def create_session():
+async def create_session(token: Optional[str] = Query(None)):
     session_id = uuid4().hex
-    SESSIONS[session_id] = {
-        "created_at": datetime.utcnow().isoformat()
-    }
+    session = {"created_at": datetime.utcnow().isoformat()}
+    # The creator can read the session's history and transcript
+    creator = verify_token(token) if token else None
+    if creator:
+        session["created_by"] = creator
+    await sessions.create(session_id, session)
     # Construct a join URL pointing to the chat client with session_id
     join_url = f"/static/chat.html?session_id={session_id}"
     return {"session_id": session_id, "join_url": join_url}
@@ -1421,7 +1270,7 @@ async def create_session():
 @app.get("/qr_from_session/{session_id}")
 async def qr_from_session(session_id: str):
     # Validate session exists
-    if session_id not in SESSIONS:
+    if not await sessions.exists(session_id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
 
     # Encode a full join URL for sharing (client will request relative path)
@@ -1438,6 +1287,185 @@ async def qr_from_session(session_id: str):
     except Exception:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to generate QR code")
 
+class ChatSubmission(NamedTuple):
+    connection: object
+    user_email: str
+    session_id: str
+    user: str
+    message: str
+    msg_id: Optional[str] = None
+
+
+def is_duplicate_message(session_id: str, user_email: str, msg_id) -> bool:
+    """Client retries reuse their msg_id; only the first copy is processed"""
+    if msg_id is None:
+        return False
+    return not seen_message_ids.add((session_id, user_email, str(msg_id)))
+
+
+def resume_state(connection, session_id: str) -> dict:
+    """What a client needs to resume later: the room's epoch and latest sequence number"""
+    buffer = manager.history.room(session_id)
+    return {"epoch": buffer.epoch, "seq": buffer.seq, "resumed": connection.resumed}
+
+
+def parse_last_seq(value) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _analyze_and_encrypt(user_email: str, session_id: str, message: str):
+    """The CPU-heavy half of handling a chat message; runs in a worker thread"""
+    try:
+        warnings = security_monitor.analyze_content(user_email, session_id, message)
+    except Exception as sec_error:
+        print(f"⚠️  Security monitoring error: {sec_error}")
+        warnings = []
+    return warnings, encrypt_message(message)
+
+
+async def analyze_chat_message(seq: int, item: ChatSubmission):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _analyze_and_encrypt, item.user_email, item.session_id, item.message)
+
+
+async def deliver_chat_message(seq: int, item: ChatSubmission, analysis):
+    """Runs in room order: rate limiting, warnings, termination, then the broadcast"""
+    content_warnings, encrypted_message = analysis
+    connection, user_email, session_id = item.connection, item.user_email, item.session_id
+    try:
+        warnings = content_warnings + security_monitor.check_rate_limit(user_email, session_id)
+
+        # Add warnings to user's record
+        for warning in warnings:
+            security_monitor.add_warning(warning)
+
+        # Check if session should be terminated
+        should_terminate = security_monitor.should_terminate_session(user_email, session_id)
+    except Exception as sec_error:
+        print(f"⚠️  Security monitoring error: {sec_error}")
+        warnings = []
+        should_terminate = False
+
+    if should_terminate:
+        # Messages the user had already sent are dropped as well
+        termination_msg = "Session terminated due to security violations."
+        encrypted_termination = encrypt_message(termination_msg)
+        # Every device the user has in this session is cut off, not just the sending one;
+        # multiplexed sockets stay subscribed to their other sessions
+        manager.terminate_user(user_email, session_id, notice={
+            "user": "Security System",
+            "message": encrypted_termination,
+            "encrypted": True,
+            "security_info": "Session terminated due to multiple security warnings",
+            "terminated": True
+        }, code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    # Send warning messages if any
+    try:
+        for warning in warnings:
+            warning_msg = f"Security Warning: {warning.message}"
+            encrypted_warning = encrypt_message(warning_msg)
+            warning_count = security_monitor.get_warning_count(user_email, session_id) if hasattr(security_monitor, 'get_warning_count') else 0
+            max_warnings = security_monitor.max_warnings_before_ban if hasattr(security_monitor, 'max_warnings_before_ban') else 3
+            connection.send({
+                "user": "Security System",
+                "message": encrypted_warning,
+                "encrypted": True,
+                "security_info": f"Warning {warning_count}/{max_warnings}",
+                "warning": True
+            }, room=session_id)
+    except Exception as warn_error:
+        print(f"⚠️  Warning message error: {warn_error}")
+
+    response = {
+        "user": item.user,
+        "message": encrypted_message,
+        "encrypted": True,
+        "timestamp": datetime.utcnow().isoformat(),
+        "security_info": "Message encrypted with AES-256-CBC"
+    }
+    if item.msg_id is not None:
+        response["msg_id"] = item.msg_id
+    await manager.broadcast(session_id, response)
+    if message_writer is not None:
+        # Buffered, not awaited on Mongo; only waits if the writer has fallen far behind
+        await message_writer.append(message_document(session_id, response))
+    # Chat keeps the session alive; written back at most once per SESSION_TOUCH_INTERVAL
+    await sessions.record_activity(session_id)
+
+
+# One actor per active room: analysis is pipelined, delivery keeps arrival order
+room_actors = RoomActorRegistry(analyze_chat_message, deliver_chat_message)
+
+
+def join_history_count(value) -> int:
+    """How many stored messages a joining client gets: its ?history=N within the cap, or the default"""
+    count = parse_last_seq(value)
+    if count is None:
+        count = WS_JOIN_HISTORY
+    return max(0, min(count, WS_JOIN_HISTORY_MAX))
+
+async def recent_messages(session_id: str, count: int) -> dict:
+    """
+    The last `count` messages of a room, oldest first: a page from the message
+    store, topped up from the room's resumption buffer with anything newer
+    that the write-behind writer hasn't saved yet.
+    """
+    stored = []
+    store = getattr(app.state, "message_store", None)
+    if store is not None:
+        try:
+            stored = [message async for message in store.history(session_id, limit=count)]
+        except Exception as e:
+            print(f"⚠️  Could not load history for session {session_id}: {str(e)[:100]}")
+    full_page = len(stored) == count
+    stored.reverse()
+
+    newest = to_millis(datetime.fromisoformat(stored[-1]["timestamp"])) if stored else None
+    unsaved = []
+    buffer = manager.history.rooms.get(session_id)
+    for message in buffer.messages if buffer is not None else ():
+        try:
+            millis = to_millis(datetime.fromisoformat(message["timestamp"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+        if newest is None or millis > newest:
+            unsaved.append({key: message[key] for key in ("user", "message", "encrypted", "timestamp", "msg_id")
+                            if key in message})
+    messages = (stored + unsaved)[-count:]
+    # Older pages continue from the oldest stored message still on this one
+    kept = [message for message in messages if "cursor" in message]
+    more = full_page or len(kept) < len(stored)
+    return {"messages": messages, "next": kept[0]["cursor"] if kept and more else None}
+
+async def send_join_history(connection, session_id: str, count: int):
+    """Send a joining client the room's recent messages as one {"type": "history"} frame"""
+    if count <= 0:
+        return
+    page = await recent_messages(session_id, count)
+    if page["messages"]:
+        connection.send({"type": "history", **page}, room=session_id)
+
+def join_events(connection, session_id: str, user_email: str):
+    """Show a joining client who is present, typing and caught up, then announce it online"""
+    snapshot = room_events.snapshot(session_id)
+    if snapshot is not None:
+        connection.send(snapshot, room=session_id)
+    room_events.set_presence(session_id, user_email, "online")
+
+async def reject_connection(websocket: WebSocket, rejected: ConnectionRejected, subprotocol: Optional[str] = None):
+    """
+    Turn away a socket over a connection limit. Closing before the handshake
+    only yields an HTTP 403, so accept and close straight away with 1013
+    (try again later) and a reason carrying the limit and retry-after seconds.
+    """
+    await websocket.accept(subprotocol=subprotocol)
+    await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason=rejected.reason)
+
 @app.websocket("/ws/{session_id}")
 async def websocket_room_endpoint(websocket: WebSocket, session_id: str, token: str = Query(...)):
     # Verify JWT token
@@ -1446,94 +1474,189 @@ async def websocket_room_endpoint(websocket: WebSocket, session_id: str, token:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
     # Validate session
-    if session_id not in SESSIONS:
+    if not await sessions.exists(session_id):
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
 
-    await manager.connect(session_id, websocket)
+    # All outbound frames go through the connection's queue so only its writer touches the socket
+    # JSON unless the client negotiates the binary codec
+    codec, subprotocol = negotiate_codec(websocket)
+    # Clients that can unpack batch frames opt in to outbound coalescing with ?coalesce=1
+    coalesce = websocket.query_params.get("coalesce", "").lower() in ("1", "true")
+    # Reconnecting clients pass ?epoch=...&last_seq=... to get only what they missed
     try:
-        welcome_msg = f"Welcome {user_email}! Joined session {session_id}."
-        encrypted_welcome = encrypt_message(welcome_msg)
-        await websocket.send_json({
-            "user": "System",
-            "message": encrypted_welcome,
-            "encrypted": True,
-            "security_info": "Message encrypted with AES-256-CBC"
-        })
+        connection = await manager.connect(session_id, websocket, user_email=user_email,
+                                           codec=codec, subprotocol=subprotocol, coalesce=coalesce,
+                                           epoch=websocket.query_params.get("epoch"),
+                                           last_seq=parse_last_seq(websocket.query_params.get("last_seq")))
+    except ConnectionRejected as e:
+        await reject_connection(websocket, e, subprotocol)
+        return
+    await sessions.add_member(session_id, user_email)
+    try:
+        if not connection.resumed:
+            welcome_msg = f"Welcome {user_email}! Joined session {session_id}."
+            encrypted_welcome = encrypt_message(welcome_msg)
+            connection.send({
+                "user": "System",
+                "message": encrypted_welcome,
+                "encrypted": True,
+                "security_info": "Message encrypted with AES-256-CBC"
+            })
+        connection.send({"type": "resume_state", **resume_state(connection, session_id)})
+        join_events(connection, session_id, user_email)
+        if not connection.resumed:
+            # Loaded off the receive path; the client places it above anything live
+            asyncio.create_task(send_join_history(connection, session_id,
+                                                  join_history_count(websocket.query_params.get("history"))))
 
         while True:
-            data = await websocket.receive_text()
+            # Size is checked before the frame is decoded
+            data = await receive_frame(websocket)
             try:
-                message_data = json.loads(data)
+                message_data = connection.codec.decode(data)
+                # Heartbeat replies only prove the connection is alive
+                if isinstance(message_data, dict) and message_data.get("type") == "pong":
+                    connection.touch(activity=False)
+                    continue
+                connection.touch()
+                # Presence, typing and read receipts skip analysis and encryption
+                if message_data.get("type") in EVENT_TYPES:
+                    room_events.submit(session_id, user_email, message_data)
+                    continue
                 user = message_data.get("user", user_email)
                 message = message_data.get("message", "")
-                
-                # Security monitoring - analyze message for threats
-                try:
-                    warnings = security_monitor.analyze_message(user_email, session_id, message)
-                    
-                    # Add warnings to user's record
-                    for warning in warnings:
-                        security_monitor.add_warning(warning)
-                    
-                    # Check if session should be terminated
-                    should_terminate = security_monitor.should_terminate_session(user_email, session_id)
-                except Exception as sec_error:
-                    print(f"⚠️  Security monitoring error: {sec_error}")
-                    warnings = []
-                    should_terminate = False
-                
-                if should_terminate:
-                    termination_msg = "Session terminated due to security violations."
-                    encrypted_termination = encrypt_message(termination_msg)
-                    await websocket.send_json({
-                        "user": "Security System",
-                        "message": encrypted_termination,
-                        "encrypted": True,
-                        "security_info": "Session terminated due to multiple security warnings",
-                        "terminated": True
-                    })
-                    await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-                    return
-                
-                # Send warning messages if any
-                try:
-                    for warning in warnings:
-                        warning_msg = f"Security Warning: {warning.message}"
-                        encrypted_warning = encrypt_message(warning_msg)
-                        warning_count = security_monitor.get_warning_count(user_email, session_id) if hasattr(security_monitor, 'get_warning_count') else 0
-                        max_warnings = security_monitor.max_warnings_before_ban if hasattr(security_monitor, 'max_warnings_before_ban') else 3
-                        await websocket.send_json({
-                            "user": "Security System",
-                            "message": encrypted_warning,
-                            "encrypted": True,
-                            "security_info": f"Warning {warning_count}/{max_warnings}",
-                            "warning": True
-                        })
-                except Exception as warn_error:
-                    print(f"⚠️  Warning message error: {warn_error}")
-                
-                encrypted_message = encrypt_message(message)
-                response = {
-                    "user": user,
-                    "message": encrypted_message,
-                    "encrypted": True,
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "security_info": "Message encrypted with AES-256-CBC"
-                }
-                await manager.broadcast(session_id, response)
-            except json.JSONDecodeError:
+                msg_id = message_data.get("msg_id")
+                if is_duplicate_message(session_id, user_email, msg_id):
+                    continue
+
+                # Security analysis, encryption and fan-out run in the room's actor,
+                # which delivers messages in the order they arrive
+                await room_actors.submit(session_id, ChatSubmission(connection, user_email, session_id,
+                                                                    user, message, msg_id))
+            except CodecError:
+                connection.touch()
                 error_msg = "Invalid message format. Please send JSON with 'user' and 'message' fields."
                 encrypted_error = encrypt_message(error_msg)
-                await websocket.send_json({
+                connection.send({
                     "user": "System",
                     "message": encrypted_error,
                     "encrypted": True,
                     "error": True
                 })
+    except FrameTooLarge as e:
+        print(f"⚠️  Closing connection in session {session_id}: {e}")
+        connection.close(code=status.WS_1009_MESSAGE_TOO_BIG)
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(session_id, websocket)
 
+@app.websocket("/ws")
+async def websocket_multiplexed_endpoint(websocket: WebSocket, token: str = Query(...)):
+    """
+    One authenticated socket for many sessions. Clients send
+    {"type": "subscribe" | "unsubscribe", "room": session_id} and chat messages
+    with a "room" field; every frame the server sends carries its room.
+    Subscribe may carry "epoch" and "last_seq" to resume a room.
+    """
+    user_email = verify_token(token)
+    if not user_email:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    codec, subprotocol = negotiate_codec(websocket)
+    coalesce = websocket.query_params.get("coalesce", "").lower() in ("1", "true")
+    try:
+        connection = await manager.connect_multiplexed(websocket, user_email=user_email, codec=codec,
+                                                       subprotocol=subprotocol, coalesce=coalesce)
+    except ConnectionRejected as e:
+        await reject_connection(websocket, e, subprotocol)
+        return
+
+    def send_error(error_msg: str, room: Optional[str] = None):
+        connection.send({
+            "user": "System",
+            "message": encrypt_message(error_msg),
+            "encrypted": True,
+            "error": True
+        }, room=room)
+
+    try:
+        while True:
+            data = await receive_frame(websocket)
+            try:
+                message_data = connection.codec.decode(data)
+            except CodecError:
+                connection.touch()
+                send_error("Invalid message format. Please send JSON with 'room' and 'message' fields.")
+                continue
+            frame_type = message_data.get("type")
+            if frame_type == "pong":
+                connection.touch(activity=False)
+                continue
+            connection.touch()
+            room = message_data.get("room")
+            if not isinstance(room, str):
+                send_error("Every frame needs a 'room' field.")
+                continue
+
+            if frame_type == "subscribe":
+                if not await sessions.exists(room):
+                    send_error("Session not found.", room=room)
+                elif room not in connection.rooms and len(connection.rooms) >= WS_MAX_ROOMS_PER_SOCKET:
+                    send_error(f"Subscribed to the maximum of {WS_MAX_ROOMS_PER_SOCKET} sessions.", room=room)
+                else:
+                    try:
+                        await manager.join(connection, room, epoch=message_data.get("epoch"),
+                                           last_seq=parse_last_seq(message_data.get("last_seq")))
+                    except ConnectionRejected as e:
+                        connection.send({"type": "rejected", "limit": e.limit, "retry_after": e.retry_after},
+                                        room=room)
+                        continue
+                    await sessions.add_member(room, user_email)
+                    connection.send({"type": "subscribed", **resume_state(connection, room)}, room=room)
+                    join_events(connection, room, user_email)
+                    if not connection.resumed:
+                        asyncio.create_task(send_join_history(connection, room,
+                                                              join_history_count(message_data.get("history"))))
+            elif frame_type == "unsubscribe":
+                manager.leave(room, websocket)
+                connection.send({"type": "unsubscribed"}, room=room)
+            elif room not in connection.rooms:
+                send_error("Subscribe to the session before sending to it.", room=room)
+            elif frame_type in EVENT_TYPES:
+                room_events.submit(room, user_email, message_data)
+            else:
+                user = message_data.get("user", user_email)
+                message = message_data.get("message", "")
+                msg_id = message_data.get("msg_id")
+                if is_duplicate_message(room, user_email, msg_id):
+                    continue
+                await room_actors.submit(room, ChatSubmission(connection, user_email, room, user, message, msg_id))
+    except FrameTooLarge as e:
+        print(f"⚠️  Closing multiplexed connection for {user_email}: {e}")
+        connection.close(code=status.WS_1009_MESSAGE_TOO_BIG)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        manager.remove(connection)
+
+@app.get("/connections/stats", dependencies=[Depends(require_user)])
+async def connection_stats():
+    """Live connection counts against the admission limits; aggregates only, no rooms or users"""
+    return manager.stats()
+
+@app.get("/storage/stats", dependencies=[Depends(require_user)])
+async def storage_stats():
+    """Storage backend health: circuit breaker state, journaled writes awaiting replay, session cache"""
+    return {**storage.stats(), "sessions": sessions.stats()}
+
+@app.get("/metrics/mongo", dependencies=[Depends(require_user)])
+async def mongo_metrics():
+    """MongoDB commands by route and collection: counts, latency histograms, bytes, slow commands"""
+    return command_monitor.snapshot()
+
 # Security monitoring endpoints
 @app.get("/security/report/{session_id}")
 async def get_security_report(session_id: str, token: str = Query(...)):
@@ -1542,7 +1665,7 @@ async def get_security_report(session_id: str, token: str = Query(...)):
     if not user_email:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
     
-    if session_id not in SESSIONS:
+    if not await sessions.exists(session_id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
     
     return security_monitor.get_security_report(user_email, session_id)
@@ -1554,7 +1677,7 @@ async def clear_warnings(session_id: str, token: str = Query(...)):
     if not user_email:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
     
-    if session_id not in SESSIONS:
+    if not await sessions.exists(session_id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
     
     security_monitor.clear_warnings(user_email, session_id)
@@ -1627,54 +1750,26 @@ async def get_otp_rate_limit_status(email: str = Query(...), purpose: str = Quer
     """Get OTP rate limit status for an email"""
     email = email.lower().strip()
     
-    if mongodb_connected:
-        try:
-            otps_collection = get_otps_collection()
-            fifteen_min_ago = datetime.utcnow() - timedelta(minutes=15)
-            count = await otps_collection.count_documents({
-                "email": email,
-                "purpose": purpose,
-                "created_at": {"$gte": fifteen_min_ago}
-            })
-            remaining = max(0, 3 - count)
-            can_request = count < 3
-            
-            # Get time until next request allowed
-            if not can_request:
-                oldest_otp = await otps_collection.find_one(
-                    {"email": email, "purpose": purpose},
-                    sort=[("created_at", 1)]
-                )
-                if oldest_otp:
-                    next_allowed = oldest_otp["created_at"] + timedelta(minutes=15)
-                    wait_seconds = max(0, int((next_allowed - datetime.utcnow()).total_seconds()))
-                else:
-                    wait_seconds = 0
-            else:
-                wait_seconds = 0
-            
-            return {
-                "can_request": can_request,
-                "remaining_attempts": remaining,
-                "wait_seconds": wait_seconds,
-                "max_requests": 3,
-                "window_minutes": 15
-            }
-        except:
-            pass
-    
-    # In-memory check
-    fifteen_min_ago = datetime.utcnow() - timedelta(minutes=15)
-    key_prefix = f"{email}:{purpose}"
-    count = sum(1 for key, doc in in_memory_otps.items() 
-               if key.startswith(key_prefix) and doc["created_at"] >= fifteen_min_ago)
-    remaining = max(0, 3 - count)
-    can_request = count < 3
+    try:
+        fifteen_min_ago = datetime.utcnow() - timedelta(minutes=15)
+        # Count and oldest OTP come back from a single query
+        window = await storage.otp_window(email, purpose, fifteen_min_ago)
+        count = window["count"]
+        remaining = max(0, 3 - count)
+        can_request = count < 3
+        
+        # Get time until next request allowed
+        wait_seconds = 0
+        if not can_request and window["oldest"]:
+            next_allowed = window["oldest"] + timedelta(minutes=15)
+            wait_seconds = max(0, int((next_allowed - datetime.utcnow()).total_seconds()))
+    except:
+        remaining, can_request, wait_seconds = 3, True, 0
     
     return {
         "can_request": can_request,
         "remaining_attempts": remaining,
-        "wait_seconds": 0 if can_request else 900,  # 15 minutes
+        "wait_seconds": wait_seconds,
         "max_requests": 3,
         "window_minutes": 15
     }
@@ -1691,7 +1786,7 @@ async def security_status():
         "qr_token_security": {
             "encryption": "AES-256-CBC",
             "expiry": "1 minute",
-            "storage": "MongoDB with TTL" if mongodb_connected else "In-Memory",
+            "storage": "MongoDB with TTL" if storage.name == STORAGE_MONGO else STORAGE_NAMES[storage.name],
             "one_time_use": True,
             "no_raw_data": True
         },
@@ -0,0 +1,514 @@
+import os
+import base64
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterable, AsyncIterator, Dict, List, Optional, Tuple
+
+from bson import Binary, ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from server.circuit_breaker import CircuitBreaker, Unavailable, UNAVAILABLE_ERRORS
+from server.db import create_missing_indexes
+from server.indexes import INDEXES
+
+logger = logging.getLogger(__name__)
+
+# Write-behind persistence configuration from environment variables
+try:
+    MESSAGE_FLUSH_SIZE = max(1, int(os.getenv("MESSAGE_FLUSH_SIZE", "100")))
+    MESSAGE_FLUSH_INTERVAL_MS = max(1, int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "250")))
+    MESSAGE_BUFFER_MAX = max(1, int(os.getenv("MESSAGE_BUFFER_MAX", "10000")))
+    MESSAGE_BACKPRESSURE_TIMEOUT = max(0.0, float(os.getenv("MESSAGE_BACKPRESSURE_TIMEOUT", "2")))
+    MESSAGE_SHUTDOWN_TIMEOUT = max(0.0, float(os.getenv("MESSAGE_SHUTDOWN_TIMEOUT", "10")))
+except ValueError:
+    MESSAGE_FLUSH_SIZE, MESSAGE_FLUSH_INTERVAL_MS, MESSAGE_BUFFER_MAX = 100, 250, 10000
+    MESSAGE_BACKPRESSURE_TIMEOUT, MESSAGE_SHUTDOWN_TIMEOUT = 2.0, 10.0
+
+# How messages are laid out in MongoDB: one document each, or grouped into per-room buckets
+STORAGE_DOCUMENTS = "documents"
+STORAGE_BUCKETS = "buckets"
+MESSAGE_STORAGE = os.getenv("MESSAGE_STORAGE", STORAGE_DOCUMENTS).lower()
+try:
+    MESSAGE_BUCKET_SIZE = max(1, int(os.getenv("MESSAGE_BUCKET_SIZE", "200")))
+    MESSAGE_BUCKET_SPAN = max(1.0, float(os.getenv("MESSAGE_BUCKET_SPAN", "3600")))
+    MESSAGE_BUCKET_MAX_OPEN = max(1, int(os.getenv("MESSAGE_BUCKET_MAX_OPEN", "10000")))
+    MESSAGE_EXPORT_BATCH_SIZE = max(1, int(os.getenv("MESSAGE_EXPORT_BATCH_SIZE", "500")))
+except ValueError:
+    MESSAGE_BUCKET_SIZE, MESSAGE_BUCKET_SPAN, MESSAGE_BUCKET_MAX_OPEN = 200, 3600.0, 10000
+    MESSAGE_EXPORT_BATCH_SIZE = 500
+
+DUPLICATE_KEY = 11000
+EPOCH = datetime(1970, 1, 1)
+
+# Retry delays after a failed write, doubling up to the cap
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+
+
+def message_document(session_id: str, message: dict) -> dict:
+    """The stored form of a broadcast chat message; the ciphertext is kept as sent"""
+    timestamp = message.get("timestamp")
+    if isinstance(timestamp, str):
+        try:
+            timestamp = datetime.fromisoformat(timestamp)
+        except ValueError:
+            timestamp = None
+    document = {
+        "room": session_id,
+        "user": message.get("user"),
+        "message": message.get("message"),
+        "encrypted": bool(message.get("encrypted", False)),
+        "timestamp": timestamp or datetime.utcnow(),
+    }
+    if message.get("msg_id") is not None:
+        document["msg_id"] = message["msg_id"]
+    return document
+
+
+class MongoMessageStore:
+    """One document per message in the messages collection"""
+
+    collection_name = "messages"
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await create_missing_indexes(self.collection, INDEXES[self.collection_name])
+
+    async def write(self, documents: List[dict]):
+        # Unordered: one bad document doesn't hold back the rest of the batch
+        try:
+            await self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # insert_many sets each _id, so a retried batch only collides with what was already saved
+            if any(error.get("code") != DUPLICATE_KEY for error in e.details.get("writeErrors", ())) \
+                    or e.details.get("writeConcernErrors"):
+                raise
+
+    async def history(self, room: str, before: Optional[str] = None, limit: int = 50) -> AsyncIterator[dict]:
+        """Newest first, starting after the `before` cursor of an earlier page"""
+        query: Dict[str, Any] = {"room": room}
+        if before is not None:
+            millis, object_id = decode_cursor(before, 2, object_id=True)
+            timestamp = from_millis(int(millis))
+            query["$or"] = [{"timestamp": {"$lt": timestamp}}, {"timestamp": timestamp, "_id": {"$lt": object_id}}]
+        cursor = self.collection.find(query).sort([("timestamp", -1), ("_id", -1)]).limit(limit)
+        async for document in cursor:
+            yield history_message(document, encode_cursor(to_millis(document["timestamp"]), document["_id"]))
+
+    async def export(self, room: str, batch_size: int = MESSAGE_EXPORT_BATCH_SIZE) -> AsyncIterator[dict]:
+        """Every stored message of a room, oldest first, fetched `batch_size` at a time"""
+        cursor = self.collection.find({"room": room}).sort([("timestamp", 1), ("_id", 1)]).batch_size(batch_size)
+        async for document in cursor:
+            yield history_message(document, encode_cursor(to_millis(document["timestamp"]), document["_id"]))
+
+
+class BucketedMessageStore:
+    """
+    Up to `bucket_size` messages of one room per document, spanning at most
+    `bucket_span` seconds, with the ciphertext as BSON binary instead of
+    base64 text. Each bucket records the first and last timestamp it holds,
+    so a history read fetches buckets newest first and stops as soon as
+    it has a page.
+
+    The open bucket of each room is tracked in memory, which makes every
+    write batch one bulk_write however many rooms it touches. Each worker
+    fills its own buckets, so buckets of a room may overlap in time; reads
+    merge them.
+    """
+
+    collection_name = "message_buckets"
+
+    def __init__(self, collection, bucket_size: int = MESSAGE_BUCKET_SIZE, bucket_span: float = MESSAGE_BUCKET_SPAN,
+                 max_open_buckets: int = MESSAGE_BUCKET_MAX_OPEN):
+        self.collection = collection
+        self.bucket_size = bucket_size
+        self.bucket_span = timedelta(seconds=bucket_span)
+        self.max_open_buckets = max_open_buckets
+        # room -> [bucket _id, messages in it, first timestamp]; oldest rooms are forgotten first
+        self.open_buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    async def ensure_indexes(self):
+        await create_missing_indexes(self.collection, INDEXES[self.collection_name])
+
+    def plan(self, documents: List[dict]) -> List[Tuple[ObjectId, str, List[dict]]]:
+        """
+        Assign messages to buckets: (bucket _id, room, entries) per bucket touched.
+        The bucket and an _id are kept on each document, so a batch that is
+        retried goes to the same buckets without being counted twice.
+        """
+        chunks: "OrderedDict[ObjectId, Tuple[str, List[dict]]]" = OrderedDict()
+        for document in documents:
+            room = document["room"]
+            if "bucket_id" not in document:
+                timestamp = document["timestamp"]
+                bucket = self.open_buckets.get(room)
+                if bucket is None or bucket[1] >= self.bucket_size or timestamp - bucket[2] >= self.bucket_span:
+                    bucket = [ObjectId(), 0, timestamp]
+                    self.open_buckets[room] = bucket
+                    while len(self.open_buckets) > self.max_open_buckets:
+                        self.open_buckets.popitem(last=False)
+                else:
+                    self.open_buckets.move_to_end(room)
+                bucket[1] += 1
+                document["bucket_id"] = bucket[0]
+                document.setdefault("_id", ObjectId())
+            chunks.setdefault(document["bucket_id"], (room, []))[1].append(bucket_entry(document))
+        return [(bucket_id, room, entries) for bucket_id, (room, entries) in chunks.items()]
+
+    async def write(self, documents: List[dict]):
+        operations = [UpdateOne({"_id": bucket_id}, bucket_update(room, entries), upsert=True)
+                      for bucket_id, room, entries in self.plan(documents)]
+        if operations:
+            await self.collection.bulk_write(operations, ordered=False)
+
+    async def history(self, room: str, before: Optional[str] = None, limit: int = 50) -> AsyncIterator[dict]:
+        """Newest first, starting after the `before` cursor of an earlier page"""
+        query: Dict[str, Any] = {"room": room}
+        before_key = None
+        if before is not None:
+            millis, bucket_id, index = decode_cursor(before, 3)
+            before_key = (int(millis), bucket_id, int(index))
+            # Buckets that start after the cursor hold nothing older than it
+            query["start"] = {"$lte": from_millis(before_key[0])}
+        # A page rarely needs more than a bucket or two; don't let the driver fetch more
+        batch = max(2, limit // self.bucket_size + 2)
+        buckets = self.collection.find(query).sort("end", -1).batch_size(batch)
+        async for key, entry in merge_buckets(buckets, before_key, limit):
+            yield bucket_history_message(key, entry)
+
+    async def export(self, room: str, batch_size: int = MESSAGE_EXPORT_BATCH_SIZE) -> AsyncIterator[dict]:
+        """Every stored message of a room, oldest first, fetched about `batch_size` messages at a time"""
+        buckets = self.collection.find({"room": room}).sort("start", 1) \
+            .batch_size(max(1, batch_size // self.bucket_size))
+        async for key, entry in merge_buckets(buckets, oldest_first=True):
+            yield bucket_history_message(key, entry)
+
+
+def bucket_update(room: str, entries: List[dict]) -> list:
+    """
+    Update pipeline appending entries to a bucket, upserting it. Entries whose
+    _id the bucket already holds are skipped one by one, since a retried batch
+    can mix saved and unsaved messages of the same bucket.
+    """
+    # $literal: message fields are user input, and a string starting with $ would be read as a field path
+    unsaved = {"$filter": {"input": {"$literal": entries},
+                           "cond": {"$not": [{"$in": ["$$this._id", {"$ifNull": ["$messages._id", []]}]}]}}}
+    return [
+        {"$set": {"room": {"$literal": room},
+                  "messages": {"$concatArrays": [{"$ifNull": ["$messages", []]}, unsaved]}}},
+        {"$set": {"count": {"$size": "$messages"},
+                  "start": {"$min": "$messages.ts"},
+                  "end": {"$max": "$messages.ts"}}},
+    ]
+
+
+def bucket_history_message(key: tuple, entry: dict) -> dict:
+    return history_message({
+        "user": entry.get("u"),
+        "message": entry_ciphertext(entry),
+        "encrypted": entry.get("c", True),
+        "timestamp": entry["ts"],
+        "msg_id": entry.get("i"),
+    }, encode_cursor(*key))
+
+
+def bucket_entry(document: dict) -> dict:
+    """A message inside a bucket: short keys, ciphertext as raw bytes, constant fields implied"""
+    entry = {"_id": document["_id"], "u": document.get("user"), "ts": document["timestamp"]}
+    message = document.get("message")
+    if document.get("encrypted") and isinstance(message, str):
+        try:
+            message = Binary(base64.b64decode(message, validate=True))
+        except ValueError:
+            pass  # encrypt_message fell back to plain text
+    entry["m"] = message
+    if not document.get("encrypted"):
+        entry["c"] = False
+    if document.get("msg_id") is not None:
+        entry["i"] = document["msg_id"]
+    return entry
+
+
+def entry_ciphertext(entry: dict):
+    message = entry.get("m")
+    if isinstance(message, bytes):
+        return base64.b64encode(message).decode("ascii")
+    return message
+
+
+async def merge_buckets(buckets: AsyncIterable[dict], before_key: Optional[tuple] = None,
+                        limit: Optional[int] = None, oldest_first: bool = False) -> AsyncIterator[Tuple[tuple, dict]]:
+    """
+    Newest-first messages from buckets arriving in descending `end` order.
+    Once a bucket ending at T has been read, every message newer than T is
+    known, so those can be yielded before reading further. With oldest_first
+    the buckets arrive in ascending `start` order and the same holds in reverse.
+    Only buckets that overlap in time are ever held at once.
+    """
+    pending: List[Tuple[tuple, dict]] = []
+    emitted = 0
+    boundary_field = "start" if oldest_first else "end"
+
+    def ready(boundary: Optional[int]):
+        nonlocal pending
+        pending.sort(key=lambda item: item[0], reverse=not oldest_first)
+        if boundary is None:
+            cut = len(pending)
+        elif oldest_first:
+            cut = next((i for i, (key, _) in enumerate(pending) if key[0] >= boundary), len(pending))
+        else:
+            cut = next((i for i, (key, _) in enumerate(pending) if key[0] <= boundary), len(pending))
+        out, pending = pending[:cut], pending[cut:]
+        return out
+
+    async for bucket in buckets:
+        for item in ready(to_millis(bucket[boundary_field])):
+            yield item
+            emitted += 1
+            if limit is not None and emitted >= limit:
+                return
+        bucket_id = str(bucket["_id"])
+        for index, entry in enumerate(bucket.get("messages", ())):
+            key = (to_millis(entry["ts"]), bucket_id, index)
+            if before_key is None or key < before_key:
+                pending.append((key, entry))
+    for item in ready(None):
+        yield item
+        emitted += 1
+        if limit is not None and emitted >= limit:
+            return
+
+
+def history_message(document: dict, cursor: str) -> dict:
+    """A stored message in the shape clients get from the room, plus a cursor for the next page"""
+    timestamp = document.get("timestamp")
+    message = {
+        "user": document.get("user"),
+        "message": document.get("message"),
+        "encrypted": document.get("encrypted", True),
+        "timestamp": timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp,
+        "cursor": cursor,
+    }
+    if document.get("msg_id") is not None:
+        message["msg_id"] = document["msg_id"]
+    return message
+
+
+def to_millis(timestamp: datetime) -> int:
+    """BSON dates keep milliseconds; cursors use the same resolution"""
+    return (timestamp - EPOCH) // timedelta(milliseconds=1)
+
+
+def from_millis(millis: int) -> datetime:
+    return EPOCH + timedelta(milliseconds=millis)
+
+
+def encode_cursor(*parts) -> str:
+    return "-".join(str(part) for part in parts)
+
+
+def decode_cursor(cursor: str, count: int, object_id: bool = False) -> list:
+    """The parts of a cursor, with the last one as an ObjectId if object_id; ValueError if malformed"""
+    parts: list = cursor.split("-")
+    if len(parts) != count or not parts[0].isdigit():
+        raise ValueError(f"Invalid history cursor: {cursor!r}")
+    if object_id:
+        try:
+            parts[-1] = ObjectId(parts[-1])
+        except InvalidId:
+            raise ValueError(f"Invalid history cursor: {cursor!r}") from None
+    return parts
+
+
+class GuardedMessageStore:
+    """
+    A message store behind the circuit breaker the storage backend uses, so
+    chat history fails fast while MongoDB is down instead of waiting out the
+    driver's server selection timeout. Failures raise Unavailable: the
+    MessageWriter keeps the batch buffered, history reads come back empty or 503.
+    """
+
+    def __init__(self, store, breaker: CircuitBreaker):
+        self.store = store
+        self.breaker = breaker
+
+    async def ensure_indexes(self):
+        if self.breaker.is_open:
+            self.breaker.rejected += 1
+            raise Unavailable(f"{self.breaker.name} circuit is open")
+        # No call timeout: building an index on a large collection legitimately takes a while
+        try:
+            await self.store.ensure_indexes()
+        except UNAVAILABLE_ERRORS as e:
+            self.breaker.record_failure(e)
+            raise Unavailable(str(e) or type(e).__name__) from e
+
+    async def write(self, documents: List[dict]):
+        # Retrying a batch that timed out after all is safe: both stores skip what was already saved
+        await self.breaker.call(self.store.write, documents)
+
+    async def history(self, room: str, before: Optional[str] = None, limit: int = 50) -> AsyncIterator[dict]:
+        async for message in self._guarded(self.store.history(room, before=before, limit=limit)):
+            yield message
+
+    async def export(self, room: str, batch_size: int = MESSAGE_EXPORT_BATCH_SIZE) -> AsyncIterator[dict]:
+        async for message in self._guarded(self.store.export(room, batch_size=batch_size)):
+            yield message
+
+    async def _guarded(self, messages: AsyncIterator[dict]) -> AsyncIterator[dict]:
+        # Each fetch is a call: the first one selects a server, later ones may run a getMore
+        while True:
+            try:
+                message = await self.breaker.call(messages.__anext__)
+            except StopAsyncIteration:
+                return
+            yield message
+
+
+def create_message_store(database, storage: str = MESSAGE_STORAGE, breaker: Optional[CircuitBreaker] = None):
+    """The message store selected by MESSAGE_STORAGE, on its collection in `database`, behind `breaker` if given"""
+    store_class = BucketedMessageStore if storage == STORAGE_BUCKETS else MongoMessageStore
+    store = store_class(database[store_class.collection_name])
+    return GuardedMessageStore(store, breaker) if breaker is not None else store
+
+
+async def ensure_indexes_when_available(store, delay: float = RETRY_BASE_DELAY):
+    """
+    Keep trying to create a store's indexes, e.g. after starting while MongoDB
+    was down. History is readable without them, only slower.
+    """
+    while True:
+        try:
+            await store.ensure_indexes()
+            return
+        except Exception as e:
+            logger.warning(f"Creating message indexes failed, retrying in {delay:g}s: {e}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, RETRY_MAX_DELAY)
+
+
+class MessageWriter:
+    """
+    Write-behind buffer in front of a message store. Messages are buffered in memory
+    and written in batches of up to `batch_size`, or whatever has gathered
+    after `interval_ms`, so chat delivery never waits on a database round trip.
+
+    The buffer is bounded. When it is full, append() waits up to
+    `backpressure_timeout` for the writer to catch up, which slows senders
+    while the database is merely slow. If the database is down, the oldest
+    buffered messages are dropped (and counted) instead of blocking chat.
+    """
+
+    def __init__(self, store, batch_size: int = MESSAGE_FLUSH_SIZE, interval_ms: int = MESSAGE_FLUSH_INTERVAL_MS,
+                 max_buffer: int = MESSAGE_BUFFER_MAX, backpressure_timeout: float = MESSAGE_BACKPRESSURE_TIMEOUT):
+        self.store = store
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000
+        self.max_buffer = max(max_buffer, batch_size)
+        self.backpressure_timeout = backpressure_timeout
+        self.buffer: List[dict] = []
+        self.written = 0
+        self.dropped = 0
+        self.failed_batches = 0
+        self.stalls = 0
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._space: Optional[asyncio.Event] = None
+
+    def start(self):
+        self._pending = asyncio.Event()
+        self._full = asyncio.Event()
+        self._space = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def append(self, document: dict):
+        """Buffer a document for the next batch; waits briefly when the buffer is full"""
+        if len(self.buffer) >= self.max_buffer:
+            self.stalls += 1
+            self._space.clear()
+            try:
+                await asyncio.wait_for(self._space.wait(), self.backpressure_timeout)
+            except asyncio.TimeoutError:
+                pass
+            if len(self.buffer) >= self.max_buffer:
+                self._drop_oldest(len(self.buffer) - self.max_buffer + 1)
+        self.buffer.append(document)
+        self._pending.set()
+        if len(self.buffer) >= self.batch_size:
+            self._full.set()
+
+    def _drop_oldest(self, count: int):
+        del self.buffer[:count]
+        self.dropped += count
+        logger.warning(f"Message buffer full; dropped {count} unsaved messages ({self.dropped} so far)")
+
+    async def flush(self):
+        """Write out everything buffered so far; a failed batch goes back to the front of the buffer"""
+        while self.buffer:
+            batch = self.buffer[:self.batch_size]
+            del self.buffer[:self.batch_size]
+            if self._space is not None:
+                self._space.set()
+            try:
+                await self.store.write(batch)
+            except BaseException:
+                # Also on cancellation, so the shutdown flush tries the batch again. The buffer
+                # may run over by one batch; append() trims it if the writer stays stuck.
+                self.failed_batches += 1
+                self.buffer[:0] = batch
+                raise
+            self.written += len(batch)
+
+    async def _run(self):
+        delay = RETRY_BASE_DELAY
+        while True:
+            await self._pending.wait()
+            # A full batch goes out at once; otherwise give the interval a chance to fill it
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            self._pending.clear()
+            try:
+                await self.flush()
+                delay = RETRY_BASE_DELAY
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Saving messages failed, retrying in {delay:g}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX_DELAY)
+                self._pending.set()
+
+    async def stop(self, timeout: float = MESSAGE_SHUTDOWN_TIMEOUT):
+        """Stop the background writer and make a last attempt to save what is buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        if not self.buffer:
+            return
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except Exception as e:
+            logger.warning(f"{len(self.buffer)} messages were not saved at shutdown: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self.buffer),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed_batches": self.failed_batches,
+            "stalls": self.stalls,
+        }
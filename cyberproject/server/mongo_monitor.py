@@ -0,0 +1,188 @@
+import os
+import logging
+import threading
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+import bson
+from pymongo import monitoring
+from starlette.routing import Match
+
+logger = logging.getLogger(__name__)
+
+# Command monitoring configuration from environment variables
+MONGO_COMMAND_MONITORING = os.getenv("MONGO_COMMAND_MONITORING", "true").lower() != "false"
+try:
+    # Commands slower than this are logged with their route; 0 turns the log off
+    MONGO_SLOW_COMMAND_MS = max(0.0, float(os.getenv("MONGO_SLOW_COMMAND_MS", "100")))
+except ValueError:
+    MONGO_SLOW_COMMAND_MS = 100.0
+
+# Upper bounds (ms) of the latency histogram buckets; slower commands land in "+Inf"
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Route of the request / WebSocket handler running in this context. Motor copies the
+# context into its executor threads, so the listener sees the route that issued a command.
+current_route: ContextVar[str] = ContextVar("mongo_route", default="background")
+
+
+class CommandStats:
+    __slots__ = ("count", "failures", "total_ms", "max_ms", "buckets", "request_bytes", "reply_bytes")
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.request_bytes = 0
+        self.reply_bytes = 0
+
+    def record(self, ms: float, request_bytes: int, reply_bytes: int, failed: bool):
+        self.count += 1
+        self.failures += failed
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.request_bytes += request_bytes
+        self.reply_bytes += reply_bytes
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "failures": self.failures,
+            "total_ms": round(self.total_ms, 3),
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0,
+            "max_ms": round(self.max_ms, 3),
+            "histogram_ms": dict(zip([str(bound) for bound in LATENCY_BUCKETS_MS] + ["+Inf"], self.buckets)),
+            "request_bytes": self.request_bytes,
+            "reply_bytes": self.reply_bytes,
+        }
+
+
+def _bson_size(document) -> int:
+    try:
+        return len(bson.encode(document))
+    except Exception:
+        return 0
+
+
+def _collection(command: dict, command_name: str) -> str:
+    # find / insert / update / delete / aggregate / findAndModify name the collection in their
+    # first field; getMore names it under "collection"; database commands (ping, ...) have none
+    target = command.get("collection") if command_name == "getMore" else command.get(command_name)
+    return target if isinstance(target, str) else "-"
+
+
+class CommandMonitor(monitoring.CommandListener):
+    """
+    pymongo command listener: counts, latency histograms and bytes of every
+    command, by the route that issued it (current_route), collection and
+    command name. Handlers and the driver's threads both report here, hence
+    the lock.
+    """
+
+    def __init__(self, slow_ms: float = MONGO_SLOW_COMMAND_MS):
+        self.slow_ms = slow_ms
+        self.stats: Dict[Tuple[str, str, str], CommandStats] = {}
+        self.requests: Dict[str, int] = {}
+        self.slow = 0
+        # (connection, request id) -> (route, collection, request bytes) until the reply arrives
+        self._pending: Dict[tuple, Tuple[str, str, int]] = {}
+        self._lock = threading.Lock()
+
+    def count_request(self, route: str):
+        with self._lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        pending = (current_route.get(), _collection(event.command, event.command_name), _bson_size(event.command))
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = pending
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._finish(event, _bson_size(event.reply), failed=False)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._finish(event, 0, failed=True)
+
+    def _finish(self, event, reply_bytes: int, failed: bool):
+        ms = event.duration_micros / 1000
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+            if pending is None:
+                return
+            route, collection, request_bytes = pending
+            key = (route, collection, event.command_name)
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = CommandStats()
+            stats.record(ms, request_bytes, reply_bytes, failed)
+            slow = self.slow_ms and ms >= self.slow_ms
+            if slow:
+                self.slow += 1
+        if slow:
+            logger.warning(f"Slow MongoDB {event.command_name} on {collection}: {ms:.1f} ms ({route})")
+
+    def snapshot(self) -> dict:
+        """Per-route totals (with commands per request, to spot N+1 loops) and per-command detail"""
+        with self._lock:
+            stats = {key: value.to_dict() for key, value in self.stats.items()}
+            requests = dict(self.requests)
+            slow = self.slow
+        routes: Dict[str, dict] = {}
+        for (route, collection, command_name), entry in sorted(stats.items(), key=lambda item: -item[1]["total_ms"]):
+            totals = routes.setdefault(route, {"requests": requests.get(route, 0), "commands": 0,
+                                               "total_ms": 0.0, "by_command": {}})
+            totals["commands"] += entry["count"]
+            totals["total_ms"] = round(totals["total_ms"] + entry["total_ms"], 3)
+            totals["by_command"][f"{collection}.{command_name}"] = entry
+        for totals in routes.values():
+            totals["commands_per_request"] = (round(totals["commands"] / totals["requests"], 2)
+                                              if totals["requests"] else None)
+        return {"slow_command_ms": self.slow_ms, "slow_commands": slow, "routes": routes}
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+            self.requests.clear()
+            self.slow = 0
+
+
+def route_label(router, scope) -> str:
+    """"GET /qr_from_session/{session_id}" / "WS /ws/{session_id}": the route template, not the raw path"""
+    prefix = "WS" if scope["type"] == "websocket" else scope.get("method", "")
+    for route in router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return f"{prefix} {route.path}"
+    return f"{prefix} unmatched"
+
+
+class CommandRouteMiddleware:
+    """ASGI middleware tagging each HTTP request and WebSocket with its route for the monitor"""
+
+    def __init__(self, app, router, monitor: Optional[CommandMonitor] = None):
+        self.app = app
+        self.router = router
+        self.monitor = monitor or command_monitor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        route = route_label(self.router, scope)
+        self.monitor.count_request(route)
+        token = current_route.set(route)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_route.reset(token)
+
+
+# The one monitor for the process; server.db registers it on the shared client
+command_monitor = CommandMonitor()
@@ -0,0 +1,312 @@
+import os
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Union
+from urllib.parse import urlparse
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+# Pub/sub configuration from environment variables
+PUBSUB_BACKEND = os.getenv("PUBSUB_BACKEND", "memory").lower()
+PUBSUB_URL = os.getenv("PUBSUB_URL", "redis://localhost:6379/0")
+PUBSUB_CHANNEL_PREFIX = os.getenv("PUBSUB_CHANNEL_PREFIX", "chat:room:")
+try:
+    PUBSUB_PUBLISH_QUEUE_SIZE = max(1, int(os.getenv("PUBSUB_PUBLISH_QUEUE_SIZE", "10000")))
+except ValueError:
+    PUBSUB_PUBLISH_QUEUE_SIZE = 10000
+
+Frame = Union[str, bytes]
+# Called with (room, frame) for every message published by another worker
+FrameHandler = Callable[[str, Frame], Optional[Awaitable[None]]]
+
+# Envelope: 32 hex chars of origin id, one kind byte, then the frame payload
+_TEXT = b"t"
+_BINARY = b"b"
+
+
+def _pack(origin: bytes, frame: Frame) -> bytes:
+    if isinstance(frame, bytes):
+        return origin + _BINARY + frame
+    return origin + _TEXT + frame.encode("utf-8")
+
+
+def _unpack(payload: bytes):
+    origin, kind, body = payload[:32], payload[32:33], payload[33:]
+    return origin, (body if kind == _BINARY else body.decode("utf-8"))
+
+
+class PubSubBackend(ABC):
+    """
+    Carries room frames between workers. Each worker delivers to its own
+    sockets first and publishes once; backends hand frames from other
+    workers to the handler given to start().
+    """
+
+    def __init__(self):
+        self.origin = uuid4().hex.encode()
+        self.handler: Optional[FrameHandler] = None
+
+    async def start(self, handler: FrameHandler):
+        self.handler = handler
+
+    @abstractmethod
+    async def publish(self, room: str, frame: Frame):
+        ...
+
+    @abstractmethod
+    async def subscribe(self, room: str):
+        ...
+
+    @abstractmethod
+    async def unsubscribe(self, room: str):
+        ...
+
+    async def close(self):
+        pass
+
+    async def _deliver(self, room: str, frame: Frame):
+        if self.handler is None:
+            return
+        try:
+            result = self.handler(room, frame)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            logger.warning(f"Pub/sub delivery failed for room {room}: {e}")
+
+
+class InProcessHub:
+    """Routes frames between in-process backends (one per simulated worker)"""
+
+    def __init__(self):
+        self.subscribers: Dict[str, Set["InProcessPubSub"]] = {}
+
+
+class InProcessPubSub(PubSubBackend):
+    """Default backend for a single worker; sharing a hub lets several managers talk in tests"""
+
+    def __init__(self, hub: Optional[InProcessHub] = None):
+        super().__init__()
+        self.hub = hub or InProcessHub()
+
+    async def publish(self, room: str, frame: Frame):
+        for backend in list(self.hub.subscribers.get(room, ())):
+            if backend is not self:
+                await backend._deliver(room, frame)
+
+    async def subscribe(self, room: str):
+        self.hub.subscribers.setdefault(room, set()).add(self)
+
+    async def unsubscribe(self, room: str):
+        subscribers = self.hub.subscribers.get(room)
+        if subscribers is None:
+            return
+        subscribers.discard(self)
+        if not subscribers:
+            del self.hub.subscribers[room]
+
+    async def close(self):
+        for room in [r for r, subs in self.hub.subscribers.items() if self in subs]:
+            await self.unsubscribe(room)
+
+
+class RedisProtocolError(Exception):
+    pass
+
+
+def _encode_command(*args: Union[str, bytes]) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Pub/sub server closed the connection")
+    prefix, rest = line[:1], line[1:-2]
+    if prefix == b"+":
+        return rest.decode()
+    if prefix == b"-":
+        raise RedisProtocolError(rest.decode())
+    if prefix == b":":
+        return int(rest)
+    if prefix == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if prefix == b"*":
+        count = int(rest)
+        if count < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(count)]
+    raise RedisProtocolError(f"Unexpected reply: {line!r}")
+
+
+class RedisPubSub(PubSubBackend):
+    """
+    Speaks the Redis protocol directly over asyncio streams, so it works with
+    Redis, Valkey, KeyDB or any RESP-compatible stand-in without a client library.
+    One connection pipelines PUBLISH commands; another holds the subscriptions.
+    """
+
+    def __init__(self, url: str = PUBSUB_URL, prefix: str = PUBSUB_CHANNEL_PREFIX,
+                 queue_size: int = PUBSUB_PUBLISH_QUEUE_SIZE, reconnect_delay: float = 1.0):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.prefix = prefix
+        self.reconnect_delay = reconnect_delay
+        self.rooms: Set[str] = set()
+        self.publish_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self._sub_writer: Optional[asyncio.StreamWriter] = None
+        self._tasks: List[asyncio.Task] = []
+        self._subscribed = asyncio.Event()
+
+    def _channel(self, room: str) -> str:
+        return f"{self.prefix}{room}"
+
+    async def _open(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(_encode_command("AUTH", self.password))
+            await writer.drain()
+            await _read_reply(reader)
+        return reader, writer
+
+    async def start(self, handler: FrameHandler):
+        await super().start(handler)
+        self._tasks = [
+            asyncio.create_task(self._publisher()),
+            asyncio.create_task(self._subscriber()),
+        ]
+
+    async def publish(self, room: str, frame: Frame):
+        try:
+            self.publish_queue.put_nowait((self._channel(room), _pack(self.origin, frame)))
+        except asyncio.QueueFull:
+            # Local delivery already happened; don't stall the room on a slow broker
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Pub/sub publish queue full, dropped {self.dropped} frames so far")
+
+    async def subscribe(self, room: str):
+        if room in self.rooms:
+            return
+        self.rooms.add(room)
+        await self._send_subscription("SUBSCRIBE", room)
+
+    async def unsubscribe(self, room: str):
+        if room not in self.rooms:
+            return
+        self.rooms.discard(room)
+        await self._send_subscription("UNSUBSCRIBE", room)
+
+    async def _send_subscription(self, command: str, room: str):
+        writer = self._sub_writer
+        if writer is None:
+            # The subscriber re-sends every room in self.rooms once it (re)connects
+            return
+        try:
+            writer.write(_encode_command(command, self._channel(room)))
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f"Pub/sub {command.lower()} failed for room {room}: {e}")
+
+    async def wait_ready(self, timeout: float = 5.0):
+        """Wait until the subscriber connection is up (useful in tests and health checks)"""
+        await asyncio.wait_for(self._subscribed.wait(), timeout)
+
+    async def _publisher(self):
+        while True:
+            try:
+                reader, writer = await self._open()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Pub/sub publisher cannot connect to {self.host}:{self.port}: {e}")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            try:
+                while True:
+                    # Pipeline everything that is waiting, then read the replies in order
+                    batch = [await self.publish_queue.get()]
+                    while not self.publish_queue.empty() and len(batch) < 512:
+                        batch.append(self.publish_queue.get_nowait())
+                    writer.write(b"".join(_encode_command("PUBLISH", ch, payload) for ch, payload in batch))
+                    await writer.drain()
+                    for _ in batch:
+                        await _read_reply(reader)
+            except asyncio.CancelledError:
+                writer.close()
+                raise
+            except Exception as e:
+                logger.warning(f"Pub/sub publisher connection lost: {e}")
+                writer.close()
+                await asyncio.sleep(self.reconnect_delay)
+
+    async def _subscriber(self):
+        while True:
+            try:
+                reader, writer = await self._open()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Pub/sub subscriber cannot connect to {self.host}:{self.port}: {e}")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            try:
+                # Publish the writer first so rooms joined while we subscribe are not lost
+                self._sub_writer = writer
+                if self.rooms:
+                    writer.write(_encode_command("SUBSCRIBE", *[self._channel(r) for r in self.rooms]))
+                    await writer.drain()
+                self._subscribed.set()
+                while True:
+                    reply = await _read_reply(reader)
+                    if not isinstance(reply, list) or len(reply) < 3 or reply[0] != b"message":
+                        continue  # subscribe/unsubscribe confirmations
+                    channel = reply[1].decode("utf-8")
+                    origin, frame = _unpack(reply[2])
+                    if origin == self.origin:
+                        continue  # Already delivered locally
+                    await self._deliver(channel[len(self.prefix):], frame)
+            except asyncio.CancelledError:
+                writer.close()
+                raise
+            except Exception as e:
+                logger.warning(f"Pub/sub subscriber connection lost: {e}")
+                writer.close()
+                await asyncio.sleep(self.reconnect_delay)
+            finally:
+                self._sub_writer = None
+                self._subscribed.clear()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._tasks = []
+
+
+def create_pubsub_backend(backend: str = PUBSUB_BACKEND, url: str = PUBSUB_URL) -> PubSubBackend:
+    """Build the pub/sub backend selected by PUBSUB_BACKEND (memory or redis)"""
+    if backend == "redis":
+        return RedisPubSub(url)
+    if backend != "memory":
+        logger.warning(f"Unknown PUBSUB_BACKEND '{backend}', using in-process pub/sub")
+    return InProcessPubSub()
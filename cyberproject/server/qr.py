@@ -5,11 +5,14 @@ import secrets
 import string
 from datetime import datetime
 
-# DB collection
+# DB collection, on the shared client
 try:
-    from server.db import qrcodes as qrcodes_collection
+    from server.db import get_database
 except ImportError:
-    from db import qrcodes as qrcodes_collection
+    from db import get_database
+
+def qrcodes_collection():
+    return get_database()["qrcodes"]
 
 # Router
 router = APIRouter()
@@ -41,7 +44,7 @@ async def create_qr_code():
     # Generate unique token
     while True:
         token = generate_token()
-        existing = await qrcodes_collection.find_one({"token": token})
+        existing = await qrcodes_collection().find_one({"token": token})
         if not existing:
             break
     
@@ -53,7 +56,7 @@ async def create_qr_code():
     }
     
     # Store in DB
-    await qrcodes_collection.insert_one(doc)
+    await qrcodes_collection().insert_one(doc)
     
     return {"token": token, "status": "waiting"}
 
@@ -62,7 +65,7 @@ async def get_qr_status(token: str):
     """
     Get the status of a QR code by token.
     """
-    qr = await qrcodes_collection.find_one({"token": token})
+    qr = await qrcodes_collection().find_one({"token": token})
     if not qr:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -76,14 +79,14 @@ async def join_qr_session(token: str):
     """
     Join a QR code session by setting status to 'joined'.
     """
-    qr = await qrcodes_collection.find_one({"token": token})
+    qr = await qrcodes_collection().find_one({"token": token})
     if not qr:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="QR code not found"
         )
     
-    await qrcodes_collection.update_one({"token": token}, {"$set": {"status": "joined", "joined_at": datetime.utcnow()}})
+    await qrcodes_collection().update_one({"token": token}, {"$set": {"status": "joined", "joined_at": datetime.utcnow()}})
     
     return {"token": token, "status": "joined"}
 
@@ -0,0 +1,135 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Room actor configuration from environment variables
+try:
+    ROOM_ACTOR_CONCURRENCY = max(1, int(os.getenv("ROOM_ACTOR_CONCURRENCY", "4")))
+    ROOM_ACTOR_INBOX_SIZE = max(1, int(os.getenv("ROOM_ACTOR_INBOX_SIZE", "1024")))
+    ROOM_ACTOR_IDLE_TIMEOUT = max(0.1, float(os.getenv("ROOM_ACTOR_IDLE_TIMEOUT", "60")))
+except ValueError:
+    ROOM_ACTOR_CONCURRENCY, ROOM_ACTOR_INBOX_SIZE, ROOM_ACTOR_IDLE_TIMEOUT = 4, 1024, 60.0
+
+# process(seq, item) runs concurrently; deliver(seq, item, result) runs one at a time in seq order
+Process = Callable[[int, Any], Awaitable[Any]]
+Deliver = Callable[[int, Any, Any], Awaitable[None]]
+
+
+class RoomActor:
+    """
+    Owns the message flow of one room. Submissions are stamped with a room-wide
+    sequence number as they leave the inbox; up to `concurrency` of them are
+    processed at once, and results are delivered strictly in sequence order.
+    """
+
+    def __init__(self, room: str, process: Process, deliver: Deliver,
+                 concurrency: int = ROOM_ACTOR_CONCURRENCY, inbox_size: int = ROOM_ACTOR_INBOX_SIZE,
+                 idle_timeout: float = ROOM_ACTOR_IDLE_TIMEOUT,
+                 on_idle: Optional[Callable[["RoomActor"], None]] = None):
+        self.room = room
+        self.process = process
+        self.deliver = deliver
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle
+        self.inbox: asyncio.Queue = asyncio.Queue(maxsize=inbox_size)
+        self.next_seq = 0
+        self.delivered = 0
+        self.closed = False
+        # Ordered hand-off from the dispatcher to the deliverer; bounded by the slots
+        self._in_flight: asyncio.Queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._dispatch()), asyncio.create_task(self._deliver())]
+
+    async def submit(self, item: Any):
+        """Queue an item; waits when the inbox is full so fast senders are slowed down"""
+        await self.inbox.put(item)
+
+    def idle(self) -> bool:
+        return self.inbox.empty() and self.next_seq == self.delivered
+
+    async def _dispatch(self):
+        while True:
+            try:
+                item = await asyncio.wait_for(self.inbox.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                if self.idle():
+                    # Nothing can be added between this check and closing; no await in between
+                    self.closed = True
+                    self._in_flight.put_nowait(None)
+                    if self.on_idle is not None:
+                        self.on_idle(self)
+                    return
+                continue
+            await self._slots.acquire()
+            seq = self.next_seq
+            self.next_seq += 1
+            task = asyncio.create_task(self.process(seq, item))
+            self._in_flight.put_nowait((seq, item, task))
+
+    async def _deliver(self):
+        while True:
+            entry = await self._in_flight.get()
+            if entry is None:
+                return
+            seq, item, task = entry
+            try:
+                result = await task
+                await self.deliver(seq, item, result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Room {self.room} dropped message {seq}: {e}")
+            finally:
+                self.delivered = seq + 1
+                self._slots.release()
+
+    async def stop(self):
+        self.closed = True
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        # Processing tasks that were still running
+        while not self._in_flight.empty():
+            entry = self._in_flight.get_nowait()
+            if entry is not None:
+                entry[2].cancel()
+
+
+class RoomActorRegistry:
+    """Creates room actors on first use and forgets them once they go idle"""
+
+    def __init__(self, process: Process, deliver: Deliver, **options):
+        self.process = process
+        self.deliver = deliver
+        self.options = options
+        self.actors: Dict[str, RoomActor] = {}
+
+    def get(self, room: str) -> RoomActor:
+        actor = self.actors.get(room)
+        if actor is None or actor.closed:
+            actor = RoomActor(room, self.process, self.deliver, on_idle=self._forget, **self.options)
+            self.actors[room] = actor
+            actor.start()
+        return actor
+
+    async def submit(self, room: str, item: Any):
+        await self.get(room).submit(item)
+
+    def _forget(self, actor: RoomActor):
+        if self.actors.get(actor.room) is actor:
+            del self.actors[actor.room]
+
+    async def stop(self):
+        actors, self.actors = list(self.actors.values()), {}
+        for actor in actors:
+            await actor.stop()
@@ -0,0 +1,198 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Ephemeral event channel configuration from environment variables
+try:
+    ROOM_EVENTS_TICK_MS = max(10, int(os.getenv("ROOM_EVENTS_TICK_MS", "100")))
+    ROOM_EVENTS_TYPING_TTL = max(1.0, float(os.getenv("ROOM_EVENTS_TYPING_TTL", "6")))
+except ValueError:
+    ROOM_EVENTS_TICK_MS, ROOM_EVENTS_TYPING_TTL = 100, 6.0
+
+# Inbound frame types handled here instead of as chat messages
+EVENT_PRESENCE = "presence"
+EVENT_TYPING = "typing"
+EVENT_READ = "read"
+EVENT_TYPES = (EVENT_PRESENCE, EVENT_TYPING, EVENT_READ)
+PRESENCE_STATES = ("online", "away", "offline")
+
+# publish(session_id, message) fans a frame out to the room without numbering it
+Publish = Callable[[str, dict], Awaitable[None]]
+
+
+class RoomState:
+    """Latest presence, typing and read marks of one room, plus what changed since the last tick"""
+
+    def __init__(self):
+        self.presence: Dict[str, str] = {}
+        self.typing: Dict[str, float] = {}  # user -> loop time the indicator expires
+        self.read: Dict[str, int] = {}
+        self.changed: Dict[str, Dict[str, Any]] = {}
+
+    def mark(self, kind: str, user: str, value: Any):
+        self.changed.setdefault(kind, {})[user] = value
+
+
+class RoomEvents:
+    """
+    Presence, typing indicators and read receipts. They skip security analysis
+    and encryption, and are coalesced: each room gets at most one
+    {"type": "events", ...} frame per tick, carrying only the latest value per
+    user. Read receipts are high-water marks, so only a higher seq is news.
+    Nothing here is numbered or kept for replay.
+    """
+
+    def __init__(self, publish: Publish, tick_ms: int = ROOM_EVENTS_TICK_MS,
+                 typing_ttl: float = ROOM_EVENTS_TYPING_TTL):
+        self.publish = publish
+        self.tick = tick_ms / 1000
+        self.typing_ttl = typing_ttl
+        self.rooms: Dict[str, RoomState] = {}
+        self.frames_sent = 0
+        self.events_received = 0
+        self._dirty: set = set()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+    def _changed(self, session_id: str):
+        self._dirty.add(session_id)
+        if self._wake is not None:
+            self._wake.set()
+
+    def submit(self, session_id: str, user: str, event: dict) -> bool:
+        """Record a client event; returns False for malformed ones, which are ignored"""
+        self.events_received += 1
+        kind = event.get("type")
+        if kind == EVENT_PRESENCE:
+            state = event.get("state")
+            if state not in PRESENCE_STATES:
+                return False
+            self.set_presence(session_id, user, state)
+        elif kind == EVENT_TYPING:
+            self.set_typing(session_id, user, bool(event.get("typing")))
+        elif kind == EVENT_READ:
+            seq = event.get("seq")
+            if not isinstance(seq, int) or isinstance(seq, bool) or seq < 0:
+                return False
+            self.set_read(session_id, user, seq)
+        else:
+            return False
+        return True
+
+    def set_presence(self, session_id: str, user: str, state: str):
+        room = self.rooms.setdefault(session_id, RoomState())
+        if room.presence.get(user) == state:
+            return
+        if state == "offline":
+            room.presence.pop(user, None)
+        else:
+            room.presence[user] = state
+        room.mark(EVENT_PRESENCE, user, state)
+        self._changed(session_id)
+
+    def set_typing(self, session_id: str, user: str, typing: bool):
+        room = self.rooms.setdefault(session_id, RoomState())
+        was_typing = user in room.typing
+        if typing:
+            # Keystrokes only push the expiry out; the room hears about it once
+            room.typing[user] = asyncio.get_running_loop().time() + self.typing_ttl
+        else:
+            room.typing.pop(user, None)
+        if typing != was_typing:
+            room.mark(EVENT_TYPING, user, typing)
+            self._changed(session_id)
+
+    def set_read(self, session_id: str, user: str, seq: int):
+        room = self.rooms.setdefault(session_id, RoomState())
+        if seq <= room.read.get(user, -1):
+            return
+        room.read[user] = seq
+        room.mark(EVENT_READ, user, seq)
+        self._changed(session_id)
+
+    def user_left(self, user: str, session_id: str):
+        """The user's last connection left the room: announce it offline and forget its state"""
+        room = self.rooms.get(session_id)
+        if room is None:
+            return
+        if user in room.typing:
+            del room.typing[user]
+            room.mark(EVENT_TYPING, user, False)
+        room.read.pop(user, None)
+        if user in room.presence:
+            del room.presence[user]
+            room.mark(EVENT_PRESENCE, user, "offline")
+        if room.changed:
+            self._changed(session_id)
+        elif not (room.presence or room.typing or room.read):
+            del self.rooms[session_id]
+
+    def snapshot(self, session_id: str) -> Optional[dict]:
+        """Current state of a room for a client that just joined; None if there is nothing to show"""
+        room = self.rooms.get(session_id)
+        if room is None or not (room.presence or room.typing or room.read):
+            return None
+        snapshot = {"type": "events"}
+        for kind, values in ((EVENT_PRESENCE, room.presence),
+                             (EVENT_TYPING, {user: True for user in room.typing}),
+                             (EVENT_READ, room.read)):
+            if values:
+                snapshot[kind] = dict(values)
+        return snapshot
+
+    def _expire_typing(self, now: float):
+        for session_id in [s for s, room in self.rooms.items() if room.typing]:
+            room = self.rooms[session_id]
+            for user in [u for u, expires in room.typing.items() if expires <= now]:
+                del room.typing[user]
+                room.mark(EVENT_TYPING, user, False)
+                self._changed(session_id)
+
+    async def flush(self):
+        """Publish one frame per room with pending changes"""
+        self._expire_typing(asyncio.get_running_loop().time())
+        dirty, self._dirty = self._dirty, set()
+        for session_id in dirty:
+            room = self.rooms.get(session_id)
+            if room is None or not room.changed:
+                continue
+            frame = {"type": "events", **room.changed}
+            room.changed = {}
+            if not (room.presence or room.typing or room.read):
+                del self.rooms[session_id]
+            try:
+                await self.publish(session_id, frame)
+                self.frames_sent += 1
+            except Exception as e:
+                logger.warning(f"Publishing events for session {session_id} failed: {e}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Sleep until something changes, or until the next typing indicator runs out
+            typing = [expires for room in self.rooms.values() for expires in room.typing.values()]
+            timeout = max(0.0, min(typing) - loop.time()) if typing else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            # Let the tick's worth of updates pile up, then send them together
+            await asyncio.sleep(self.tick)
+            await self.flush()
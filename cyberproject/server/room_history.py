@@ -0,0 +1,85 @@
+import os
+from collections import OrderedDict, deque
+from typing import Hashable, List, Optional
+from uuid import uuid4
+
+# Resumption buffers from environment variables
+try:
+    ROOM_HISTORY_SIZE = max(1, int(os.getenv("ROOM_HISTORY_SIZE", "256")))
+    ROOM_HISTORY_MAX_ROOMS = max(1, int(os.getenv("ROOM_HISTORY_MAX_ROOMS", "1000")))
+    MESSAGE_ID_CACHE_SIZE = max(1, int(os.getenv("MESSAGE_ID_CACHE_SIZE", "10000")))
+except ValueError:
+    ROOM_HISTORY_SIZE, ROOM_HISTORY_MAX_ROOMS, MESSAGE_ID_CACHE_SIZE = 256, 1000, 10000
+
+
+class LRUSet:
+    """A set that forgets its least recently added keys beyond a fixed capacity"""
+
+    def __init__(self, capacity: int = MESSAGE_ID_CACHE_SIZE):
+        self.capacity = capacity
+        self._keys: "OrderedDict[Hashable, None]" = OrderedDict()
+
+    def add(self, key: Hashable) -> bool:
+        """Remember a key; returns False if it was already there"""
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return False
+        self._keys[key] = None
+        if len(self._keys) > self.capacity:
+            self._keys.popitem(last=False)
+        return True
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+class RoomBuffer:
+    """Recent broadcasts of one room. The epoch changes whenever numbering restarts."""
+
+    def __init__(self, size: int):
+        self.epoch = uuid4().hex[:12]
+        self.seq = 0
+        self.messages: deque = deque(maxlen=size)
+
+
+class RoomHistory:
+    """
+    Bounded ring buffers of recent broadcasts, one per room, numbered by a
+    per-room sequence. A reconnecting client presents the epoch and the last
+    sequence number it saw and gets only the messages it missed.
+    """
+
+    def __init__(self, size: int = ROOM_HISTORY_SIZE, max_rooms: int = ROOM_HISTORY_MAX_ROOMS):
+        self.size = size
+        self.max_rooms = max_rooms
+        self.rooms: "OrderedDict[str, RoomBuffer]" = OrderedDict()
+
+    def room(self, session_id: str) -> RoomBuffer:
+        buffer = self.rooms.get(session_id)
+        if buffer is None:
+            buffer = self.rooms[session_id] = RoomBuffer(self.size)
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(session_id)
+        return buffer
+
+    def stamp(self, session_id: str, message: dict) -> dict:
+        """Number a broadcast and keep it for replay; returns the message with its "seq" """
+        buffer = self.room(session_id)
+        buffer.seq += 1
+        stamped = {**message, "seq": buffer.seq}
+        buffer.messages.append(stamped)
+        return stamped
+
+    def replay(self, session_id: str, epoch: Optional[str], last_seq: int) -> Optional[List[dict]]:
+        """Messages after last_seq, or None if the gap can no longer be filled"""
+        buffer = self.rooms.get(session_id)
+        if buffer is None or epoch != buffer.epoch or last_seq > buffer.seq:
+            return None
+        if last_seq < buffer.seq - len(buffer.messages):
+            return None  # Part of the gap has already left the ring
+        return [message for message in buffer.messages if message["seq"] > last_seq]
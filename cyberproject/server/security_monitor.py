@@ -11,6 +11,9 @@ import os
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Messages are counted per user and session over this window
+RATE_LIMIT_WINDOW = timedelta(minutes=1)
+
 @dataclass
 class SecurityWarning:
     user_email: str
@@ -32,6 +35,7 @@ class SecurityMonitor:
         # Rate limiting
         self.message_counts: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
         self.last_message_time: Dict[str, Dict[str, datetime]] = defaultdict(lambda: defaultdict(lambda: datetime.min))
+        self.last_rate_limit_prune = datetime.min
         
         # ML phishing detection configuration
         self.enable_ml_detection = os.getenv("ENABLE_ML_PHISHING", "true").lower() == "true"
@@ -175,6 +179,10 @@ class SecurityMonitor:
         
     def analyze_message(self, user_email: str, session_id: str, message: str) -> List[SecurityWarning]:
         """Analyze a message for security threats and return warnings"""
+        return self.analyze_content(user_email, session_id, message) + self.check_rate_limit(user_email, session_id)
+
+    def analyze_content(self, user_email: str, session_id: str, message: str) -> List[SecurityWarning]:
+        """Content checks only; touches no per-user state, so it is safe to run in worker threads"""
         warnings = []
         
         # ML-based phishing detection (probabilistic)
@@ -224,19 +232,21 @@ class SecurityMonitor:
                 severity="medium"
             ))
         
-        # Check rate limiting
-        rate_limit_warnings = self._check_rate_limiting(user_email, session_id)
-        for warning in rate_limit_warnings:
-            warnings.append(SecurityWarning(
+        return warnings
+
+    def check_rate_limit(self, user_email: str, session_id: str) -> List[SecurityWarning]:
+        """Count a message towards the user's rate limit and return any warnings"""
+        return [
+            SecurityWarning(
                 user_email=user_email,
                 session_id=session_id,
                 warning_type="rate_limit",
                 message=warning,
                 timestamp=datetime.utcnow(),
                 severity="medium"
-            ))
-        
-        return warnings
+            )
+            for warning in self._check_rate_limiting(user_email, session_id)
+        ]
     
     def _detect_phishing(self, message: str) -> List[str]:
         """Detect phishing URLs in message"""
@@ -280,7 +290,7 @@ class SecurityMonitor:
         self.message_counts[user_email][session_id] += 1
         
         # Check per-minute limit
-        if now - self.last_message_time[user_email][session_id] < timedelta(minutes=1):
+        if now - self.last_message_time[user_email][session_id] < RATE_LIMIT_WINDOW:
             if self.message_counts[user_email][session_id] > self.max_messages_per_minute:
                 warnings.append(f"Rate limit exceeded: {self.message_counts[user_email][session_id]} messages in 1 minute")
         else:
@@ -314,6 +324,32 @@ class SecurityMonitor:
         if user_email in self.user_warnings and session_id in self.user_warnings[user_email]:
             del self.user_warnings[user_email][session_id]
     
+    def prune_rate_limits(self, now: datetime = None):
+        """Forget counters whose last message is older than the rate window; the next message would reset them"""
+        now = now or datetime.utcnow()
+        for user_email in list(self.last_message_time):
+            sessions = self.last_message_time[user_email]
+            for session_id in [s for s, last in sessions.items() if now - last >= RATE_LIMIT_WINDOW]:
+                del sessions[session_id]
+                self.message_counts.get(user_email, {}).pop(session_id, None)
+            if not sessions:
+                del self.last_message_time[user_email]
+                self.message_counts.pop(user_email, None)
+        self.last_rate_limit_prune = now
+
+    def release_session_state(self, user_email: str, session_id: str):
+        """Tidy up after a user has left; counters inside the rate window stay, so reconnecting doesn't reset them"""
+        now = datetime.utcnow()
+        # Sweeps every user, so at most once per window
+        if now - self.last_rate_limit_prune >= RATE_LIMIT_WINDOW:
+            self.prune_rate_limits(now)
+        # Warnings still count towards termination if the user rejoins; only prune empty entries
+        if user_email in self.user_warnings:
+            if not self.user_warnings[user_email].get(session_id, True):
+                del self.user_warnings[user_email][session_id]
+            if not self.user_warnings[user_email]:
+                del self.user_warnings[user_email]
+    
     def get_security_report(self, user_email: str, session_id: str) -> dict:
         """Get a security report for a user in a session"""
         warnings = self.get_user_warnings(user_email, session_id)
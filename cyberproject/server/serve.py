@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+Production entry point: uvicorn with the tuned permessage-deflate protocol.
+
+Usage (from the project root): python -m server.serve
+"""
+import os
+
+import uvicorn
+
+from server.ws_codec import WS_MAX_FRAME_BYTES
+from server.ws_compression import uvicorn_ws_option
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "server.main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", 8000)),
+        ws=uvicorn_ws_option(),
+        # Oversized messages are refused (close 1009) before they are buffered;
+        # server.ws_codec still checks every frame it decodes
+        ws_max_size=WS_MAX_FRAME_BYTES,
+        log_level="info",
+    )
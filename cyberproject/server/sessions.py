@@ -0,0 +1,145 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+
+from server.storage import StorageBackend, BoundedDict
+
+logger = logging.getLogger(__name__)
+
+# Session registry configuration from environment variables
+try:
+    # Sessions nobody has created, joined, messaged in or checked for this long expire
+    SESSION_IDLE_TIMEOUT = max(60, int(os.getenv("SESSION_IDLE_TIMEOUT", "86400")))
+    # Sessions each worker keeps in memory, and how long (seconds) it trusts a cached one
+    SESSION_CACHE_SIZE = max(1, int(os.getenv("SESSION_CACHE_SIZE", "10000")))
+    SESSION_CACHE_TTL = max(0.0, float(os.getenv("SESSION_CACHE_TTL", "30")))
+    # Last activity is written back at most once per this many seconds per session
+    SESSION_TOUCH_INTERVAL = max(1.0, float(os.getenv("SESSION_TOUCH_INTERVAL", "60")))
+except ValueError:
+    SESSION_IDLE_TIMEOUT, SESSION_CACHE_SIZE, SESSION_CACHE_TTL, SESSION_TOUCH_INTERVAL = 86400, 10000, 30.0, 60.0
+
+
+class CachedSession(NamedTuple):
+    session: dict
+    last_active_at: datetime
+    expires_at: datetime
+    fresh_until: datetime  # when to ask the storage backend again
+
+
+def is_member(session: dict, user_email: str) -> bool:
+    """Whether user_email created the session or has joined it"""
+    return user_email == session.get("created_by") or user_email in session.get("members", ())
+
+
+class SessionRegistry:
+    """
+    Chat sessions in the storage backend, which forgets them after
+    idle_timeout without activity, behind a per-worker read-through cache.
+    Membership checks on every join and /security call are answered from
+    the cache. Lookups and chat messages count as activity, written back
+    at most once per touch_interval.
+    A session expired or created on another worker is seen within cache_ttl.
+    """
+
+    def __init__(self, storage: StorageBackend, idle_timeout: float = SESSION_IDLE_TIMEOUT,
+                 cache_size: int = SESSION_CACHE_SIZE, cache_ttl: float = SESSION_CACHE_TTL,
+                 touch_interval: float = SESSION_TOUCH_INTERVAL):
+        self.storage = storage
+        self.idle_timeout = timedelta(seconds=idle_timeout)
+        self.cache_ttl = timedelta(seconds=cache_ttl)
+        self.touch_interval = timedelta(seconds=touch_interval)
+        self.cache = BoundedDict(cache_size)
+        self.hits = 0
+        self.misses = 0
+        self.touches = 0
+
+    def _cache(self, session_id: str, session: dict, now: datetime) -> dict:
+        expires_at = session["expires_at"]
+        self.cache[session_id] = CachedSession(session, session.get("last_active_at", now), expires_at,
+                                               min(now + self.cache_ttl, expires_at))
+        return session
+
+    async def create(self, session_id: str, session: dict) -> dict:
+        now = datetime.utcnow()
+        expires_at = now + self.idle_timeout
+        session = dict(session, last_active_at=now)
+        await self.storage.create_session(session_id, session, expires_at)
+        return self._cache(session_id, dict(session, expires_at=expires_at), now)
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        """The live session, counting the lookup as activity; None if unknown or expired"""
+        now = datetime.utcnow()
+        cached = self.cache.get(session_id)
+        if cached is not None and cached.fresh_until > now:
+            self.hits += 1
+            self.cache.move_to_end(session_id)
+        else:
+            self.misses += 1
+            session = await self.storage.get_session(session_id)
+            if session is None:
+                self.cache.pop(session_id, None)
+                return None
+            self._cache(session_id, session, now)
+            cached = self.cache[session_id]
+        if now - cached.last_active_at >= self.touch_interval:
+            return await self._touch(session_id, cached, now)
+        return cached.session
+
+    async def exists(self, session_id: str) -> bool:
+        return await self.get(session_id) is not None
+
+    async def record_activity(self, session_id: str):
+        """A message was sent in the session, so a busy room with no new joins doesn't expire"""
+        cached = self.cache.get(session_id)
+        if cached is None:
+            await self.get(session_id)
+            return
+        now = datetime.utcnow()
+        if now - cached.last_active_at >= self.touch_interval:
+            await self._touch(session_id, cached, now)
+
+    async def add_member(self, session_id: str, user_email: str):
+        """Remember who joined, so they can still read the history after leaving"""
+        session = await self.get(session_id)
+        if session is None or user_email in session.get("members", ()):
+            return
+        try:
+            added = await self.storage.add_session_member(session_id, user_email)
+        except Exception as e:
+            # The join goes ahead; the next join retries it
+            logger.warning(f"Could not record member of session {session_id}: {e!r}")
+            return
+        cached = self.cache.get(session_id)
+        if not added:
+            self.cache.pop(session_id, None)
+        elif cached is not None:
+            members = [*cached.session.get("members", ()), user_email]
+            self.cache[session_id] = cached._replace(session=dict(cached.session, members=members))
+
+    async def _touch(self, session_id: str, cached: CachedSession, now: datetime) -> Optional[dict]:
+        expires_at = now + self.idle_timeout
+        try:
+            touched = await self.storage.touch_session(session_id, now, expires_at)
+        except Exception as e:
+            # Activity tracking must not fail the request; the next lookup retries it
+            logger.warning(f"Could not record activity of session {session_id}: {e!r}")
+            return cached.session
+        self.touches += 1
+        if not touched:
+            # Expired in storage since it was cached
+            self.cache.pop(session_id, None)
+            return None
+        return self._cache(session_id, dict(cached.session, last_active_at=now, expires_at=expires_at), now)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "cached": len(self.cache),
+            "evicted": self.cache.evicted,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+            "touches": self.touches,
+            "idle_timeout": int(self.idle_timeout.total_seconds()),
+        }
@@ -0,0 +1,902 @@
+import os
+import json
+import asyncio
+import sqlite3
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from server.circuit_breaker import CircuitBreaker, Unavailable, UNAVAILABLE_ERRORS
+from server.db import IndexSpec, ensure_indexes
+from server.indexes import index_specs
+
+logger = logging.getLogger(__name__)
+
+# Account storage configuration from environment variables
+STORAGE_MONGO = "mongo"
+STORAGE_MEMORY = "memory"
+STORAGE_SQLITE = "sqlite"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", STORAGE_MONGO).lower()
+STORAGE_SQLITE_PATH = os.getenv("STORAGE_SQLITE_PATH", "chat_app.db")
+try:
+    # Entries kept per kind of record by the in-memory backend; the oldest go first
+    STORAGE_MEMORY_MAX_ITEMS = max(100, int(os.getenv("STORAGE_MEMORY_MAX_ITEMS", "100000")))
+except ValueError:
+    STORAGE_MEMORY_MAX_ITEMS = 100000
+# Writes made while MongoDB is down, replayed when it is back; kept in memory, and
+# appended to this file too if set so they survive a restart
+STORAGE_JOURNAL_PATH = os.getenv("STORAGE_JOURNAL_PATH", "")
+try:
+    STORAGE_JOURNAL_MAX = max(100, int(os.getenv("STORAGE_JOURNAL_MAX", "10000")))
+except ValueError:
+    STORAGE_JOURNAL_MAX = 10000
+
+# Wrong codes allowed before an OTP is thrown away
+OTP_MAX_ATTEMPTS = 5
+
+
+class BoundedDict(OrderedDict):
+    """A dict that forgets its least recently written entries past max_items"""
+
+    def __init__(self, max_items: int = STORAGE_MEMORY_MAX_ITEMS):
+        super().__init__()
+        self.max_items = max_items
+        self.evicted = 0
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_items:
+            self.popitem(last=False)
+            self.evicted += 1
+
+    def purge_expired(self, now: datetime, field: str = "expires_at"):
+        """Drop expired entries from the old end; records here share one lifetime, so they expire in order"""
+        while self:
+            key, value = next(iter(self.items()))
+            if value[field] > now:
+                break
+            del self[key]
+
+
+class StorageBackend(ABC):
+    """
+    Users, OTPs, temporary signup passwords, password reset tokens, QR login
+    tokens and chat sessions. Handlers only talk to this interface; each
+    backend answers every call in as few queries as it can.
+    """
+
+    name = "none"
+
+    async def start(self):
+        """Create tables / indexes; called once before the app takes requests"""
+
+    async def close(self):
+        pass
+
+    async def ping(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+    # Users
+    @abstractmethod
+    async def get_user(self, email: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def create_user(self, user: dict) -> bool:
+        """False if an account with this email already exists"""
+
+    @abstractmethod
+    async def update_password(self, email: str, password_hash: str) -> bool:
+        """False if there is no such user"""
+
+    # OTPs: several per (email, purpose) are kept so requests can be rate limited
+    @abstractmethod
+    async def replace_otp(self, otp: dict):
+        """Store a new OTP, dropping any unused one for the same email and purpose"""
+
+    @abstractmethod
+    async def consume_otp(self, email: str, purpose: str, otp_code: str,
+                          max_attempts: int = OTP_MAX_ATTEMPTS) -> Optional[dict]:
+        """
+        Check a code against the unused OTP in one atomic step: a live OTP is
+        marked used if the code matches, otherwise its attempts go up by one.
+        Returns the OTP as it was before (with its "_id"), or None.
+        """
+
+    @abstractmethod
+    async def delete_otp(self, otp: dict):
+        ...
+
+    @abstractmethod
+    async def otp_window(self, email: str, purpose: str, since: datetime) -> dict:
+        """{"count": OTPs created since `since`, "oldest": the earliest one's created_at or None}"""
+
+    # Password hashes waiting for signup OTP verification
+    @abstractmethod
+    async def put_temp_password(self, email: str, password_hash: str, expires_at: datetime):
+        ...
+
+    @abstractmethod
+    async def pop_temp_password(self, email: str) -> Optional[str]:
+        """Take the stored hash; None if there is none or it has expired"""
+
+    # Password reset tokens: one live token per email
+    @abstractmethod
+    async def put_verification_token(self, token: str, email: str, expires_at: datetime):
+        ...
+
+    @abstractmethod
+    async def get_verification_token(self, token: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def delete_verification_token(self, token: str):
+        ...
+
+    # One-time QR login tokens
+    @abstractmethod
+    async def put_qr_token(self, token: dict):
+        ...
+
+    @abstractmethod
+    async def use_qr_token(self, token: str) -> Optional[dict]:
+        """Mark an unused token used and return it; None if unknown or already used"""
+
+    # Chat sessions: they expire once idle, see server/sessions.py
+    @abstractmethod
+    async def create_session(self, session_id: str, session: dict, expires_at: datetime):
+        ...
+
+    @abstractmethod
+    async def get_session(self, session_id: str) -> Optional[dict]:
+        """The session with its "expires_at"; None if unknown or expired"""
+
+    @abstractmethod
+    async def touch_session(self, session_id: str, last_active_at: datetime, expires_at: datetime) -> bool:
+        """Record activity and push back the expiry; False if the session is gone"""
+
+    @abstractmethod
+    async def add_session_member(self, session_id: str, user_email: str) -> bool:
+        """Add user_email to the session's "members" list once; False if the session is gone"""
+
+
+class MemoryStorage(StorageBackend):
+    """Process-local and lost on restart; every kind of record is capped at max_items"""
+
+    name = STORAGE_MEMORY
+
+    def __init__(self, max_items: int = STORAGE_MEMORY_MAX_ITEMS):
+        self.users = BoundedDict(max_items)
+        self.otps = BoundedDict(max_items)  # (email, purpose) -> OTPs, oldest first
+        self.temp_passwords = BoundedDict(max_items)
+        self.verification_tokens = BoundedDict(max_items)
+        self.verification_token_by_email = BoundedDict(max_items)
+        self.qr_tokens = BoundedDict(max_items)
+        self.sessions = BoundedDict(max_items)
+
+    async def get_user(self, email: str) -> Optional[dict]:
+        user = self.users.get(email)
+        return dict(user) if user is not None else None
+
+    async def create_user(self, user: dict) -> bool:
+        if user["email"] in self.users:
+            return False
+        self.users[user["email"]] = dict(user)
+        return True
+
+    async def update_password(self, email: str, password_hash: str) -> bool:
+        user = self.users.get(email)
+        if user is None:
+            return False
+        user["password_hash"] = password_hash
+        user["password_reset_at"] = datetime.utcnow()
+        return True
+
+    async def replace_otp(self, otp: dict):
+        now = datetime.utcnow()
+        key = (otp["email"], otp["purpose"])
+        kept = [doc for doc in self.otps.get(key, ()) if doc["used"] and doc["expires_at"] > now]
+        self.otps[key] = kept + [dict(otp, _id=uuid4().hex)]
+
+    async def consume_otp(self, email: str, purpose: str, otp_code: str,
+                          max_attempts: int = OTP_MAX_ATTEMPTS) -> Optional[dict]:
+        now = datetime.utcnow()
+        for doc in self.otps.get((email, purpose), ()):
+            if doc["used"]:
+                continue
+            before = dict(doc)
+            if doc["expires_at"] > now and doc.get("attempts", 0) < max_attempts:
+                if doc["otp_code"] == otp_code:
+                    doc.update(used=True, used_at=now)
+                else:
+                    doc["attempts"] = doc.get("attempts", 0) + 1
+            return before
+        return None
+
+    async def delete_otp(self, otp: dict):
+        key = (otp["email"], otp["purpose"])
+        if key in self.otps:
+            self.otps[key] = [doc for doc in self.otps[key] if doc["_id"] != otp["_id"]]
+
+    async def otp_window(self, email: str, purpose: str, since: datetime) -> dict:
+        created = [doc["created_at"] for doc in self.otps.get((email, purpose), ()) if doc["created_at"] >= since]
+        return {"count": len(created), "oldest": min(created, default=None)}
+
+    async def put_temp_password(self, email: str, password_hash: str, expires_at: datetime):
+        self.temp_passwords.purge_expired(datetime.utcnow())
+        self.temp_passwords[email] = {"password_hash": password_hash, "expires_at": expires_at}
+
+    async def pop_temp_password(self, email: str) -> Optional[str]:
+        temp = self.temp_passwords.pop(email, None)
+        if temp is None or datetime.utcnow() > temp["expires_at"]:
+            return None
+        return temp["password_hash"]
+
+    async def put_verification_token(self, token: str, email: str, expires_at: datetime):
+        self.verification_tokens.purge_expired(datetime.utcnow())
+        old = self.verification_token_by_email.get(email)
+        if old is not None:
+            self.verification_tokens.pop(old, None)
+        self.verification_token_by_email[email] = token
+        self.verification_tokens[token] = {"token": token, "email": email, "expires_at": expires_at,
+                                           "created_at": datetime.utcnow()}
+
+    async def get_verification_token(self, token: str) -> Optional[dict]:
+        doc = self.verification_tokens.get(token)
+        return dict(doc) if doc is not None else None
+
+    async def delete_verification_token(self, token: str):
+        self.verification_tokens.pop(token, None)
+
+    async def put_qr_token(self, token: dict):
+        self.qr_tokens.purge_expired(datetime.utcnow())
+        self.qr_tokens[token["token"]] = dict(token)
+
+    async def use_qr_token(self, token: str) -> Optional[dict]:
+        doc = self.qr_tokens.get(token)
+        if doc is None or doc["used"]:
+            return None
+        doc.update(used=True, used_at=datetime.utcnow())
+        return dict(doc)
+
+    async def create_session(self, session_id: str, session: dict, expires_at: datetime):
+        self.sessions.purge_expired(datetime.utcnow())
+        self.sessions[session_id] = dict(session, expires_at=expires_at)
+
+    async def get_session(self, session_id: str) -> Optional[dict]:
+        session = self.sessions.get(session_id)
+        if session is None or session["expires_at"] <= datetime.utcnow():
+            return None
+        return dict(session)
+
+    async def touch_session(self, session_id: str, last_active_at: datetime, expires_at: datetime) -> bool:
+        session = await self.get_session(session_id)
+        if session is None:
+            return False
+        # Re-inserting keeps the table in expiry order for purge_expired
+        self.sessions[session_id] = dict(session, last_active_at=last_active_at, expires_at=expires_at)
+        return True
+
+    async def add_session_member(self, session_id: str, user_email: str) -> bool:
+        if await self.get_session(session_id) is None:
+            return False
+        members = self.sessions[session_id].setdefault("members", [])
+        if user_email not in members:
+            members.append(user_email)
+        return True
+
+
+# Registry names of the collections MongoStorage uses
+STORAGE_COLLECTIONS = ("users", "otps", "temp_passwords", "verification_tokens", "qr_tokens", "sessions")
+
+
+class MongoStorage(StorageBackend):
+    """MongoDB collections; TTL indexes expire OTPs and tokens"""
+
+    name = STORAGE_MONGO
+
+    def __init__(self, database, users_collection: str = "users"):
+        self.database = database
+        self.users = database[users_collection]
+        self.otps = database["otps"]
+        self.temp_passwords = database["temp_passwords"]
+        self.verification_tokens = database["verification_tokens"]
+        self.qr_tokens = database["qr_tokens"]
+        self.sessions = database["sessions"]
+
+    def indexes(self) -> List[IndexSpec]:
+        """This backend's collections, with their indexes from the registry in server/indexes.py"""
+        return index_specs(self.database, {"users": self.users.name}, only=STORAGE_COLLECTIONS)
+
+    async def start(self):
+        # Missing indexes only, all collections at once
+        await ensure_indexes(self.indexes())
+
+    async def ping(self):
+        await self.database.command("ping")
+
+    async def get_user(self, email: str) -> Optional[dict]:
+        return await self.users.find_one({"email": email})
+
+    async def create_user(self, user: dict) -> bool:
+        # The unique email index makes the existence check and the insert one round trip
+        try:
+            await self.users.insert_one(dict(user))
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def update_password(self, email: str, password_hash: str) -> bool:
+        result = await self.users.update_one(
+            {"email": email},
+            {"$set": {"password_hash": password_hash, "password_reset_at": datetime.utcnow()}}
+        )
+        return result.matched_count > 0
+
+    async def replace_otp(self, otp: dict):
+        await self.otps.delete_many({"email": otp["email"], "purpose": otp["purpose"], "used": False})
+        await self.otps.insert_one(dict(otp))
+
+    async def consume_otp(self, email: str, purpose: str, otp_code: str,
+                          max_attempts: int = OTP_MAX_ATTEMPTS) -> Optional[dict]:
+        # An update pipeline decides used / attempts server-side, so checking a code is one round trip
+        now = datetime.utcnow()
+        attempts = {"$ifNull": ["$attempts", 0]}
+        live = {"$and": [{"$gt": ["$expires_at", now]}, {"$lt": [attempts, max_attempts]}]}
+        # $literal: a submitted code like "$otp_code" must not be read as a field path
+        code = {"$literal": otp_code}
+        accepted = {"$and": [live, {"$eq": ["$otp_code", code]}]}
+        rejected = {"$and": [live, {"$ne": ["$otp_code", code]}]}
+        return await self.otps.find_one_and_update(
+            {"email": email, "purpose": purpose, "used": False},
+            [{"$set": {
+                "used": accepted,
+                "used_at": {"$cond": [accepted, now, "$$REMOVE"]},
+                "attempts": {"$add": [attempts, {"$cond": [rejected, 1, 0]}]},
+            }}]
+        )
+
+    async def delete_otp(self, otp: dict):
+        await self.otps.delete_one({"_id": otp["_id"]})
+
+    async def otp_window(self, email: str, purpose: str, since: datetime) -> dict:
+        # Count and oldest in one aggregation instead of a count plus a sorted find
+        groups = await self.otps.aggregate([
+            {"$match": {"email": email, "purpose": purpose, "created_at": {"$gte": since}}},
+            {"$group": {"_id": None, "count": {"$sum": 1}, "oldest": {"$min": "$created_at"}}},
+        ]).to_list(1)
+        if not groups:
+            return {"count": 0, "oldest": None}
+        return {"count": groups[0]["count"], "oldest": groups[0]["oldest"]}
+
+    async def put_temp_password(self, email: str, password_hash: str, expires_at: datetime):
+        await self.temp_passwords.replace_one(
+            {"email": email},
+            {"email": email, "password_hash": password_hash, "created_at": datetime.utcnow(),
+             "expires_at": expires_at},
+            upsert=True
+        )
+
+    async def pop_temp_password(self, email: str) -> Optional[str]:
+        temp = await self.temp_passwords.find_one_and_delete({"email": email})
+        # The TTL monitor runs about once a minute, so expiry is checked here too
+        if temp is None or datetime.utcnow() > temp["expires_at"]:
+            return None
+        return temp["password_hash"]
+
+    async def put_verification_token(self, token: str, email: str, expires_at: datetime):
+        # One live token per email: replacing the email's document drops the old token with it
+        await self.verification_tokens.replace_one(
+            {"email": email},
+            {"token": token, "email": email, "expires_at": expires_at, "created_at": datetime.utcnow()},
+            upsert=True
+        )
+
+    async def get_verification_token(self, token: str) -> Optional[dict]:
+        return await self.verification_tokens.find_one({"token": token})
+
+    async def delete_verification_token(self, token: str):
+        await self.verification_tokens.delete_one({"token": token})
+
+    async def put_qr_token(self, token: dict):
+        await self.qr_tokens.insert_one(dict(token))
+
+    async def use_qr_token(self, token: str) -> Optional[dict]:
+        # Check and mark in one atomic step, so a token can't be redeemed twice
+        return await self.qr_tokens.find_one_and_update(
+            {"token": token, "used": False},
+            {"$set": {"used": True, "used_at": datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def create_session(self, session_id: str, session: dict, expires_at: datetime):
+        await self.sessions.insert_one({"session_id": session_id, **session, "expires_at": expires_at})
+
+    async def get_session(self, session_id: str) -> Optional[dict]:
+        # The TTL monitor only runs once a minute, so expired documents can still be there
+        return await self.sessions.find_one({"session_id": session_id, "expires_at": {"$gt": datetime.utcnow()}},
+                                            {"_id": 0, "session_id": 0})
+
+    async def touch_session(self, session_id: str, last_active_at: datetime, expires_at: datetime) -> bool:
+        result = await self.sessions.update_one(
+            {"session_id": session_id, "expires_at": {"$gt": datetime.utcnow()}},
+            {"$set": {"last_active_at": last_active_at, "expires_at": expires_at}}
+        )
+        return result.matched_count > 0
+
+    async def add_session_member(self, session_id: str, user_email: str) -> bool:
+        result = await self.sessions.update_one(
+            {"session_id": session_id, "expires_at": {"$gt": datetime.utcnow()}},
+            {"$addToSet": {"members": user_email}}
+        )
+        return result.matched_count > 0
+
+
+def _to_json(document: dict) -> str:
+    # Datetimes round-trip; anything else unusual (e.g. an ObjectId) is kept as text
+    return json.dumps(document, default=lambda value: {"$date": value.isoformat()}
+                      if isinstance(value, datetime) else str(value))
+
+
+def _from_json(text: str) -> dict:
+    return json.loads(text, object_hook=lambda value: datetime.fromisoformat(value["$date"])
+                      if value.keys() == {"$date"} else value)
+
+
+def _ts(value: datetime) -> str:
+    # Fixed width, so timestamps compare correctly as text
+    return value.isoformat(timespec="microseconds")
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (email TEXT PRIMARY KEY, document TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS otps (
+    id INTEGER PRIMARY KEY, email TEXT NOT NULL, purpose TEXT NOT NULL, otp_code TEXT NOT NULL,
+    created_at TEXT NOT NULL, expires_at TEXT NOT NULL, used INTEGER NOT NULL DEFAULT 0,
+    used_at TEXT, attempts INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS otps_email_purpose ON otps (email, purpose, used);
+CREATE INDEX IF NOT EXISTS otps_expires_at ON otps (expires_at);
+CREATE TABLE IF NOT EXISTS temp_passwords (
+    email TEXT PRIMARY KEY, password_hash TEXT NOT NULL, expires_at TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS temp_passwords_expires_at ON temp_passwords (expires_at);
+CREATE TABLE IF NOT EXISTS verification_tokens (
+    token TEXT PRIMARY KEY, email TEXT NOT NULL, created_at TEXT NOT NULL, expires_at TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS verification_tokens_email ON verification_tokens (email);
+CREATE INDEX IF NOT EXISTS verification_tokens_expires_at ON verification_tokens (expires_at);
+CREATE TABLE IF NOT EXISTS qr_tokens (
+    token TEXT PRIMARY KEY, user_email TEXT NOT NULL, created_at TEXT NOT NULL, expires_at TEXT NOT NULL,
+    used INTEGER NOT NULL DEFAULT 0, used_at TEXT);
+CREATE INDEX IF NOT EXISTS qr_tokens_expires_at ON qr_tokens (expires_at);
+CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, document TEXT NOT NULL, expires_at TEXT);
+"""
+
+OTP_COLUMNS = ("id", "email", "purpose", "otp_code", "created_at", "expires_at", "used", "used_at", "attempts")
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    An embedded database file for single-node deployments. All queries run on
+    one worker thread with its own connection, so the event loop never blocks
+    on disk and SQLite never sees concurrent writers.
+    """
+
+    name = STORAGE_SQLITE
+
+    def __init__(self, path: str = STORAGE_SQLITE_PATH):
+        self.path = path
+        self.db: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-storage")
+
+    def _open(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SQLITE_SCHEMA)
+        # Files from before sessions expired lack the column; their sessions count as expired
+        if "expires_at" not in {row[1] for row in self.db.execute("PRAGMA table_info(sessions)")}:
+            self.db.execute("ALTER TABLE sessions ADD COLUMN expires_at TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _transaction(self, statements: List[tuple]) -> List[sqlite3.Cursor]:
+        """Run (sql, params) pairs atomically"""
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            cursors = [self.db.execute(sql, params) for sql, params in statements]
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        return cursors
+
+    async def _execute(self, sql: str, params: tuple = ()) -> int:
+        return await self._run(lambda: self.db.execute(sql, params).rowcount)
+
+    async def _execute_returning(self, sql: str, params: tuple) -> List[tuple]:
+        return await self._run(lambda: self.db.execute(sql, params).fetchall())
+
+    async def _fetchone(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        return await self._run(lambda: self.db.execute(sql, params).fetchone())
+
+    async def start(self):
+        await self._run(self._open)
+
+    async def close(self):
+        if self.db is not None:
+            await self._run(self.db.close)
+            self.db = None
+        self._executor.shutdown(wait=False)
+
+    async def get_user(self, email: str) -> Optional[dict]:
+        row = await self._fetchone("SELECT document FROM users WHERE email = ?", (email,))
+        return _from_json(row[0]) if row else None
+
+    async def create_user(self, user: dict) -> bool:
+        inserted = await self._execute("INSERT OR IGNORE INTO users (email, document) VALUES (?, ?)",
+                                       (user["email"], _to_json(user)))
+        return inserted > 0
+
+    async def update_password(self, email: str, password_hash: str) -> bool:
+        def update():
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT document FROM users WHERE email = ?", (email,)).fetchone()
+                if row is not None:
+                    user = _from_json(row[0])
+                    user.update(password_hash=password_hash, password_reset_at=datetime.utcnow())
+                    self.db.execute("UPDATE users SET document = ? WHERE email = ?", (_to_json(user), email))
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return row is not None
+
+        return await self._run(update)
+
+    def _otp_row(self, row: Optional[tuple]) -> Optional[dict]:
+        if row is None:
+            return None
+        otp = dict(zip(OTP_COLUMNS, row))
+        otp["_id"] = otp.pop("id")
+        otp["used"] = bool(otp["used"])
+        for field in ("created_at", "expires_at", "used_at"):
+            if otp[field] is not None:
+                otp[field] = datetime.fromisoformat(otp[field])
+        return otp
+
+    async def replace_otp(self, otp: dict):
+        await self._run(self._transaction, [
+            ("DELETE FROM otps WHERE expires_at <= ?", (_ts(datetime.utcnow()),)),
+            ("DELETE FROM otps WHERE email = ? AND purpose = ? AND used = 0", (otp["email"], otp["purpose"])),
+            ("INSERT INTO otps (email, purpose, otp_code, created_at, expires_at, used, attempts) "
+             "VALUES (?, ?, ?, ?, ?, ?, ?)",
+             (otp["email"], otp["purpose"], otp["otp_code"], _ts(otp["created_at"]), _ts(otp["expires_at"]),
+              int(otp.get("used", False)), otp.get("attempts", 0))),
+        ])
+
+    async def consume_otp(self, email: str, purpose: str, otp_code: str,
+                          max_attempts: int = OTP_MAX_ATTEMPTS) -> Optional[dict]:
+        now = _ts(datetime.utcnow())
+
+        def consume():
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(f"SELECT {', '.join(OTP_COLUMNS)} FROM otps "
+                                      "WHERE email = ? AND purpose = ? AND used = 0", (email, purpose)).fetchone()
+                if row is not None:
+                    self.db.execute(
+                        "UPDATE otps SET used = (otp_code = ?), used_at = CASE WHEN otp_code = ? THEN ? END, "
+                        "attempts = attempts + (otp_code != ?) WHERE id = ? AND expires_at > ? AND attempts < ?",
+                        (otp_code, otp_code, now, otp_code, row[0], now, max_attempts))
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return row
+
+        return self._otp_row(await self._run(consume))
+
+    async def delete_otp(self, otp: dict):
+        await self._execute("DELETE FROM otps WHERE id = ?", (otp["_id"],))
+
+    async def otp_window(self, email: str, purpose: str, since: datetime) -> dict:
+        count, oldest = await self._fetchone("SELECT COUNT(*), MIN(created_at) FROM otps "
+                                             "WHERE email = ? AND purpose = ? AND created_at >= ?",
+                                             (email, purpose, _ts(since)))
+        return {"count": count, "oldest": datetime.fromisoformat(oldest) if oldest else None}
+
+    async def put_temp_password(self, email: str, password_hash: str, expires_at: datetime):
+        await self._run(self._transaction, [
+            ("DELETE FROM temp_passwords WHERE expires_at <= ?", (_ts(datetime.utcnow()),)),
+            ("INSERT OR REPLACE INTO temp_passwords (email, password_hash, expires_at) VALUES (?, ?, ?)",
+             (email, password_hash, _ts(expires_at))),
+        ])
+
+    async def pop_temp_password(self, email: str) -> Optional[str]:
+        rows = await self._execute_returning("DELETE FROM temp_passwords WHERE email = ? "
+                                             "RETURNING password_hash, expires_at", (email,))
+        if not rows or datetime.utcnow() > datetime.fromisoformat(rows[0][1]):
+            return None
+        return rows[0][0]
+
+    async def put_verification_token(self, token: str, email: str, expires_at: datetime):
+        now = datetime.utcnow()
+        await self._run(self._transaction, [
+            ("DELETE FROM verification_tokens WHERE email = ? OR expires_at <= ?", (email, _ts(now))),
+            ("INSERT INTO verification_tokens (token, email, created_at, expires_at) VALUES (?, ?, ?, ?)",
+             (token, email, _ts(now), _ts(expires_at))),
+        ])
+
+    async def get_verification_token(self, token: str) -> Optional[dict]:
+        row = await self._fetchone("SELECT email, created_at, expires_at FROM verification_tokens WHERE token = ?",
+                                   (token,))
+        if row is None:
+            return None
+        return {"token": token, "email": row[0], "created_at": datetime.fromisoformat(row[1]),
+                "expires_at": datetime.fromisoformat(row[2])}
+
+    async def delete_verification_token(self, token: str):
+        await self._execute("DELETE FROM verification_tokens WHERE token = ?", (token,))
+
+    async def put_qr_token(self, token: dict):
+        await self._run(self._transaction, [
+            ("DELETE FROM qr_tokens WHERE expires_at <= ?", (_ts(datetime.utcnow()),)),
+            ("INSERT INTO qr_tokens (token, user_email, created_at, expires_at, used) VALUES (?, ?, ?, ?, ?)",
+             (token["token"], token["user_email"], _ts(token["created_at"]), _ts(token["expires_at"]),
+              int(token.get("used", False)))),
+        ])
+
+    async def use_qr_token(self, token: str) -> Optional[dict]:
+        used_at = datetime.utcnow()
+        rows = await self._execute_returning("UPDATE qr_tokens SET used = 1, used_at = ? WHERE token = ? AND used = 0 "
+                                             "RETURNING user_email, created_at, expires_at",
+                                             (_ts(used_at), token))
+        if not rows:
+            return None
+        user_email, created_at, expires_at = rows[0]
+        return {"token": token, "user_email": user_email, "created_at": datetime.fromisoformat(created_at),
+                "expires_at": datetime.fromisoformat(expires_at), "used": True, "used_at": used_at}
+
+    async def create_session(self, session_id: str, session: dict, expires_at: datetime):
+        await self._run(self._transaction, [
+            ("DELETE FROM sessions WHERE expires_at IS NULL OR expires_at <= ?", (_ts(datetime.utcnow()),)),
+            ("INSERT OR REPLACE INTO sessions (session_id, document, expires_at) VALUES (?, ?, ?)",
+             (session_id, _to_json(dict(session, expires_at=expires_at)), _ts(expires_at))),
+        ])
+
+    async def get_session(self, session_id: str) -> Optional[dict]:
+        row = await self._fetchone("SELECT document FROM sessions WHERE session_id = ? AND expires_at > ?",
+                                   (session_id, _ts(datetime.utcnow())))
+        return _from_json(row[0]) if row else None
+
+    async def touch_session(self, session_id: str, last_active_at: datetime, expires_at: datetime) -> bool:
+        updated = await self._execute(
+            "UPDATE sessions SET expires_at = ?, document = json_set(document, "
+            "'$.last_active_at', json_object('$date', ?), '$.expires_at', json_object('$date', ?)) "
+            "WHERE session_id = ? AND expires_at > ?",
+            (_ts(expires_at), _ts(last_active_at), _ts(expires_at), session_id, _ts(datetime.utcnow())))
+        return updated > 0
+
+    async def add_session_member(self, session_id: str, user_email: str) -> bool:
+        # Matches (and so counts) whether or not the member was already listed
+        updated = await self._execute(
+            "UPDATE sessions SET document = CASE "
+            "WHEN EXISTS (SELECT 1 FROM json_each(document, '$.members') WHERE value = ?) THEN document "
+            "ELSE json_set(document, '$.members', "
+            "json_insert(COALESCE(json_extract(document, '$.members'), json_array()), '$[#]', ?)) END "
+            "WHERE session_id = ? AND expires_at > ?",
+            (user_email, user_email, session_id, _ts(datetime.utcnow())))
+        return updated > 0
+
+
+
+class StorageJournal:
+    """Writes that couldn't reach the primary backend, oldest first, as (method name, args)"""
+
+    def __init__(self, path: str = STORAGE_JOURNAL_PATH, max_entries: int = STORAGE_JOURNAL_MAX):
+        self.path = path
+        self.entries = deque(maxlen=max_entries)
+        self.dropped = 0
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = _from_json(line)
+                        self._add(entry["op"], tuple(entry["args"]))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _add(self, method: str, args: tuple):
+        if len(self.entries) == self.entries.maxlen:
+            self.dropped += 1
+        self.entries.append((method, args))
+
+    def append(self, method: str, args: tuple):
+        self._add(method, args)
+        if self.path:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(_to_json({"op": method, "args": list(args)}) + "\n")
+            except OSError as e:
+                logger.warning(f"Could not write storage journal {self.path}: {e}")
+
+    def clear(self):
+        self.entries.clear()
+        if self.path and os.path.exists(self.path):
+            open(self.path, "w").close()
+
+
+class FailoverStorage(StorageBackend):
+    """
+    A primary backend (MongoDB) behind a circuit breaker, with an in-memory
+    fallback. While the primary is healthy every write is mirrored into the
+    fallback and users / sessions read from it are cached there, so the
+    fallback can carry on when the breaker opens. Writes made while open are
+    journaled and replayed into the primary before the breaker closes.
+    """
+
+    def __init__(self, primary: StorageBackend, fallback: Optional[MemoryStorage] = None,
+                 breaker: Optional[CircuitBreaker] = None, journal: Optional[StorageJournal] = None):
+        self.primary = primary
+        self.fallback = fallback if fallback is not None else MemoryStorage()
+        self.breaker = breaker if breaker is not None else CircuitBreaker(primary.ping)
+        self.breaker.on_recover = self._recover
+        self.journal = journal if journal is not None else StorageJournal()
+        self.name = primary.name
+        self.replayed = 0
+        self._prepared = False
+
+    async def start(self):
+        """Prepare the primary if it answers; otherwise start open and catch up once it does"""
+        try:
+            await asyncio.wait_for(self.primary.ping(), self.breaker.call_timeout)
+        except UNAVAILABLE_ERRORS as e:
+            logger.warning(f"{self.name} storage unavailable at startup, serving from memory: {e!r}")
+            self.breaker.trip()
+            return
+        await self.primary.start()
+        self._prepared = True
+        await self._replay()
+
+    async def close(self):
+        await self.breaker.stop()
+        await self.primary.close()
+
+    async def _recover(self):
+        if not self._prepared:
+            await self.primary.start()
+            self._prepared = True
+        await self._replay()
+
+    async def _replay(self):
+        """Apply journaled writes to the primary, oldest first; a connection error leaves the rest queued"""
+        while self.journal.entries:
+            method, args = self.journal.entries[0]
+            try:
+                await asyncio.wait_for(getattr(self.primary, method)(*args), self.breaker.call_timeout)
+            except UNAVAILABLE_ERRORS:
+                raise
+            except Exception as e:
+                logger.warning(f"Dropping journaled {method}: {e!r}")
+            self.journal.entries.popleft()
+            self.replayed += 1
+        self.journal.clear()
+
+    async def _read(self, method: str, *args):
+        try:
+            return await self.breaker.call(getattr(self.primary, method), *args)
+        except Unavailable:
+            return await getattr(self.fallback, method)(*args)
+
+    async def _write(self, method: str, *args):
+        if not self.breaker.is_open:
+            try:
+                result = await self.breaker.call(getattr(self.primary, method), *args)
+            except Unavailable:
+                pass
+            else:
+                try:
+                    await getattr(self.fallback, method)(*args)
+                except Exception:
+                    pass
+                return result
+        result = await getattr(self.fallback, method)(*args)
+        self.journal.append(method, args)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "breaker": self.breaker.stats(),
+            "journal": {"pending": len(self.journal), "replayed": self.replayed, "dropped": self.journal.dropped},
+        }
+
+    async def get_user(self, email: str) -> Optional[dict]:
+        user = await self._read("get_user", email)
+        if user is not None and not self.breaker.is_open:
+            self.fallback.users[email] = dict(user)
+        return user
+
+    async def get_session(self, session_id: str) -> Optional[dict]:
+        session = await self._read("get_session", session_id)
+        if session is not None and not self.breaker.is_open:
+            self.fallback.sessions[session_id] = dict(session)
+        return session
+
+    async def otp_window(self, email: str, purpose: str, since: datetime) -> dict:
+        return await self._read("otp_window", email, purpose, since)
+
+    async def get_verification_token(self, token: str) -> Optional[dict]:
+        return await self._read("get_verification_token", token)
+
+    async def create_user(self, user: dict) -> bool:
+        return await self._write("create_user", user)
+
+    async def update_password(self, email: str, password_hash: str) -> bool:
+        return await self._write("update_password", email, password_hash)
+
+    async def replace_otp(self, otp: dict):
+        await self._write("replace_otp", otp)
+
+    async def consume_otp(self, email: str, purpose: str, otp_code: str,
+                          max_attempts: int = OTP_MAX_ATTEMPTS) -> Optional[dict]:
+        return await self._write("consume_otp", email, purpose, otp_code, max_attempts)
+
+    async def delete_otp(self, otp: dict):
+        await self._write("delete_otp", otp)
+
+    async def put_temp_password(self, email: str, password_hash: str, expires_at: datetime):
+        await self._write("put_temp_password", email, password_hash, expires_at)
+
+    async def pop_temp_password(self, email: str) -> Optional[str]:
+        return await self._write("pop_temp_password", email)
+
+    async def put_verification_token(self, token: str, email: str, expires_at: datetime):
+        await self._write("put_verification_token", token, email, expires_at)
+
+    async def delete_verification_token(self, token: str):
+        await self._write("delete_verification_token", token)
+
+    async def put_qr_token(self, token: dict):
+        await self._write("put_qr_token", token)
+
+    async def use_qr_token(self, token: str) -> Optional[dict]:
+        return await self._write("use_qr_token", token)
+
+    async def create_session(self, session_id: str, session: dict, expires_at: datetime):
+        await self._write("create_session", session_id, session, expires_at)
+
+    async def touch_session(self, session_id: str, last_active_at: datetime, expires_at: datetime) -> bool:
+        return await self._write("touch_session", session_id, last_active_at, expires_at)
+
+    async def add_session_member(self, session_id: str, user_email: str) -> bool:
+        return await self._write("add_session_member", session_id, user_email)
+
+
+def create_storage(backend: str = STORAGE_BACKEND, database=None, users_collection: str = "users",
+                   sqlite_path: str = STORAGE_SQLITE_PATH) -> StorageBackend:
+    """
+    The configured backend. MongoDB sits behind a circuit breaker with an
+    in-memory failover; without a database handle at all, memory is used.
+    """
+    if backend == STORAGE_MONGO and database is not None:
+        return FailoverStorage(MongoStorage(database, users_collection))
+    if backend == STORAGE_SQLITE:
+        return SQLiteStorage(sqlite_path)
+    if backend not in (STORAGE_MONGO, STORAGE_MEMORY):
+        logger.warning(f"Unknown STORAGE_BACKEND {backend!r}, using in-memory storage")
+    return MemoryStorage()
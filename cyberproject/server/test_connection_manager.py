@@ -0,0 +1,416 @@
+"""
+Test script for the WebSocket room connection manager (no server required)
+"""
+
+import os
+import sys
+import json
+import asyncio
+import time
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.connection_manager import (
+    RoomConnectionManager,
+    OVERFLOW_DROP_OLDEST,
+    OVERFLOW_DROP_MESSAGE,
+    OVERFLOW_DISCONNECT,
+    ConnectionRejected,
+)
+from server.ws_codec import CODECS
+from server.room_history import LRUSet
+
+
+class FakeWebSocket:
+    """Minimal stand-in for a Starlette WebSocket that records what it is sent"""
+
+    def __init__(self, delay: float = 0.0, fail: bool = False):
+        self.delay = delay
+        self.fail = fail
+        self.sent = []
+        self.closed_with = None
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data):
+        if self.fail:
+            raise RuntimeError("socket is gone")
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.sent.append(json.loads(data))
+
+    async def close(self, code: int = 1000):
+        self.closed_with = code
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_broadcast_does_not_wait_for_slow_clients():
+    async def scenario():
+        manager = RoomConnectionManager()
+        fast = FakeWebSocket()
+        slow = FakeWebSocket(delay=0.5)
+        await manager.connect("room", fast)
+        await manager.connect("room", slow)
+
+        started = time.perf_counter()
+        for i in range(10):
+            await manager.broadcast("room", {"n": i})
+        elapsed = time.perf_counter() - started
+        await _settle()
+
+        assert elapsed < 0.05, f"broadcast blocked for {elapsed:.3f}s"
+        assert [m["n"] for m in fast.sent] == list(range(10))
+        assert len(slow.sent) < 10
+        for connection in manager.get_connections("room"):
+            connection.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_overflow_policies():
+    async def scenario(policy):
+        manager = RoomConnectionManager(max_queue=2, overflow_policy=policy)
+        ws = FakeWebSocket(delay=10)
+        connection = await manager.connect("room", ws)
+        await _settle()  # writer picks up nothing yet
+        for i in range(5):
+            await manager.broadcast("room", {"n": i})
+        queued = [json.loads(f)["n"] for f in list(connection.queue._queue) if f is not None]
+        await _settle()
+        result = (queued, connection.dropped, ws.closed_with, manager.get_connections("room"))
+        connection.cancel()
+        return result
+
+    queued, dropped, _, _ = asyncio.run(scenario(OVERFLOW_DROP_OLDEST))
+    assert queued == [3, 4] and dropped == 3
+
+    queued, dropped, _, _ = asyncio.run(scenario(OVERFLOW_DROP_MESSAGE))
+    assert queued == [0, 1] and dropped == 3
+
+    _, _, closed_with, remaining = asyncio.run(scenario(OVERFLOW_DISCONNECT))
+    assert closed_with == 1013
+    assert remaining == []
+
+
+def test_flush_then_close():
+    async def scenario():
+        manager = RoomConnectionManager()
+        ws = FakeWebSocket()
+        connection = await manager.connect("room", ws)
+        connection.send({"n": 1})
+        connection.close(code=1008, flush=True)
+        await connection.wait_closed()
+        assert ws.sent == [{"n": 1}]
+        assert ws.closed_with == 1008
+        assert "room" not in manager.room_to_connections
+
+    asyncio.run(scenario())
+
+
+def test_failed_send_evicts_from_registry():
+    async def scenario():
+        manager = RoomConnectionManager()
+        left = []
+        manager.on_user_left = lambda user, session: left.append((user, session))
+        healthy = FakeWebSocket()
+        dead = FakeWebSocket(fail=True)
+        await manager.connect("room", healthy, user_email="a@example.com")
+        await manager.connect("room", dead, user_email="b@example.com")
+        await manager.broadcast("room", {"n": 1})
+        await _settle()
+        assert [c.websocket for c in manager.get_connections("room")] == [healthy]
+        assert left == [("b@example.com", "room")]
+        manager.disconnect("room", healthy)
+        assert manager.room_to_connections == {}
+        assert left[-1] == ("a@example.com", "room")
+
+    asyncio.run(scenario())
+
+
+def test_heartbeat_sweep():
+    async def scenario():
+        manager = RoomConnectionManager(ping_interval=10, ping_timeout=5, idle_timeout=100)
+        quiet, silent, idle = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+        for ws in (quiet, silent, idle):
+            await manager.connect("room", ws)
+        quiet_conn, silent_conn, idle_conn = manager.get_connections("room")
+        start = quiet_conn.last_seen
+
+        # Quiet for one interval: pinged, not evicted
+        assert manager.reap(now=start + 11) == 0
+        await _settle()
+        assert {"type": "ping"} in quiet.sent
+
+        # Quiet answers pings; idle answers pings but never chats; silent never answers
+        quiet_conn.last_seen = quiet_conn.last_activity = start + 101
+        idle_conn.last_seen = start + 101
+        assert manager.reap(now=start + 102) == 2
+        await _settle()
+        assert silent.closed_with == 1001
+        assert idle.closed_with == 1000
+        assert manager.get_connections("room") == [quiet_conn]
+        quiet_conn.cancel()
+
+    asyncio.run(scenario())
+
+
+class FakeProtocol:
+    """The websockets protocol behind a socket; pongs arrive at once, or never"""
+
+    def __init__(self, answers: bool):
+        self.answers = answers
+        self.pings = 0
+
+    async def ping(self):
+        self.pings += 1
+        pong = asyncio.get_running_loop().create_future()
+        if self.answers:
+            pong.set_result(0.001)
+        return pong
+
+
+def test_heartbeat_keeps_clients_without_app_pings():
+    async def scenario():
+        manager = RoomConnectionManager(ping_interval=10, ping_timeout=1, idle_timeout=0)
+        plain, answering, dead = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+        for ws in (plain, answering, dead):
+            await manager.connect("room", ws)
+        plain_conn, answering_conn, dead_conn = manager.get_connections("room")
+        answering_conn.ping_protocol, dead_conn.ping_protocol = FakeProtocol(True), FakeProtocol(False)
+        now = plain_conn.last_seen
+        for connection in (plain_conn, answering_conn, dead_conn):
+            connection.last_seen = now - 10.5
+
+        # None of them reply to {"type": "ping"}
+        assert manager.reap(now=now) == 0
+        await asyncio.sleep(0.1)
+        # A protocol pong counts; without a protocol to ping, a delivered frame does
+        assert answering_conn.last_seen >= now and answering_conn.ping_protocol.pings == 1
+        assert plain_conn.last_seen >= now
+        assert dead_conn.last_seen == now - 10.5
+        assert manager.reap(now=now + 5) == 1
+        await _settle()
+        assert dead.closed_with == 1001 and plain.closed_with is None and answering.closed_with is None
+        for connection in manager.get_connections("room"):
+            connection.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_coalescing_batches_bursts():
+    async def scenario():
+        manager = RoomConnectionManager()
+        batched, plain = FakeWebSocket(), FakeWebSocket()
+        await manager.connect("room", batched, coalesce=True)
+        await manager.connect("room", plain)
+        for i in range(20):
+            await manager.broadcast("room", {"n": i})
+        await asyncio.sleep(0.05)
+        # The burst reaches the coalescing client as one batch, in order
+        assert len(batched.sent) == 1 and batched.sent[0]["type"] == "batch"
+        assert [m["n"] for m in batched.sent[0]["frames"]] == list(range(20))
+        assert [m["n"] for m in plain.sent] == list(range(20))
+
+        # A lone frame is sent as-is, and a flushing close delivers what is pending
+        await manager.broadcast("room", {"n": "solo"})
+        await asyncio.sleep(0.05)
+        assert batched.sent[-1] == {"n": "solo", "seq": 21}
+        connection = next(c for c in manager.get_connections("room") if c.websocket is batched)
+        connection.send({"n": "last"})
+        connection.close(code=1008, flush=True)
+        await connection.wait_closed()
+        assert batched.sent[-1] == {"n": "last"} and batched.closed_with == 1008
+        for c in manager.get_connections("room"):
+            c.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_msgpack_batch_frame():
+    codec = CODECS.get("msgpack")
+    if codec is None:
+        return
+    import msgpack
+    frames = [codec.encode({"type": "text", "message": str(i)}) for i in range(20)]
+    unpacked = msgpack.unpackb(codec.batch(frames), raw=False)
+    assert unpacked["t"] == "batch"
+    assert [f["m"] for f in unpacked["f"]] == [str(i) for i in range(20)]
+
+
+def test_multiplexed_socket_gets_room_tagged_frames():
+    async def scenario():
+        left = []
+        manager = RoomConnectionManager()
+        manager.on_user_left = lambda user, room: left.append((user, room))
+        mux, single = FakeWebSocket(), FakeWebSocket()
+        connection = await manager.connect_multiplexed(mux, user_email="a@example.com")
+        await manager.connect("one", single)
+        await manager.join(connection, "one")
+        await manager.join(connection, "two")
+        assert manager.connection_count() == 2
+
+        await manager.broadcast("one", {"n": 1})
+        await manager.broadcast("two", {"n": 2})
+        await _settle()
+        assert mux.sent == [{"room": "one", "n": 1, "seq": 1}, {"room": "two", "n": 2, "seq": 1}]
+        assert single.sent == [{"n": 1, "seq": 1}]
+
+        # Leaving a room keeps the socket open for the others
+        manager.leave("two", mux)
+        assert left == [("a@example.com", "two")] and not connection.closed
+        await manager.broadcast("two", {"n": 3})
+        await _settle()
+        assert len(mux.sent) == 2
+
+        manager.remove(connection)
+        assert connection.closed and manager.multiplexed == {}
+        assert manager.get_connections("one") != [] and "two" not in manager.room_to_connections
+        for c in manager.get_connections("one"):
+            c.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_reconnect_replays_only_the_gap():
+    async def scenario():
+        manager = RoomConnectionManager()
+        first = FakeWebSocket()
+        connection = await manager.connect("room", first)
+        for i in range(3):
+            await manager.broadcast("room", {"n": i})
+        await _settle()
+        last = first.sent[-1]["seq"]
+        epoch = manager.history.rooms["room"].epoch
+        connection.close()
+
+        # Messages sent while the client was away
+        for i in range(3, 6):
+            await manager.broadcast("room", {"n": i})
+
+        again = FakeWebSocket()
+        connection = await manager.connect("room", again, epoch=epoch, last_seq=last)
+        await manager.broadcast("room", {"n": 6})
+        await _settle()
+        assert connection.resumed
+        assert [(m["seq"], m["n"]) for m in again.sent] == [(4, 3), (5, 4), (6, 5), (7, 6)]
+
+        # A stale epoch or a gap older than the ring can't be filled
+        assert manager.history.replay("room", "other", last) is None
+        manager.history.rooms["room"].messages.popleft()
+        assert manager.history.replay("room", epoch, 0) is None
+        connection.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_message_id_lru():
+    seen = LRUSet(capacity=2)
+    assert seen.add("a") and seen.add("b")
+    assert not seen.add("a")  # duplicate, and now the most recent
+    assert seen.add("c")      # evicts "b"
+    assert "a" in seen and "b" not in seen and len(seen) == 2
+
+
+def test_admission_limits():
+    async def scenario():
+        manager = RoomConnectionManager(max_connections=4, max_per_room=2, max_per_user=2, retry_after=3)
+
+        await manager.connect("room", FakeWebSocket(), user_email="a@example.com")
+        await manager.connect("room", FakeWebSocket(), user_email="b@example.com")
+        turned_away = FakeWebSocket()
+        try:
+            await manager.connect("room", turned_away, user_email="c@example.com")
+            assert False, "room limit not enforced"
+        except ConnectionRejected as e:
+            assert e.limit == "room" and 3 <= e.retry_after <= 6
+            assert json.loads(e.reason) == {"limit": "room", "retry_after": e.retry_after}
+
+        mux = await manager.connect_multiplexed(FakeWebSocket(), user_email="a@example.com")
+        try:
+            await manager.connect("other", FakeWebSocket(), user_email="a@example.com")
+            assert False, "user limit not enforced"
+        except ConnectionRejected as e:
+            assert e.limit == "user"
+        try:
+            await manager.join(mux, "room")
+            assert False, "room limit not enforced on join"
+        except ConnectionRejected:
+            assert "room" not in mux.rooms
+
+        await manager.connect("other", FakeWebSocket(), user_email="d@example.com")
+        try:
+            await manager.connect("third", FakeWebSocket(), user_email="e@example.com")
+            assert False, "global limit not enforced"
+        except ConnectionRejected as e:
+            assert e.limit == "global"
+
+        stats = manager.stats()
+        assert stats["connections"] == 4 and stats["rejected"] == {"room": 2, "user": 1, "global": 1}
+        assert stats["headroom"] == {"global": 0, "room": 0, "user": 0}
+
+        # Slots come back when connections go away
+        mux.close()
+        await _settle()
+        assert manager.connection_count() == 3
+        assert {user: len(c) for user, c in manager.user_to_connections.items()} == {
+            "a@example.com": 1, "b@example.com": 1, "d@example.com": 1}
+        await manager.connect("third", FakeWebSocket(), user_email="e@example.com")
+        for connection in manager.all_connections():
+            connection.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_user_index_targeted_send_and_termination():
+    async def scenario():
+        manager = RoomConnectionManager()
+        phone, laptop, other = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+        await manager.connect("room", phone, user_email="a@example.com")
+        await manager.connect("room", laptop, user_email="a@example.com")
+        await manager.connect("room", other, user_email="b@example.com")
+        mux = await manager.connect_multiplexed(FakeWebSocket(), user_email="a@example.com")
+        await manager.join(mux, "room")
+        await manager.join(mux, "lobby")
+
+        assert manager.send_to_user("a@example.com", {"n": 1}, session_id="lobby") == 1
+        assert manager.send_to_user("a@example.com", {"n": 2}) == 3
+        await _settle()
+        assert phone.sent == [{"n": 2}] and other.sent == []
+        assert mux.websocket.sent == [{"n": 1, "room": "lobby"}, {"n": 2}]
+
+        # Terminating in one room closes the single-room sockets and unsubscribes the multiplexed one
+        assert manager.terminate_user("a@example.com", "room", notice={"terminated": True}) == 3
+        await _settle()
+        assert phone.closed_with == 1008 and laptop.closed_with == 1008 and other.closed_with is None
+        assert phone.sent[-1] == {"terminated": True}
+        assert mux.rooms == {"lobby"} and not mux.closed
+        assert manager.get_connections("room") == [manager.room_to_connections["room"][other]]
+        assert manager.user_connections("a@example.com") == [mux]
+
+        assert manager.terminate_user("a@example.com") == 1
+        await _settle()
+        assert "a@example.com" not in manager.user_to_connections and manager.connection_count() == 1
+        other_connection = manager.get_connections("room")[0]
+        other_connection.cancel()
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Testing RoomConnectionManager")
+    print("=" * 60)
+    for test in (test_broadcast_does_not_wait_for_slow_clients, test_overflow_policies, test_flush_then_close,
+                 test_failed_send_evicts_from_registry, test_heartbeat_sweep,
+                 test_heartbeat_keeps_clients_without_app_pings, test_coalescing_batches_bursts,
+                 test_msgpack_batch_frame, test_multiplexed_socket_gets_room_tagged_frames,
+                 test_reconnect_replays_only_the_gap, test_message_id_lru, test_admission_limits,
+                 test_user_index_targeted_send_and_termination):
+        test()
+        print(f"✅ {test.__name__}")
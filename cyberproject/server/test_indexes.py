@@ -0,0 +1,102 @@
+"""
+Test script for the MongoDB index registry and query-plan checks.
+
+Without a database every query shape is checked against the registry by a
+prefix-matching stand-in for the planner. Point MONGODB_TEST_URL at a local
+mongod (e.g. mongodb://localhost:27017) to also run each shape through
+explain() on a scratch database and fail on any collection scan.
+"""
+
+import os
+import sys
+import asyncio
+
+import pytest
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import IndexModel
+
+from server.indexes import INDEXES, QUERY_SHAPES, QueryShape, matching_index, plan_stages, uses_index, \
+    index_specs, unindexed_queries
+from server.message_store import MongoMessageStore, BucketedMessageStore
+from server.storage import STORAGE_COLLECTIONS
+
+MONGODB_TEST_URL = os.getenv("MONGODB_TEST_URL", "")
+
+
+def test_every_registered_index_is_created_at_startup():
+    # Startup applies the storage backend's collections and the message store's; anything
+    # else in the registry would satisfy the checks below without ever existing
+    applied = set(STORAGE_COLLECTIONS) | {MongoMessageStore.collection_name, BucketedMessageStore.collection_name}
+    assert set(INDEXES) <= applied, f"Never created: {sorted(set(INDEXES) - applied)}"
+
+
+def test_every_query_shape_has_an_index():
+    unindexed = [f"{shape.collection}: {shape.name}" for shape in QUERY_SHAPES if matching_index(shape) is None]
+    assert not unindexed, f"Queries that would scan their collection: {unindexed}"
+    # Lookups that used to scan, or filter past the index, as the collections grew
+    shapes = {shape.name: shape for shape in QUERY_SHAPES}
+    assert matching_index(shapes["MongoStorage.put_temp_password / pop_temp_password"]) == "email_1"
+    assert matching_index(shapes["MongoStorage.get_verification_token"]) == "token_1"
+    assert matching_index(shapes["MongoStorage.otp_window"]) == "email_1_purpose_1_created_at_1"
+    # Every registered collection is queried somewhere
+    assert set(INDEXES) == {shape.collection for shape in QUERY_SHAPES}
+
+
+def test_stand_in_spots_missing_indexes():
+    shape = QueryShape("temp_passwords", "lookup", {"email": "a@example.com"})
+    assert matching_index(shape, []) is None
+    assert matching_index(shape, [IndexModel("expires_at", expireAfterSeconds=0)]) is None
+    # An index on a later key doesn't help without its leading key in the filter
+    assert matching_index(QueryShape("otps", "lookup", {"purpose": "signup"}),
+                          [IndexModel([("email", 1), ("purpose", 1)])]) is None
+
+
+def test_plan_stages_from_explain_output():
+    indexed = {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}}
+    scanned = {"queryPlanner": {"winningPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}}}
+    # Slot-based engine output, and an $or planned per branch
+    nested = {"queryPlanner": {"winningPlan": {"queryPlan": {"stage": "FETCH", "inputStage": {
+        "stage": "OR", "inputStages": [{"stage": "IXSCAN"}, {"stage": "IXSCAN"}]}}}}}
+    mixed = {"queryPlanner": {"winningPlan": {"stage": "OR", "inputStages": [{"stage": "IXSCAN"},
+                                                                               {"stage": "COLLSCAN"}]}}}
+    assert plan_stages(indexed) == ["FETCH", "IXSCAN"] and uses_index(indexed)
+    assert not uses_index(scanned) and uses_index(nested) and not uses_index(mixed)
+
+
+def test_query_plans_on_mongod():
+    if not MONGODB_TEST_URL:
+        pytest.skip("MONGODB_TEST_URL not set; explain() checks need a mongod")
+
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from server.db import ensure_indexes
+
+    async def scenario():
+        client = AsyncIOMotorClient(MONGODB_TEST_URL, serverSelectionTimeoutMS=2000)
+        database = client["chat_app_index_check"]
+        try:
+            await ensure_indexes(index_specs(database))
+            failures = await unindexed_queries(database)
+            assert not failures, "Collection scans:\n" + "\n".join(failures)
+        finally:
+            await client.drop_database(database.name)
+            client.close()
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Testing MongoDB indexes")
+    print("=" * 60)
+    for test in (test_every_registered_index_is_created_at_startup, test_every_query_shape_has_an_index,
+                 test_stand_in_spots_missing_indexes, test_plan_stages_from_explain_output,
+                 test_query_plans_on_mongod):
+        try:
+            test()
+        except pytest.skip.Exception as e:
+            print(f"⏭️  {test.__name__}: {e.msg}")
+            continue
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,526 @@
+"""
+Test script for write-behind message persistence (no database required)
+"""
+
+import os
+import sys
+import gzip
+import json
+import base64
+import asyncio
+from datetime import datetime, timedelta
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo.errors import AutoReconnect
+
+from server.circuit_breaker import CircuitBreaker, Unavailable
+from server.message_store import (MessageWriter, MongoMessageStore, BucketedMessageStore, GuardedMessageStore,
+                                  message_document, merge_buckets, to_millis, ensure_indexes_when_available)
+from server.sessions import SessionRegistry
+from server.storage import MemoryStorage
+
+
+class FakeStore:
+    """Records batches; can be made slow or failing"""
+
+    def __init__(self, delay: float = 0.0, failures: int = 0):
+        self.delay = delay
+        self.failures = failures
+        self.batches = []
+
+    async def write(self, documents):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("database unavailable")
+        self.batches.append(list(documents))
+
+
+def test_batches_on_size_and_time():
+    async def scenario():
+        sink = FakeStore()
+        writer = MessageWriter(sink, batch_size=10, interval_ms=50)
+        writer.start()
+        for n in range(10):
+            await writer.append({"n": n})
+        await asyncio.sleep(0.01)
+        # A full batch goes out at once
+        assert [len(b) for b in sink.batches] == [10]
+        for n in range(10, 15):
+            await writer.append({"n": n})
+        await asyncio.sleep(0.01)
+        assert [len(b) for b in sink.batches] == [10]
+        # The remainder waits for the interval
+        await asyncio.sleep(0.1)
+        assert [len(b) for b in sink.batches] == [10, 5]
+        assert [d["n"] for b in sink.batches for d in b] == list(range(15))
+        assert writer.written == 15
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+
+def test_backpressure_then_drop_oldest():
+    async def scenario():
+        # Slow database: a full buffer makes append() wait for the writer
+        sink = FakeStore(delay=0.05)
+        writer = MessageWriter(sink, batch_size=2, interval_ms=1, max_buffer=4, backpressure_timeout=1)
+        writer.start()
+        for n in range(12):
+            await writer.append({"n": n})
+        await writer.stop()
+        assert writer.stalls > 0 and writer.dropped == 0
+        assert [d["n"] for b in sink.batches for d in b] == list(range(12))
+
+        # Dead database: the oldest unsaved messages give way instead of blocking chat
+        sink = FakeStore(failures=1000)
+        writer = MessageWriter(sink, batch_size=2, interval_ms=1, max_buffer=4, backpressure_timeout=0.01)
+        writer.start()
+        for n in range(10):
+            await writer.append({"n": n})
+        assert len(writer.buffer) <= 4 and writer.dropped >= 6
+        assert writer.buffer[-1] == {"n": 9}
+        await writer.stop(timeout=0.1)
+
+    asyncio.run(scenario())
+
+
+def test_failed_batch_is_retried_and_flushed_on_shutdown():
+    async def scenario():
+        sink = FakeStore(failures=1)
+        writer = MessageWriter(sink, batch_size=100, interval_ms=1)
+        writer.start()
+        await writer.append({"n": 1})
+        await asyncio.sleep(0.02)
+        assert writer.failed_batches == 1 and writer.buffer == [{"n": 1}]
+        # Stopping before the retry is due still saves everything buffered
+        await writer.append({"n": 2})
+        await writer.stop()
+        assert sink.batches == [[{"n": 1}, {"n": 2}]] and not writer.buffer
+
+    asyncio.run(scenario())
+
+
+def test_store_started_during_an_outage_catches_up():
+    class DownStore(FakeStore):
+        def __init__(self):
+            super().__init__(failures=2)
+            self.index_attempts = 0
+
+        async def ensure_indexes(self):
+            self.index_attempts += 1
+            if self.index_attempts < 3:
+                raise ConnectionError("database unavailable")
+
+    async def scenario():
+        store = DownStore()
+        indexes = asyncio.create_task(ensure_indexes_when_available(store, delay=0.01))
+        writer = MessageWriter(store, batch_size=100, interval_ms=1)
+        writer.start()
+        await writer.append({"n": 1})
+        await asyncio.sleep(0.05)
+        assert indexes.done() and store.index_attempts == 3
+        assert writer.failed_batches >= 1 and not store.batches
+        # The writer keeps retrying; once the database is back the buffered messages are saved
+        await asyncio.sleep(2)
+        assert store.batches == [[{"n": 1}]] and not writer.buffer
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+
+def test_open_breaker_fails_fast_and_buffers():
+    class HangingStore(FakeStore):
+        """Like Motor during an outage: every call waits out server selection"""
+
+        def __init__(self):
+            super().__init__()
+            self.calls = 0
+            self.down = True
+
+        async def _wait(self):
+            self.calls += 1
+            if self.down:
+                await asyncio.sleep(30)
+
+        async def ensure_indexes(self):
+            await self._wait()
+
+        async def write(self, documents):
+            await self._wait()
+            self.batches.append(list(documents))
+
+        async def history(self, room, before=None, limit=50):
+            await self._wait()
+            yield {"message": "m"}
+
+    async def scenario():
+        store = HangingStore()
+        probe_ok = asyncio.Event()
+
+        async def probe():
+            if not probe_ok.is_set():
+                raise ConnectionError("database unavailable")
+
+        breaker = CircuitBreaker(probe, failure_threshold=1, call_timeout=0.05, probe_interval=0.05)
+        guarded = GuardedMessageStore(store, breaker)
+        writer = MessageWriter(guarded, batch_size=100, interval_ms=1)
+        writer.start()
+        await writer.append({"n": 1})
+        await asyncio.sleep(0.1)
+        # One call waited out the call timeout and opened the breaker; nothing else reached the driver
+        assert breaker.is_open and store.calls == 1 and writer.buffer == [{"n": 1}]
+        started = asyncio.get_running_loop().time()
+        # The shutdown flush included
+        for call in (guarded.ensure_indexes(), guarded.history("room").__anext__(), writer.flush()):
+            try:
+                await call
+            except Unavailable:
+                pass
+        assert asyncio.get_running_loop().time() - started < 0.05
+        assert store.calls == 1 and writer.buffer == [{"n": 1}]
+
+        # Back up: the breaker closes and the writer's next retry saves the buffered message
+        store.down = False
+        probe_ok.set()
+        await asyncio.sleep(0.1)
+        assert not breaker.is_open
+        assert [message async for message in guarded.history("room")] == [{"message": "m"}]
+        await asyncio.sleep(0.6)
+        assert store.batches == [[{"n": 1}]]
+        await writer.stop()
+        await breaker.stop()
+
+    asyncio.run(scenario())
+
+
+def test_message_document():
+    document = message_document("room", {"user": "a@example.com", "message": "abc=", "encrypted": True,
+                                         "timestamp": "2025-01-01T00:00:05", "msg_id": "m1", "seq": 7})
+    assert document["room"] == "room" and document["msg_id"] == "m1" and "seq" not in document
+    assert document["timestamp"].isoformat() == "2025-01-01T00:00:05"
+
+
+def evaluate(expression, document, this=None):
+    """The aggregation expressions bucket_update uses; "$a.b" over an array gives each element's b"""
+    if isinstance(expression, str) and expression.startswith("$"):
+        value, path = (this, expression[7:]) if expression.startswith("$$this.") else (document, expression[1:])
+        for field in path.split("."):
+            if isinstance(value, list):
+                value = [item[field] for item in value if field in item]
+            else:
+                value = value.get(field) if isinstance(value, dict) else None
+        return value
+    if isinstance(expression, list):
+        return [evaluate(item, document, this) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    (operator, args), = expression.items()
+    if operator == "$literal":
+        return args
+    if operator == "$filter":
+        return [item for item in evaluate(args["input"], document, this)
+                if evaluate(args["cond"], document, item)]
+    values = evaluate(args, document, this)
+    return {
+        "$ifNull": lambda: values[1] if values[0] is None else values[0],
+        "$concatArrays": lambda: [item for array in values for item in array],
+        "$not": lambda: not values[0],
+        "$in": lambda: values[0] in values[1],
+        "$size": lambda: len(values),
+        "$min": lambda: min(values),
+        "$max": lambda: max(values),
+    }[operator]()
+
+
+class FakeBucketCollection:
+    """Just enough of a Motor collection for history reads: find(start <= t).sort(end desc)"""
+
+    def __init__(self, fail_after: int = None):
+        self.buckets = {}
+        self.fetched = 0
+        # Lose the connection after applying this many updates of the next bulk_write
+        self.fail_after = fail_after
+
+    def add(self, bucket_id, room, entries):
+        # What the $setOnInsert / $push / $inc / $min / $max upsert does
+        bucket = self.buckets.setdefault(bucket_id, {"_id": bucket_id, "room": room, "messages": [], "count": 0})
+        bucket["messages"].extend(entries)
+        bucket["count"] += len(entries)
+        timestamps = [entry["ts"] for entry in bucket["messages"]]
+        bucket["start"], bucket["end"] = min(timestamps), max(timestamps)
+
+    async def bulk_write(self, operations, ordered=True):
+        for index, operation in enumerate(operations):
+            if index == self.fail_after:
+                self.fail_after = None
+                raise AutoReconnect("connection reset")
+            # Upserts of an update pipeline, run the way mongod evaluates bucket_update's operators
+            bucket_id = operation._filter["_id"]
+            bucket = dict(self.buckets.get(bucket_id, {"_id": bucket_id}))
+            for stage in operation._doc:
+                bucket.update({field: evaluate(expression, bucket) for field, expression in stage["$set"].items()})
+            self.buckets[bucket_id] = bucket
+
+    def find(self, query):
+        collection = self
+
+        class Cursor:
+            def sort(self, key, direction):
+                self.items = sorted((b for b in collection.buckets.values() if b["room"] == query["room"]
+                                     and ("start" not in query or b["start"] <= query["start"]["$lte"])),
+                                    key=lambda b: b[key], reverse=direction < 0)
+                return self
+
+            def batch_size(self, size):
+                return self
+
+            async def __aiter__(self):
+                for bucket in self.items:
+                    collection.fetched += 1
+                    yield bucket
+
+        return Cursor()
+
+
+async def _collect(iterator):
+    return [item async for item in iterator]
+
+
+def test_buckets_fill_by_size_and_span():
+    store = BucketedMessageStore(None, bucket_size=3, bucket_span=60)
+    start = datetime(2025, 1, 1)
+    documents = [message_document(room, {"user": "a@example.com", "encrypted": True,
+                                         "message": base64.b64encode(b"secret %d" % n).decode(),
+                                         "timestamp": (start + timedelta(seconds=n)).isoformat()})
+                 for n in range(5) for room in ("r1", "r2")]
+    documents.append(message_document("r1", {"user": "a@example.com", "message": "late", "encrypted": False,
+                                             "timestamp": (start + timedelta(seconds=300)).isoformat()}))
+    plan = store.plan(documents)
+    # r1: 3 + 2 messages, then a new bucket once the span is exceeded; r2: 3 + 2
+    assert [(room, len(entries)) for _, room, entries in plan] == [
+        ("r1", 3), ("r2", 3), ("r1", 2), ("r2", 2), ("r1", 1)]
+    entry = plan[0][2][0]
+    assert bytes(entry["m"]) == b"secret 0" and "c" not in entry and entry["u"] == "a@example.com"
+    assert plan[-1][2][0]["m"] == "late" and plan[-1][2][0]["c"] is False
+
+
+def test_retried_bucket_batch_is_not_saved_twice():
+    async def scenario():
+        collection = FakeBucketCollection(fail_after=1)
+        store = BucketedMessageStore(collection, bucket_size=3)
+        writer = MessageWriter(store, batch_size=100)
+        start = datetime(2025, 1, 1)
+        for n in range(5):
+            writer.buffer.append(message_document("room", {
+                "user": "u", "message": "m%d" % n, "encrypted": False, "msg_id": str(n),
+                "timestamp": (start + timedelta(seconds=n)).isoformat()}))
+        # The first bucket is saved, then the connection drops before the second
+        try:
+            await writer.flush()
+        except AutoReconnect:
+            pass
+        assert writer.failed_batches == 1 and len(writer.buffer) == 5 and len(collection.buckets) == 1
+        await writer.flush()
+        assert not writer.buffer and writer.written == 5
+        assert sorted(bucket["count"] for bucket in collection.buckets.values()) == [2, 3]
+        assert store.open_buckets["room"][1] == 2
+        history = await _collect(store.history("room", limit=10))
+        assert [m["msg_id"] for m in history] == ["4", "3", "2", "1", "0"]
+        exported = await _collect(store.export("room"))
+        assert [m["msg_id"] for m in exported] == ["0", "1", "2", "3", "4"]
+
+    asyncio.run(scenario())
+
+
+def test_partly_saved_bucket_retry_keeps_the_new_messages():
+    async def scenario():
+        collection = FakeBucketCollection()
+        store = BucketedMessageStore(collection, bucket_size=5)
+        writer = MessageWriter(store, batch_size=100)
+        start = datetime(2025, 1, 1)
+
+        def message(n):
+            return message_document("room", {"user": "$messages" if n == 1 else "u", "message": "m%d" % n,
+                                             "encrypted": False, "msg_id": str(n),
+                                             "timestamp": (start + timedelta(seconds=n)).isoformat()})
+
+        writer.buffer += [message(0), message(1)]
+        # Saved, but the reply is lost: the writer puts the batch back
+        original_write = collection.bulk_write
+
+        async def saved_then_disconnected(operations, ordered=True):
+            await original_write(operations, ordered)
+            raise AutoReconnect("connection reset")
+
+        collection.bulk_write = saved_then_disconnected
+        try:
+            await writer.flush()
+        except AutoReconnect:
+            pass
+        collection.bulk_write = original_write
+        assert len(writer.buffer) == 2
+        # The retry shares its bucket with messages that were never saved
+        writer.buffer += [message(2), message(3)]
+        await writer.flush()
+        bucket, = collection.buckets.values()
+        assert [entry["i"] for entry in bucket["messages"]] == ["0", "1", "2", "3"] and bucket["count"] == 4
+        assert bucket["start"] == start and bucket["end"] == start + timedelta(seconds=3)
+        assert bucket["messages"][1]["u"] == "$messages"
+        history = await _collect(store.history("room", limit=10))
+        assert [m["msg_id"] for m in history] == ["3", "2", "1", "0"]
+
+    asyncio.run(scenario())
+
+
+def test_bucket_history_pages_newest_first():
+    async def scenario():
+        collection = FakeBucketCollection()
+        store = BucketedMessageStore(collection, bucket_size=4, bucket_span=3600)
+        start = datetime(2025, 1, 1)
+        # Two workers filling their own buckets: interleaved, overlapping in time
+        workers = [BucketedMessageStore(None, bucket_size=4), BucketedMessageStore(None, bucket_size=4)]
+        for n in range(20):
+            document = message_document("room", {"user": "u", "message": base64.b64encode(b"%d" % n).decode(),
+                                                 "encrypted": True, "msg_id": str(n),
+                                                 "timestamp": (start + timedelta(seconds=n)).isoformat()})
+            for bucket_id, room, entries in workers[n % 2].plan([document]):
+                collection.add(bucket_id, room, entries)
+
+        page = await _collect(store.history("room", limit=5))
+        assert [m["msg_id"] for m in page] == ["19", "18", "17", "16", "15"]
+        assert base64.b64decode(page[0]["message"]) == b"19" and page[0]["encrypted"] is True
+        assert collection.fetched <= 4  # only the newest buckets were read
+
+        seen = [m["msg_id"] for m in page]
+        while page:
+            page = await _collect(store.history("room", before=page[-1]["cursor"], limit=5))
+            seen += [m["msg_id"] for m in page]
+        assert seen == [str(n) for n in range(19, -1, -1)]
+
+    asyncio.run(scenario())
+
+
+def test_merge_buckets_waits_for_overlapping_buckets():
+    async def scenario():
+        t = lambda s: datetime(2025, 1, 1) + timedelta(seconds=s)
+
+        async def buckets():
+            # Sorted by end: the second bucket still holds messages newer than most of the first
+            yield {"_id": "b", "end": t(10), "messages": [{"ts": t(1)}, {"ts": t(10)}]}
+            yield {"_id": "a", "end": t(9), "messages": [{"ts": t(2)}, {"ts": t(9)}]}
+
+        keys = [key for key, _ in await _collect(merge_buckets(buckets(), None, 10))]
+        assert [key[0] for key in keys] == [to_millis(t(s)) for s in (10, 9, 2, 1)]
+
+    asyncio.run(scenario())
+
+
+def test_history_endpoint_pages_with_cursor():
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from server.chat import router
+
+    collection = FakeBucketCollection()
+    writer = BucketedMessageStore(None, bucket_size=3)
+    start = datetime(2025, 1, 1)
+    for n in range(7):
+        document = message_document("room", {"user": "u", "message": base64.b64encode(b"%d" % n).decode(),
+                                             "encrypted": True, "msg_id": str(n),
+                                             "timestamp": (start + timedelta(seconds=n)).isoformat()})
+        for bucket_id, room, entries in writer.plan([document]):
+            collection.add(bucket_id, room, entries)
+
+    app = FastAPI()
+    app.include_router(router, prefix="/chat")
+    users = {"good": "a@example.com", "other": "b@example.com"}
+    app.state.verify_token = users.get
+    app.state.sessions = SessionRegistry(MemoryStorage())
+    app.state.message_store = BucketedMessageStore(collection, bucket_size=3)
+    client = TestClient(app)
+    asyncio.run(app.state.sessions.create("room", {"created_by": "c@example.com", "members": ["a@example.com"]}))
+
+    assert client.get("/chat/history", params={"room": "room", "token": "bad"}).status_code == 401
+    assert client.get("/chat/history", params={"room": "nope", "token": "good"}).status_code == 404
+    assert client.get("/chat/history", params={"room": "room", "token": "other"}).status_code == 403
+    assert client.get("/chat/history", params={"room": "room", "token": "good", "before": "x"}).status_code == 400
+    seen, before = [], None
+    while True:
+        params = {"room": "room", "token": "good", "limit": 3}
+        if before:
+            params["before"] = before
+        page = client.get("/chat/history", params=params).json()
+        seen += [m["msg_id"] for m in page["messages"]]
+        before = page["next"]
+        if before is None:
+            break
+    assert seen == ["6", "5", "4", "3", "2", "1", "0"]
+
+    # A cursor whose id part isn't an ObjectId is the client's mistake, not an outage
+    app.state.message_store = MongoMessageStore(None)
+    for before in ("123-zzz", "123-" + "0" * 23, "x-1"):
+        response = client.get("/chat/history", params={"room": "room", "token": "good", "before": before})
+        assert response.status_code == 400, (before, response.status_code)
+
+
+def test_transcript_export_streams_oldest_first():
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from server.chat import router
+
+    collection = FakeBucketCollection()
+    start = datetime(2025, 1, 1)
+    # Two workers' buckets overlapping in time
+    workers = [BucketedMessageStore(None, bucket_size=5), BucketedMessageStore(None, bucket_size=5)]
+    for n in range(30):
+        document = message_document("room", {"user": "u", "message": base64.b64encode(b"%d" % n).decode(),
+                                             "encrypted": True, "msg_id": str(n),
+                                             "timestamp": (start + timedelta(seconds=n)).isoformat()})
+        for bucket_id, room, entries in workers[n % 2].plan([document]):
+            collection.add(bucket_id, room, entries)
+
+    app = FastAPI()
+    app.include_router(router, prefix="/chat")
+    users = {"good": "a@example.com", "other": "b@example.com"}
+    app.state.verify_token = users.get
+    app.state.decrypt_message = lambda ciphertext: base64.b64decode(ciphertext).decode()
+    app.state.sessions = SessionRegistry(MemoryStorage())
+    app.state.message_store = BucketedMessageStore(collection, bucket_size=5)
+    client = TestClient(app)
+    asyncio.run(app.state.sessions.create("room", {"created_by": "a@example.com"}))
+
+    assert client.get("/chat/export", params={"room": "room", "token": "bad"}).status_code == 401
+    assert client.get("/chat/export", params={"room": "nope", "token": "good"}).status_code == 404
+    # Refused before anything is read or decrypted
+    assert client.get("/chat/export", params={"room": "room", "token": "other", "decrypt": 1}).status_code == 403
+    response = client.get("/chat/export", params={"room": "room", "token": "good", "batch_size": 5})
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [m["msg_id"] for m in lines] == [str(n) for n in range(30)]
+    assert lines[0]["encrypted"] is True and "cursor" not in lines[0]
+
+    response = client.get("/chat/export", params={"room": "room", "token": "good", "gzip": 1, "decrypt": 1})
+    assert response.headers["content-disposition"] == 'attachment; filename="transcript-room.ndjson.gz"'
+    lines = [json.loads(line) for line in gzip.decompress(response.content).decode().splitlines()]
+    assert [m["message"] for m in lines] == [str(n) for n in range(30)]
+    assert lines[0]["encrypted"] is False
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Testing message persistence")
+    print("=" * 60)
+    for test in (test_batches_on_size_and_time, test_backpressure_then_drop_oldest,
+                 test_failed_batch_is_retried_and_flushed_on_shutdown, test_store_started_during_an_outage_catches_up,
+                 test_open_breaker_fails_fast_and_buffers,
+                 test_message_document,
+                 test_buckets_fill_by_size_and_span, test_retried_bucket_batch_is_not_saved_twice,
+                 test_partly_saved_bucket_retry_keeps_the_new_messages,
+                 test_bucket_history_pages_newest_first,
+                 test_merge_buckets_waits_for_overlapping_buckets, test_history_endpoint_pages_with_cursor,
+                 test_transcript_export_streams_oldest_first):
+        test()
+        print(f"✅ {test.__name__}")
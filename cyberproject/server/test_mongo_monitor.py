@@ -0,0 +1,107 @@
+"""
+Test script for the per-route MongoDB command monitor (no database server required)
+"""
+
+import os
+import sys
+import asyncio
+from datetime import timedelta
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import FastAPI, WebSocket
+from fastapi.testclient import TestClient
+from motor.frameworks.asyncio import run_on_executor
+from pymongo.monitoring import CommandStartedEvent, CommandSucceededEvent, CommandFailedEvent
+
+from server.mongo_monitor import CommandMonitor, CommandRouteMiddleware, current_route
+
+ADDRESS = ("localhost", 27017)
+
+
+def send_command(monitor, request_id, command, ms, reply=None):
+    """What the driver reports for one command: started, then succeeded (or failed without a reply)"""
+    name = next(iter(command))
+    monitor.started(CommandStartedEvent(command, "chat_app", request_id, ADDRESS, request_id))
+    if reply is None:
+        monitor.failed(CommandFailedEvent(timedelta(milliseconds=ms), {"ok": 0}, name, request_id, ADDRESS,
+                                          request_id))
+    else:
+        monitor.succeeded(CommandSucceededEvent(timedelta(milliseconds=ms), reply, name, request_id, ADDRESS,
+                                                request_id))
+
+
+def test_commands_are_grouped_by_route_and_collection():
+    monitor = CommandMonitor(slow_ms=50)
+    token = current_route.set("POST /signup")
+    send_command(monitor, 1, {"insert": "users", "documents": [{"email": "a@example.com"}]}, 3, {"ok": 1, "n": 1})
+    send_command(monitor, 2, {"insert": "users", "documents": [{"email": "b@example.com"}]}, 120, {"ok": 1, "n": 1})
+    send_command(monitor, 3, {"insert": "users", "documents": []}, 1, reply=None)
+    current_route.reset(token)
+    # Outside any request (startup, background tasks)
+    send_command(monitor, 4, {"ping": 1}, 0.5, {"ok": 1})
+    send_command(monitor, 5, {"getMore": 7, "collection": "messages"}, 2, {"ok": 1})
+
+    routes = monitor.snapshot()["routes"]
+    inserts = routes["POST /signup"]["by_command"]["users.insert"]
+    assert inserts["count"] == 3 and inserts["failures"] == 1 and inserts["max_ms"] == 120
+    assert inserts["histogram_ms"]["1"] == 1 and inserts["histogram_ms"]["5"] == 1
+    assert inserts["histogram_ms"]["250"] == 1 and sum(inserts["histogram_ms"].values()) == 3
+    assert inserts["request_bytes"] > 0 and inserts["reply_bytes"] > 0
+    assert set(routes["background"]["by_command"]) == {"-.ping", "messages.getMore"}
+    assert monitor.snapshot()["slow_commands"] == 1
+
+    # A reply without a matching start (listener registered mid-command) is ignored
+    monitor.succeeded(CommandSucceededEvent(timedelta(milliseconds=1), {"ok": 1}, "find", 99, ADDRESS, 99))
+    assert monitor.snapshot()["routes"]["background"]["commands"] == 2
+    monitor.reset()
+    assert monitor.snapshot()["routes"] == {}
+
+
+def test_route_follows_commands_into_driver_threads():
+    monitor = CommandMonitor(slow_ms=0)
+    app = FastAPI()
+    app.add_middleware(CommandRouteMiddleware, router=app.router, monitor=monitor)
+    request_ids = iter(range(1, 1000))
+
+    async def motor_command(command):
+        # Motor runs pymongo on its executor; the listener fires on that thread
+        await run_on_executor(asyncio.get_running_loop(), send_command, monitor, next(request_ids), command, 1,
+                              {"ok": 1})
+
+    @app.get("/sessions/{session_id}")
+    async def get_session(session_id: str):
+        # An N+1 loop: one find per message instead of one for all of them
+        for _ in range(3):
+            await motor_command({"find": "messages", "filter": {"room": session_id}})
+        return {}
+
+    @app.websocket("/ws/{session_id}")
+    async def websocket_endpoint(websocket: WebSocket, session_id: str):
+        await websocket.accept()
+        await motor_command({"find": "sessions", "filter": {"session_id": session_id}})
+        await websocket.close()
+
+    client = TestClient(app)
+    for session_id in ("s1", "s2"):
+        assert client.get(f"/sessions/{session_id}").status_code == 200
+    with client.websocket_connect("/ws/s1"):
+        pass
+    client.get("/nowhere")
+
+    routes = monitor.snapshot()["routes"]
+    # Route templates, not raw paths, so ids don't split the metrics
+    assert routes["GET /sessions/{session_id}"]["requests"] == 2
+    assert routes["GET /sessions/{session_id}"]["commands_per_request"] == 3
+    assert routes["WS /ws/{session_id}"]["by_command"]["sessions.find"]["count"] == 1
+    assert "GET unmatched" not in routes and monitor.requests["GET unmatched"] == 1
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Testing MongoDB command monitoring")
+    print("=" * 60)
+    for test in (test_commands_are_grouped_by_route_and_collection, test_route_follows_commands_into_driver_threads):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,156 @@
+"""
+Test script for cross-worker room fan-out (no Redis required).
+The Redis backend is exercised against a tiny in-process RESP stand-in.
+"""
+
+import os
+import sys
+import json
+import asyncio
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.connection_manager import RoomConnectionManager
+from server.pubsub import PubSubBackend, InProcessHub, InProcessPubSub, RedisPubSub, _read_reply, _encode_command
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data):
+        self.sent.append(json.loads(data))
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+class RespPubSubStandIn:
+    """Just enough of a Redis server for SUBSCRIBE / UNSUBSCRIBE / PUBLISH"""
+
+    def __init__(self):
+        self.channels = {}
+        self.server = None
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._client, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _client(self, reader, writer):
+        try:
+            while True:
+                command = await _read_reply(reader)
+                name = command[0].upper()
+                if name == b"PUBLISH":
+                    receivers = list(self.channels.get(command[1], ()))
+                    for subscriber in receivers:
+                        subscriber.write(_encode_command("message", command[1], command[2]))
+                    writer.write(b":%d\r\n" % len(receivers))
+                elif name in (b"SUBSCRIBE", b"UNSUBSCRIBE"):
+                    for channel in command[1:]:
+                        subscribers = self.channels.setdefault(channel, set())
+                        if name == b"SUBSCRIBE":
+                            subscribers.add(writer)
+                        else:
+                            subscribers.discard(writer)
+                        # Confirmation: [kind, channel, count]; the count isn't checked by the client
+                        writer.write(_encode_command(name.lower(), channel, b"1"))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, IndexError, TypeError):
+            pass
+        finally:
+            for subscribers in self.channels.values():
+                subscribers.discard(writer)
+            writer.close()
+
+
+async def _wait_for(predicate, timeout: float = 2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        if loop.time() > deadline:
+            raise AssertionError("timed out waiting for delivery")
+        await asyncio.sleep(0.01)
+
+
+async def _two_workers(worker_a: RoomConnectionManager, worker_b: RoomConnectionManager):
+    alice, bob, carol = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+    await worker_a.connect("room", alice)
+    await worker_b.connect("room", bob)
+    await worker_b.connect("other", carol)
+    await asyncio.sleep(0.05)
+
+    await worker_a.broadcast("room", {"message": "hi from a"})
+    await worker_b.broadcast("room", {"message": "hi from b"})
+    await _wait_for(lambda: len(alice.sent) == 2 and len(bob.sent) == 2)
+    await asyncio.sleep(0.05)
+
+    # Each worker delivers exactly once, and only to the room's sockets
+    assert [m["message"] for m in alice.sent] == ["hi from a", "hi from b"]
+    assert sorted(m["message"] for m in bob.sent) == ["hi from a", "hi from b"]
+    assert carol.sent == []
+
+
+def test_in_process_hub():
+    async def scenario():
+        hub = InProcessHub()
+        worker_a = RoomConnectionManager(pubsub=InProcessPubSub(hub))
+        worker_b = RoomConnectionManager(pubsub=InProcessPubSub(hub))
+        await worker_a.start()
+        await worker_b.start()
+        await _two_workers(worker_a, worker_b)
+        await worker_a.stop()
+        await worker_b.stop()
+        assert hub.subscribers == {}
+
+    asyncio.run(scenario())
+
+
+def test_redis_protocol_backend():
+    async def scenario():
+        stand_in = RespPubSubStandIn()
+        port = await stand_in.start()
+        url = f"redis://127.0.0.1:{port}/0"
+        backend_a, backend_b = RedisPubSub(url), RedisPubSub(url)
+        worker_a = RoomConnectionManager(pubsub=backend_a)
+        worker_b = RoomConnectionManager(pubsub=backend_b)
+        await worker_a.start()
+        await worker_b.start()
+        await backend_a.wait_ready()
+        await backend_b.wait_ready()
+        await _two_workers(worker_a, worker_b)
+        await worker_a.stop()
+        await worker_b.stop()
+        await stand_in.stop()
+
+    asyncio.run(scenario())
+
+
+def test_incomplete_backend_fails_at_construction():
+    class PublishOnly(PubSubBackend):
+        async def publish(self, room, frame):
+            pass
+
+    try:
+        PublishOnly()
+    except TypeError as e:
+        assert "subscribe" in str(e) and "unsubscribe" in str(e)
+    else:
+        raise AssertionError("a backend without subscribe / unsubscribe was created")
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Testing room pub/sub backends")
+    print("=" * 60)
+    for test in (test_in_process_hub, test_redis_protocol_backend, test_incomplete_backend_fails_at_construction):
+        test()
+        print(f"✅ {test.__name__}")
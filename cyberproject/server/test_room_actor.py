@@ -0,0 +1,105 @@
+"""
+Test script for the per-room actor pipeline (no server required)
+"""
+
+import os
+import sys
+import random
+import asyncio
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.room_actor import RoomActor, RoomActorRegistry
+
+
+def test_concurrent_processing_ordered_delivery():
+    async def scenario():
+        running, peak, delivered = 0, 0, []
+
+        async def process(seq, item):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            # Later messages often finish first
+            await asyncio.sleep(random.uniform(0, 0.02))
+            running -= 1
+            return item.upper()
+
+        async def deliver(seq, item, result):
+            delivered.append((seq, result))
+
+        actor = RoomActor("room", process, deliver, concurrency=4)
+        actor.start()
+        senders = [[f"{name}{i}" for i in range(10)] for name in "abc"]
+        for batch in zip(*senders):
+            for item in batch:
+                await actor.submit(item)
+        while actor.delivered < 30:
+            await asyncio.sleep(0.01)
+
+        arrival = [item.upper() for batch in zip(*senders) for item in batch]
+        assert delivered == list(enumerate(arrival))
+        assert 1 < peak <= 4, peak
+        await actor.stop()
+
+    asyncio.run(scenario())
+
+
+def test_failed_message_does_not_stall_the_room():
+    async def scenario():
+        delivered = []
+
+        async def process(seq, item):
+            if item == "bad":
+                raise ValueError("analysis failed")
+            return item
+
+        async def deliver(seq, item, result):
+            delivered.append(result)
+
+        actor = RoomActor("room", process, deliver)
+        actor.start()
+        for item in ("one", "bad", "two"):
+            await actor.submit(item)
+        while actor.delivered < 3:
+            await asyncio.sleep(0.01)
+        assert delivered == ["one", "two"]
+        await actor.stop()
+
+    asyncio.run(scenario())
+
+
+def test_idle_actors_are_released():
+    async def scenario():
+        delivered = []
+
+        async def process(seq, item):
+            return item
+
+        async def deliver(seq, item, result):
+            delivered.append(result)
+
+        registry = RoomActorRegistry(process, deliver, idle_timeout=0.05)
+        await registry.submit("room", 1)
+        first = registry.get("room")
+        await asyncio.sleep(0.2)
+        assert first.closed and "room" not in registry.actors
+
+        # A new message starts a fresh actor
+        await registry.submit("room", 2)
+        await asyncio.sleep(0.01)
+        assert delivered == [1, 2] and registry.get("room") is not first
+        await registry.stop()
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Testing room actors")
+    print("=" * 60)
+    for test in (test_concurrent_processing_ordered_delivery, test_failed_message_does_not_stall_the_room,
+                 test_idle_actors_are_released):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,104 @@
+"""
+Test script for the coalesced presence / typing / read receipt channel (no server required)
+"""
+
+import os
+import sys
+import asyncio
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.room_events import RoomEvents
+from server.connection_manager import RoomConnectionManager
+from server.test_connection_manager import FakeWebSocket, _settle
+
+
+def test_updates_coalesce_per_tick():
+    async def scenario():
+        published = []
+
+        async def publish(session_id, message):
+            published.append((session_id, message))
+
+        events = RoomEvents(publish, tick_ms=20)
+        events.start()
+        # A burst of keystrokes, receipts and presence changes from two users
+        for seq in range(1, 51):
+            assert events.submit("room", "a@example.com", {"type": "typing", "typing": True})
+            assert events.submit("room", "b@example.com", {"type": "read", "seq": seq})
+        events.submit("room", "b@example.com", {"type": "read", "seq": 10})  # stale, ignored
+        events.submit("room", "a@example.com", {"type": "presence", "state": "away"})
+        events.submit("room", "a@example.com", {"type": "presence", "state": "online"})
+        assert not events.submit("room", "a@example.com", {"type": "read", "seq": "9"})
+        await asyncio.sleep(0.1)
+
+        assert published == [("room", {
+            "type": "events",
+            "typing": {"a@example.com": True},
+            "read": {"b@example.com": 50},
+            "presence": {"a@example.com": "online"},
+        })]
+        assert events.snapshot("room") == {
+            "type": "events",
+            "presence": {"a@example.com": "online"},
+            "typing": {"a@example.com": True},
+            "read": {"b@example.com": 50},
+        }
+
+        # Leaving clears the user's state in one more frame; an empty room is forgotten
+        events.user_left("a@example.com", "room")
+        events.user_left("b@example.com", "room")
+        await asyncio.sleep(0.1)
+        assert published[1] == ("room", {"type": "events", "typing": {"a@example.com": False},
+                                         "presence": {"a@example.com": "offline"}})
+        assert len(published) == 2 and "room" not in events.rooms
+        await events.stop()
+
+    asyncio.run(scenario())
+
+
+def test_typing_expires():
+    async def scenario():
+        published = []
+
+        async def publish(session_id, message):
+            published.append(message)
+
+        events = RoomEvents(publish, tick_ms=10, typing_ttl=0.05)
+        events.start()
+        events.set_typing("room", "a@example.com", True)
+        await asyncio.sleep(0.2)
+        assert published == [{"type": "events", "typing": {"a@example.com": True}},
+                             {"type": "events", "typing": {"a@example.com": False}}]
+        await events.stop()
+
+    asyncio.run(scenario())
+
+
+def test_events_are_not_numbered():
+    async def scenario():
+        manager = RoomConnectionManager()
+        ws = FakeWebSocket()
+        await manager.connect("room", ws)
+        await manager.broadcast_ephemeral("room", {"type": "events", "typing": {"a@example.com": True}})
+        await manager.broadcast("room", {"n": 1})
+        # Arriving from another worker doesn't number it either
+        manager._remote_frame("room", '{"type":"events","read":{"a@example.com":1}}')
+        await _settle()
+        assert ws.sent == [{"type": "events", "typing": {"a@example.com": True}}, {"n": 1, "seq": 1},
+                           {"type": "events", "read": {"a@example.com": 1}}]
+        assert len(manager.history.room("room").messages) == 1
+        for connection in manager.all_connections():
+            connection.cancel()
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Testing room events")
+    print("=" * 60)
+    for test in (test_updates_coalesce_per_tick, test_typing_expires, test_events_are_not_numbered):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,42 @@
+"""
+Test script for the security monitor's per-user rate limiting (no server required)
+"""
+
+import os
+import sys
+from datetime import datetime
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.security_monitor import SecurityMonitor, RATE_LIMIT_WINDOW
+
+
+def test_leaving_does_not_reset_the_rate_limit():
+    monitor = SecurityMonitor()
+    for _ in range(monitor.max_messages_per_minute):
+        assert not monitor._check_rate_limiting("a@example.com", "room")
+    # Reconnecting used to start a fresh allowance
+    monitor.release_session_state("a@example.com", "room")
+    assert monitor._check_rate_limiting("a@example.com", "room")
+
+
+def test_stale_counters_are_pruned():
+    monitor = SecurityMonitor()
+    monitor._check_rate_limiting("a@example.com", "old")
+    monitor._check_rate_limiting("a@example.com", "recent")
+    monitor._check_rate_limiting("b@example.com", "old")
+    monitor.last_message_time["a@example.com"]["old"] -= RATE_LIMIT_WINDOW
+    monitor.last_message_time["b@example.com"]["old"] -= RATE_LIMIT_WINDOW
+    monitor.prune_rate_limits(datetime.utcnow())
+    assert dict(monitor.message_counts) == {"a@example.com": {"recent": 1}}
+    assert list(monitor.last_message_time) == ["a@example.com"]
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Testing SecurityMonitor rate limiting")
+    print("=" * 60)
+    for test in (test_leaving_does_not_reset_the_rate_limit, test_stale_counters_are_pruned):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,175 @@
+"""
+Test script for the expiring chat session registry (no database server required)
+"""
+
+import os
+import sys
+import time
+import asyncio
+import sqlite3
+import tempfile
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.storage import MemoryStorage, SQLiteStorage
+from server.sessions import SessionRegistry, is_member
+
+
+class CountingStorage(MemoryStorage):
+    """MemoryStorage counting the session calls that would be round trips to a database"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.reads = 0
+        self.touches = 0
+
+    async def get_session(self, session_id):
+        self.reads += 1
+        return await super().get_session(session_id)
+
+    async def touch_session(self, session_id, last_active_at, expires_at):
+        self.touches += 1
+        return await super().touch_session(session_id, last_active_at, expires_at)
+
+
+def test_lookups_are_served_from_the_cache():
+    async def scenario():
+        storage = CountingStorage()
+        sessions = SessionRegistry(storage, cache_ttl=30, touch_interval=60)
+        await sessions.create("s1", {"created_at": "now"})
+        started = time.perf_counter()
+        for _ in range(10000):
+            assert await sessions.exists("s1")
+        per_lookup_ms = (time.perf_counter() - started) / 10000 * 1000
+        assert per_lookup_ms < 0.1, per_lookup_ms
+        assert storage.reads == 0 and storage.touches == 0 and sessions.hits == 10000
+        # Unknown ids aren't cached, so each one is a miss
+        assert not await sessions.exists("nope") and not await sessions.exists("nope")
+        assert storage.reads == 2 and "nope" not in sessions.cache
+
+    asyncio.run(scenario())
+
+
+def test_idle_sessions_expire_and_activity_extends_them():
+    async def scenario():
+        storage = CountingStorage()
+        sessions = SessionRegistry(storage, idle_timeout=0.3, cache_ttl=0.05, touch_interval=0.1)
+        await sessions.create("s1", {})
+        await sessions.create("idle", {})
+        # Activity after touch_interval is written back, moving the expiry
+        await asyncio.sleep(0.15)
+        assert await sessions.exists("s1") and storage.touches == 1
+        assert await sessions.exists("s1") and storage.touches == 1
+        await asyncio.sleep(0.2)
+        assert await sessions.exists("s1")
+        assert not await sessions.exists("idle") and await storage.get_session("idle") is None
+        # Nobody looks for it any more
+        await asyncio.sleep(0.35)
+        assert not await sessions.exists("s1")
+        assert sessions.stats()["touches"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_chat_traffic_keeps_a_session_alive():
+    async def scenario():
+        storage = CountingStorage()
+        sessions = SessionRegistry(storage, idle_timeout=0.3, cache_ttl=30, touch_interval=0.1)
+        await sessions.create("busy", {})
+        await sessions.create("quiet", {})
+        # Messages every 50 ms for twice the idle timeout, and no joins
+        for _ in range(12):
+            await sessions.record_activity("busy")
+            await asyncio.sleep(0.05)
+        assert await storage.get_session("busy") is not None
+        assert await storage.get_session("quiet") is None
+        # Written back once per touch_interval, not once per message
+        assert 4 <= storage.touches <= 7
+        # A reconnect (a cache miss on another worker) still finds it
+        assert await SessionRegistry(storage).exists("busy")
+
+    asyncio.run(scenario())
+
+
+def test_members_are_remembered():
+    async def scenario():
+        storage = MemoryStorage()
+        sessions = SessionRegistry(storage)
+        await sessions.create("s1", {"created_by": "a@example.com"})
+        for _ in range(3):
+            await sessions.add_member("s1", "b@example.com")
+        assert storage.sessions["s1"]["members"] == ["b@example.com"]
+        session = await sessions.get("s1")
+        assert is_member(session, "a@example.com") and is_member(session, "b@example.com")
+        assert not is_member(session, "c@example.com")
+        # Joining an unknown session records nothing
+        await sessions.add_member("nope", "b@example.com")
+        assert "nope" not in storage.sessions
+
+    asyncio.run(scenario())
+
+
+def test_memory_stays_bounded_under_creation_spam():
+    async def scenario():
+        storage = MemoryStorage(max_items=1000)
+        sessions = SessionRegistry(storage, cache_size=100)
+        for n in range(5000):
+            await sessions.create(f"s{n}", {})
+        assert len(sessions.cache) == 100 and sessions.cache.evicted == 4900
+        assert len(storage.sessions) == 1000
+        # Evicted from the cache but still live in storage: read through
+        assert await sessions.exists("s4000") and await sessions.exists("s4999")
+        assert not await sessions.exists("s0")
+
+    asyncio.run(scenario())
+
+
+def test_workers_share_sessions_through_storage():
+    async def scenario():
+        storage = MemoryStorage()
+        worker_a = SessionRegistry(storage, cache_ttl=0.05)
+        worker_b = SessionRegistry(storage, cache_ttl=0.05)
+        await worker_a.create("s1", {})
+        assert await worker_b.exists("s1") and worker_b.misses == 1
+        assert await worker_b.exists("s1") and worker_b.hits == 1
+        # Gone from storage (expired elsewhere): cached copies last at most cache_ttl
+        del storage.sessions["s1"]
+        assert await worker_b.exists("s1")
+        await asyncio.sleep(0.06)
+        assert not await worker_b.exists("s1") and not await worker_a.exists("s1")
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_files_from_before_expiry():
+    async def scenario(path):
+        old = sqlite3.connect(path)
+        old.execute("CREATE TABLE sessions (session_id TEXT PRIMARY KEY, document TEXT NOT NULL)")
+        old.execute("INSERT INTO sessions VALUES ('old', '{}')")
+        old.commit()
+        old.close()
+
+        storage = SQLiteStorage(path)
+        await storage.start()
+        sessions = SessionRegistry(storage)
+        # Sessions that never had an expiry are treated as expired
+        assert not await sessions.exists("old")
+        await sessions.create("s1", {"created_at": "now"})
+        assert (await storage.get_session("s1"))["created_at"] == "now"
+        await storage.close()
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(scenario(os.path.join(directory, "chat.db")))
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Testing the session registry")
+    print("=" * 60)
+    for test in (test_lookups_are_served_from_the_cache, test_idle_sessions_expire_and_activity_extends_them,
+                 test_chat_traffic_keeps_a_session_alive, test_members_are_remembered,
+                 test_memory_stays_bounded_under_creation_spam,
+                 test_workers_share_sessions_through_storage, test_sqlite_files_from_before_expiry):
+        test()
+        print(f"✅ {test.__name__}")
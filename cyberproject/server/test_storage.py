@@ -0,0 +1,458 @@
+"""
+Test script for the account storage backends (no database server required)
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+from datetime import datetime, timedelta
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+from pymongo import IndexModel
+from pymongo.errors import AutoReconnect, DuplicateKeyError
+
+from server.storage import (StorageBackend, MemoryStorage, SQLiteStorage, MongoStorage, BoundedDict, FailoverStorage,
+                            StorageJournal)
+from server.circuit_breaker import CircuitBreaker
+from server.db import ensure_indexes
+
+
+async def check_contract(storage):
+    """The behaviour main.py relies on, whichever backend is behind it"""
+    await storage.start()
+    now = datetime.utcnow()
+    later = now + timedelta(minutes=5)
+
+    # Users
+    user = {"email": "a@example.com", "password_hash": "h1", "created_at": now}
+    assert await storage.create_user(user)
+    assert not await storage.create_user(dict(user, password_hash="other"))
+    stored = await storage.get_user("a@example.com")
+    assert stored["password_hash"] == "h1" and stored["created_at"] == now
+    assert await storage.update_password("a@example.com", "h2")
+    assert (await storage.get_user("a@example.com"))["password_hash"] == "h2"
+    assert not await storage.update_password("nobody@example.com", "h")
+    assert await storage.get_user("nobody@example.com") is None
+
+    # OTPs: a new one replaces the unused one; used ones still count towards the rate limit
+    otp = {"email": "a@example.com", "purpose": "signup", "otp_code": "111111", "created_at": now,
+           "expires_at": later, "used": False, "attempts": 0}
+    await storage.replace_otp(otp)
+    await storage.replace_otp(dict(otp, otp_code="222222"))
+    # consume_otp returns the OTP as it was before the attempt
+    assert (await storage.consume_otp("a@example.com", "signup", "000000"))["attempts"] == 0
+    assert (await storage.consume_otp("a@example.com", "signup", "000000"))["attempts"] == 1
+    before = await storage.consume_otp("a@example.com", "signup", "222222")
+    assert before["otp_code"] == "222222" and before["attempts"] == 2 and not before["used"]
+    assert await storage.consume_otp("a@example.com", "signup", "222222") is None
+    await storage.replace_otp(dict(otp, otp_code="333333", created_at=now + timedelta(seconds=1)))
+    assert await storage.otp_window("a@example.com", "signup", now - timedelta(minutes=15)) == \
+        {"count": 2, "oldest": now}
+    assert await storage.otp_window("a@example.com", "forgot_password", now) == {"count": 0, "oldest": None}
+    # Out of attempts: the right code no longer marks it used
+    assert (await storage.consume_otp("a@example.com", "signup", "000000", max_attempts=1))["attempts"] == 0
+    found = await storage.consume_otp("a@example.com", "signup", "333333", max_attempts=1)
+    assert found["attempts"] == 1
+    await storage.delete_otp(found)
+    assert await storage.consume_otp("a@example.com", "signup", "333333") is None
+    # Expired: neither used nor counted
+    await storage.replace_otp(dict(otp, otp_code="444444", expires_at=now - timedelta(seconds=1)))
+    await storage.consume_otp("a@example.com", "signup", "444444")
+    assert (await storage.consume_otp("a@example.com", "signup", "000000"))["attempts"] == 0
+
+    # Temporary signup passwords are taken once, and not after they expire
+    await storage.put_temp_password("a@example.com", "temp", later)
+    assert await storage.pop_temp_password("a@example.com") == "temp"
+    assert await storage.pop_temp_password("a@example.com") is None
+    await storage.put_temp_password("b@example.com", "temp", now - timedelta(seconds=1))
+    assert await storage.pop_temp_password("b@example.com") is None
+
+    # Verification tokens: a new one replaces the email's old one
+    await storage.put_verification_token("t1", "a@example.com", later)
+    await storage.put_verification_token("t2", "a@example.com", later)
+    assert await storage.get_verification_token("t1") is None
+    token = await storage.get_verification_token("t2")
+    assert token["email"] == "a@example.com" and token["expires_at"] == later
+    await storage.delete_verification_token("t2")
+    assert await storage.get_verification_token("t2") is None
+
+    # QR tokens are single use
+    await storage.put_qr_token({"token": "qr", "user_email": "a@example.com", "created_at": now,
+                                "expires_at": later, "used": False})
+    assert (await storage.use_qr_token("qr"))["user_email"] == "a@example.com"
+    assert await storage.use_qr_token("qr") is None
+    assert await storage.use_qr_token("unknown") is None
+
+    # Sessions expire unless activity pushes expires_at back
+    await storage.create_session("s1", {"created_at": now.isoformat()}, later)
+    assert await storage.get_session("s1") == {"created_at": now.isoformat(), "expires_at": later}
+    assert await storage.get_session("s2") is None
+    assert await storage.touch_session("s1", now, later + timedelta(minutes=5))
+    assert await storage.get_session("s1") == {"created_at": now.isoformat(), "last_active_at": now,
+                                               "expires_at": later + timedelta(minutes=5)}
+    assert not await storage.touch_session("s2", now, later)
+    # Members are listed once, and kept when activity is recorded
+    assert await storage.add_session_member("s1", "a@example.com")
+    assert await storage.add_session_member("s1", "a@example.com")
+    assert await storage.add_session_member("s1", "b@example.com")
+    assert await storage.touch_session("s1", now, later + timedelta(minutes=5))
+    assert (await storage.get_session("s1"))["members"] == ["a@example.com", "b@example.com"]
+    assert not await storage.add_session_member("s2", "a@example.com")
+    await storage.create_session("idle", {}, now - timedelta(seconds=1))
+    assert await storage.get_session("idle") is None
+    assert not await storage.touch_session("idle", now, later)
+    await storage.close()
+
+
+def test_incomplete_backend_fails_at_construction():
+    class UsersOnly(StorageBackend):
+        async def get_user(self, email):
+            return None
+
+    try:
+        UsersOnly()
+    except TypeError as e:
+        assert "create_session" in str(e)
+    else:
+        raise AssertionError("a backend missing most of the interface was created")
+    for backend in (MemoryStorage, SQLiteStorage, MongoStorage, FailoverStorage):
+        assert not backend.__abstractmethods__, backend.__name__
+
+
+def test_memory_storage():
+    asyncio.run(check_contract(MemoryStorage()))
+
+
+def test_sqlite_storage_persists():
+    async def scenario(path):
+        await check_contract(SQLiteStorage(path))
+        # A restart finds the same accounts and sessions
+        reopened = SQLiteStorage(path)
+        await reopened.start()
+        assert (await reopened.get_user("a@example.com"))["password_hash"] == "h2"
+        assert await reopened.get_session("s1") is not None
+        await reopened.close()
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(scenario(os.path.join(directory, "chat.db")))
+
+
+def test_memory_storage_is_bounded():
+    async def scenario():
+        storage = MemoryStorage(max_items=100)
+        later = datetime.utcnow() + timedelta(minutes=5)
+        for n in range(250):
+            await storage.create_session(f"s{n}", {}, later)
+            await storage.create_user({"email": f"u{n}@example.com", "password_hash": "h"})
+        assert len(storage.sessions) == 100 and storage.sessions.evicted == 150
+        assert await storage.get_session("s0") is None and await storage.get_session("s249") == {"expires_at": later}
+
+        # Expired entries go before live ones are pushed out
+        tokens = BoundedDict(max_items=100)
+        now = datetime.utcnow()
+        for n in range(10):
+            tokens[n] = {"expires_at": now + timedelta(seconds=n - 5)}
+        tokens.purge_expired(now)
+        assert list(tokens) == [6, 7, 8, 9]
+
+    asyncio.run(scenario())
+
+
+class FlakyStorage(MemoryStorage):
+    """An in-memory "database" that can be taken down, or made to hang"""
+
+    name = "mongo"
+
+    def __init__(self):
+        super().__init__()
+        self.mode = "up"
+        self.calls = 0
+
+    async def _check(self):
+        self.calls += 1
+        if self.mode == "down":
+            raise AutoReconnect("connection refused")
+        if self.mode == "hang":
+            await asyncio.sleep(60)
+
+    async def ping(self):
+        await self._check()
+
+    async def get_user(self, email):
+        await self._check()
+        return await super().get_user(email)
+
+    async def create_user(self, user):
+        await self._check()
+        return await super().create_user(user)
+
+    async def create_session(self, session_id, session, expires_at):
+        await self._check()
+        await super().create_session(session_id, session, expires_at)
+
+    async def get_session(self, session_id):
+        await self._check()
+        return await super().get_session(session_id)
+
+
+def test_failover_and_journal_replay():
+    async def scenario():
+        primary = FlakyStorage()
+        storage = FailoverStorage(primary, breaker=CircuitBreaker(primary.ping, failure_threshold=2,
+                                                                  call_timeout=0.05, probe_interval=0.05),
+                                  journal=StorageJournal(path=""))
+        await storage.start()
+        later = datetime.utcnow() + timedelta(minutes=5)
+        assert await storage.create_user({"email": "a@example.com", "password_hash": "h"})
+        await storage.create_session("s1", {}, later)
+
+        # A hanging database costs one call timeout per request until the breaker opens
+        primary.mode = "hang"
+        started = time.perf_counter()
+        assert (await storage.get_user("a@example.com"))["password_hash"] == "h"
+        assert await storage.get_session("s1") == {"expires_at": later}
+        assert storage.breaker.is_open and time.perf_counter() - started < 0.5
+
+        # Open: answered from memory without touching the database; writes are journaled
+        primary.mode = "down"
+        calls = primary.calls
+        started = time.perf_counter()
+        for n in range(100):
+            assert await storage.get_session("s1") == {"expires_at": later}
+        assert time.perf_counter() - started < 0.05
+        assert await storage.create_user({"email": "b@example.com", "password_hash": "h"})
+        await storage.create_session("s2", {"created_at": "now"}, later)
+        assert primary.calls - calls <= 2  # only background probes
+        assert len(storage.journal) == 2 and "s2" not in primary.sessions
+
+        # Recovery: the probe replays the journal, then the breaker closes
+        primary.mode = "up"
+        await asyncio.sleep(0.3)
+        assert not storage.breaker.is_open and len(storage.journal) == 0 and storage.replayed == 2
+        assert (await primary.get_user("b@example.com"))["email"] == "b@example.com"
+        assert await primary.get_session("s2") == {"created_at": "now", "expires_at": later}
+        stats = storage.stats()
+        assert stats["breaker"]["trips"] == 1 and stats["journal"]["pending"] == 0
+        await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_journal_survives_restart():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "journal.ndjson")
+        journal = StorageJournal(path=path)
+        expires_at = datetime(2025, 1, 1, 12, 0)
+        journal.append("put_temp_password", ("a@example.com", "hash", expires_at))
+        journal.append("create_session", ("s1", {"created_at": "now"}))
+        reloaded = StorageJournal(path=path)
+        assert list(reloaded.entries) == [("put_temp_password", ("a@example.com", "hash", expires_at)),
+                                          ("create_session", ("s1", {"created_at": "now"}))]
+        reloaded.clear()
+        assert len(StorageJournal(path=path)) == 0
+
+
+class FakeIndexedCollection:
+    """index_information() / create_indexes() with a round-trip delay"""
+
+    def __init__(self, existing=()):
+        self.indexes = {"_id_": {}, **{name: {} for name in existing}}
+        self.commands = 0
+
+    async def index_information(self):
+        self.commands += 1
+        await asyncio.sleep(0.05)
+        return dict(self.indexes)
+
+    async def create_indexes(self, models):
+        self.commands += 1
+        await asyncio.sleep(0.05)
+        names = [model.document["name"] for model in models]
+        self.indexes.update({name: {} for name in names})
+        return names
+
+
+def test_index_bootstrap_is_concurrent_and_skips_existing():
+    async def scenario():
+        users, otps = FakeIndexedCollection(existing=["email_1"]), FakeIndexedCollection()
+        specs = [(users, [IndexModel("email", unique=True)]),
+                 (otps, [IndexModel("email"), IndexModel("expires_at", expireAfterSeconds=0)])]
+        started = time.perf_counter()
+        assert await ensure_indexes(specs) == ["email_1", "expires_at_1"]
+        # Both collections in parallel: two round trips, not four
+        assert time.perf_counter() - started < 0.15
+        assert users.commands == 1 and otps.commands == 2
+        # A warm restart only lists them
+        assert await ensure_indexes(specs) == []
+        assert users.commands == 2 and otps.commands == 3
+
+    asyncio.run(scenario())
+
+
+class RecordingCursor:
+    def __init__(self, result):
+        self.result = result
+
+    async def to_list(self, length=None):
+        return self.result
+
+
+class RecordingCollection:
+    """A Motor collection that logs each command sent and answers with a canned reply"""
+
+    def __init__(self, name, log, replies):
+        self.name = name
+        self.log = log
+        self.replies = replies
+
+    def _reply(self, command, *args, **kwargs):
+        self.log.append((self.name, command, args))
+        reply = self.replies.get((self.name, command))
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def aggregate(self, pipeline):
+        return RecordingCursor(self._reply("aggregate", pipeline))
+
+    def __getattr__(self, command):
+        async def send(*args, **kwargs):
+            return self._reply(command, *args, **kwargs)
+        return send
+
+
+class RecordingDatabase:
+    def __init__(self, replies=None):
+        self.log = []
+        self.replies = replies or {}
+
+    def __getitem__(self, name):
+        return RecordingCollection(name, self.log, self.replies)
+
+
+class PipelineOTPCollection:
+    """
+    An otps collection that runs find_one_and_update's update pipeline the
+    way mongod evaluates it, for the expression operators consume_otp uses
+    """
+
+    def __init__(self, document):
+        self.document = document
+
+    def evaluate(self, expression):
+        if isinstance(expression, str) and expression.startswith("$"):
+            # "$$REMOVE" is a variable; any other "$name" is a field path
+            return self if expression == "$$REMOVE" else self.document.get(expression[1:])
+        if not isinstance(expression, dict):
+            return expression
+        (operator, args), = expression.items()
+        if operator == "$literal":
+            return args
+        values = [self.evaluate(arg) for arg in args]
+        if operator == "$cond":
+            return values[1] if values[0] else values[2]
+        if operator == "$ifNull":
+            return values[1] if values[0] is None else values[0]
+        return {"$and": lambda: all(values), "$add": lambda: sum(values),
+                "$eq": lambda: values[0] == values[1], "$ne": lambda: values[0] != values[1],
+                "$gt": lambda: values[0] > values[1], "$lt": lambda: values[0] < values[1]}[operator]()
+
+    async def find_one_and_update(self, query, pipeline):
+        if any(self.document.get(field) != value for field, value in query.items()):
+            return None
+        before = dict(self.document)
+        for stage in pipeline:
+            updates = {field: self.evaluate(expression) for field, expression in stage["$set"].items()}
+            for field, value in updates.items():
+                if value is self:
+                    self.document.pop(field, None)
+                else:
+                    self.document[field] = value
+        return before
+
+
+def test_otp_codes_are_not_read_as_field_paths():
+    async def scenario():
+        now = datetime.utcnow()
+        otps = PipelineOTPCollection({"_id": 1, "email": "a@example.com", "purpose": "signup",
+                                      "otp_code": "123456", "created_at": now,
+                                      "expires_at": now + timedelta(minutes=5), "used": False, "attempts": 0})
+        storage = MongoStorage(RecordingDatabase())
+        storage.otps = otps
+        # Unescaped, "$otp_code" would compare the stored code with itself and burn the OTP
+        for code in ("$otp_code", "$$ROOT"):
+            assert (await storage.consume_otp("a@example.com", "signup", code))["used"] is False
+        assert otps.document["used"] is False and otps.document["attempts"] == 2
+        assert "used_at" not in otps.document
+        await storage.consume_otp("a@example.com", "signup", "123456")
+        assert otps.document["used"] is True and otps.document["attempts"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_hot_paths_are_one_command_each(monkeypatch):
+    import server.main as main
+
+    now = datetime.utcnow()
+    database = RecordingDatabase()
+    # Restored afterwards, so later tests get the app's own backend back
+    monkeypatch.setattr(main, "storage", MongoStorage(database))
+    client = TestClient(main.app)
+
+    def commands():
+        sent = list(database.log)
+        database.log.clear()
+        database.replies.clear()
+        return sent
+
+    # Signup: the unique index reports an existing account, no find first
+    response = client.post("/signup", json={"email": "a@example.com", "password": "Passw0rd!"})
+    assert response.status_code == 200 and [c[:2] for c in commands()] == [("users", "insert_one")]
+    database.replies[("users", "insert_one")] = DuplicateKeyError("email")
+    response = client.post("/signup", json={"email": "a@example.com", "password": "Passw0rd!"})
+    assert response.status_code == 400 and [c[:2] for c in commands()] == [("users", "insert_one")]
+
+    # OTP check, right or wrong code: one find_one_and_update
+    otp = {"_id": 1, "email": "a@example.com", "purpose": "signup", "otp_code": "123456",
+           "created_at": now, "expires_at": now + timedelta(minutes=5), "used": False, "attempts": 0}
+    for code, valid in (("123456", True), ("000000", False)):
+        database.replies[("otps", "find_one_and_update")] = otp
+        assert asyncio.run(main.verify_otp("a@example.com", code, "signup"))["valid"] is valid
+        sent = commands()
+        assert [c[:2] for c in sent] == [("otps", "find_one_and_update")]
+        assert sent[0][2][0] == {"email": "a@example.com", "purpose": "signup", "used": False}
+
+    # QR login: the single-use check and marking it used are the same command
+    token = main.generate_qr_token("a@example.com")
+    database.replies[("qr_tokens", "find_one_and_update")] = {"token": token, "used": True}
+    response = client.post("/validate_qr", json={"token": token})
+    assert response.status_code == 200 and [c[:2] for c in commands()] == [("qr_tokens", "find_one_and_update")]
+
+    # Rate limit status: count and oldest OTP from one aggregation
+    database.replies[("otps", "aggregate")] = [{"_id": None, "count": 3, "oldest": now - timedelta(minutes=5)}]
+    status = client.get("/otp_rate_limit_status", params={"email": "a@example.com", "purpose": "signup"}).json()
+    assert not status["can_request"] and 590 <= status["wait_seconds"] <= 600
+    assert [c[:2] for c in commands()] == [("otps", "aggregate")]
+    status = client.get("/otp_rate_limit_status", params={"email": "b@example.com", "purpose": "signup"}).json()
+    assert status["can_request"] and status["remaining_attempts"] == 3
+    assert [c[:2] for c in commands()] == [("otps", "aggregate")]
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Testing storage backends")
+    print("=" * 60)
+    for test in (test_incomplete_backend_fails_at_construction, test_memory_storage, test_sqlite_storage_persists, test_memory_storage_is_bounded,
+                 test_failover_and_journal_replay, test_journal_survives_restart,
+                 test_index_bootstrap_is_concurrent_and_skips_existing, test_otp_codes_are_not_read_as_field_paths):
+        test()
+        print(f"✅ {test.__name__}")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        test_hot_paths_are_one_command_each(monkeypatch)
+    print("✅ test_hot_paths_are_one_command_each")
@@ -0,0 +1,175 @@
+"""
+Test script for the WebSocket message codecs (no server required)
+"""
+
+import os
+import sys
+import json
+import base64
+import asyncio
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.ws_codec import (
+    JSON_CODEC,
+    COMPACT_CODEC,
+    CODECS,
+    CodecError,
+    FrameTooLarge,
+    receive_frame,
+)
+from server.connection_manager import RoomConnectionManager
+from server.ws_compression import deflate_extensions
+
+CIPHERTEXT = base64.b64encode(os.urandom(48)).decode()
+CHAT_FRAME = {
+    "user": "alice@example.com",
+    "message": CIPHERTEXT,
+    "encrypted": True,
+    "timestamp": "2025-01-01T12:00:00.123000",
+    "security_info": "Message encrypted with AES-256-CBC",
+}
+
+
+class FakeWebSocket:
+    def __init__(self, inbound=()):
+        self.inbound = list(inbound)
+        self.sent = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def receive(self):
+        return self.inbound.pop(0)
+
+    async def send_text(self, data):
+        self.sent.append(data)
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+def test_msgpack_is_compact_and_carries_raw_ciphertext():
+    codec = CODECS.get("msgpack")
+    if codec is None:
+        print("   (msgpack not installed, skipping)")
+        return
+    packed = codec.encode(CHAT_FRAME)
+    as_json = JSON_CODEC.encode(CHAT_FRAME)
+    assert len(packed) < len(as_json) * 0.6, (len(packed), len(as_json))
+
+    decoded = codec.decode(packed)
+    assert decoded["message"] == base64.b64decode(CIPHERTEXT)
+    assert decoded["user"] == CHAT_FRAME["user"]
+    assert decoded["timestamp"] == 1735732800123
+    assert "security_info" not in decoded and "encrypted" not in decoded
+
+    # Inbound client frames may use either full or short keys
+    assert codec.decode(codec.encode({"message": "hi"})) == {"message": "hi"}
+    try:
+        codec.decode("not binary")
+        raise AssertionError("text frame accepted by binary codec")
+    except CodecError:
+        pass
+
+
+def test_json_rejects_non_objects():
+    for bad in ("not json", "[1, 2]", b"\xff\xfe"):
+        try:
+            JSON_CODEC.decode(bad)
+            raise AssertionError(f"{bad!r} accepted")
+        except CodecError:
+            pass
+
+
+def test_oversized_frames_rejected_before_decoding():
+    async def scenario():
+        ws = FakeWebSocket([
+            {"type": "websocket.receive", "text": "x" * 2048},
+            {"type": "websocket.receive", "bytes": b"ok"},
+        ])
+        try:
+            await receive_frame(ws, max_bytes=1024)
+            raise AssertionError("oversized frame accepted")
+        except FrameTooLarge as e:
+            assert e.size == 2048
+        assert await receive_frame(ws, max_bytes=1024) == b"ok"
+
+    asyncio.run(scenario())
+
+
+def test_mixed_codec_room_broadcast():
+    codec = CODECS.get("msgpack")
+    if codec is None:
+        return
+
+    async def scenario():
+        manager = RoomConnectionManager()
+        json_ws, binary_ws = FakeWebSocket(), FakeWebSocket()
+        await manager.connect("room", json_ws)
+        await manager.connect("room", binary_ws, codec=codec)
+        await manager.broadcast("room", CHAT_FRAME)
+        # Frames that arrive from other workers carry only the JSON form
+        manager.broadcast_frame("room", JSON_CODEC.encode(CHAT_FRAME))
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert [json.loads(f) for f in json_ws.sent] == [dict(CHAT_FRAME, seq=1), CHAT_FRAME]
+        assert all(isinstance(f, bytes) for f in binary_ws.sent) and len(binary_ws.sent) == 2
+        assert codec.decode(binary_ws.sent[0])["message"] == base64.b64decode(CIPHERTEXT)
+        for connection in manager.get_connections("room"):
+            connection.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_compact_json_schema():
+    compact = COMPACT_CODEC.encode(CHAT_FRAME)
+    assert len(compact) < len(JSON_CODEC.encode(CHAT_FRAME)) * 0.75
+    assert json.loads(compact) == {"u": CHAT_FRAME["user"], "m": CIPHERTEXT, "ts": 1735732800123}
+    # Only non-default values survive: a plain message and a custom security_info
+    plain = json.loads(COMPACT_CODEC.encode({"message": "hi", "encrypted": False, "security_info": "Warning 1/3"}))
+    assert plain == {"m": "hi", "c": False, "si": "Warning 1/3"}
+    assert COMPACT_CODEC.decode('{"t":"pong"}') == {"type": "pong"}
+    assert json.loads(COMPACT_CODEC.batch([compact, compact]))["f"][1]["u"] == CHAT_FRAME["user"]
+
+
+def test_room_tags():
+    assert json.loads(JSON_CODEC.tag(JSON_CODEC.encode(CHAT_FRAME), "r1")) == {"room": "r1", **CHAT_FRAME}
+    assert json.loads(JSON_CODEC.tag("{}", "r1")) == {"room": "r1"}
+    assert COMPACT_CODEC.decode(COMPACT_CODEC.tag(COMPACT_CODEC.encode({"type": "ping"}), "r1")) == \
+        {"room": "r1", "type": "ping"}
+    codec = CODECS.get("msgpack")
+    if codec is not None:
+        assert codec.decode(codec.tag(codec.encode(CHAT_FRAME), "r1"))["room"] == "r1"
+        big = {f"k{i}": i for i in range(20)}
+        assert codec.decode(codec.tag(codec.encode(big), "r1")) == {"room": "r1", **big}
+
+
+def test_deflate_negotiation_uses_configured_settings():
+    assert deflate_extensions(enabled=False) == []
+    factory, = deflate_extensions(enabled=True, level=9, window_bits=10, mem_level=4)
+    # A browser offer: permessage-deflate; client_max_window_bits
+    response, extension = factory.process_request_params([("client_max_window_bits", None)], [])
+    assert ("server_max_window_bits", "10") in response
+    assert ("client_max_window_bits", "10") in response
+
+    # Repeated boilerplate across frames shrinks with context takeover
+    frames = [COMPACT_CODEC.encode(dict(CHAT_FRAME, user=f"user{i}@example.com")).encode() for i in range(20)]
+    from websockets.frames import Frame, Opcode
+    sizes = [len(extension.encode(Frame(Opcode.TEXT, data)).data) for data in frames]
+    assert sum(sizes[1:]) < sum(len(f) for f in frames[1:]), sizes
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Testing WebSocket codecs")
+    print("=" * 60)
+    for test in (test_msgpack_is_compact_and_carries_raw_ciphertext, test_json_rejects_non_objects,
+                 test_oversized_frames_rejected_before_decoding, test_mixed_codec_room_broadcast,
+                 test_compact_json_schema, test_room_tags, test_deflate_negotiation_uses_configured_settings):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,253 @@
+import os
+import json
+import base64
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+# MessagePack is optional; without it only the JSON codec is offered
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Frames larger than this are rejected before any decoding (bytes, or characters for text)
+try:
+    WS_MAX_FRAME_BYTES = max(1024, int(os.getenv("WS_MAX_FRAME_BYTES", str(1024 * 1024))))
+except ValueError:
+    WS_MAX_FRAME_BYTES = 1024 * 1024
+
+# The security_info string that nearly every chat frame carries
+DEFAULT_SECURITY_INFO = "Message encrypted with AES-256-CBC"
+
+Frame = Union[str, bytes]
+
+
+class CodecError(ValueError):
+    """Raised when an inbound frame cannot be decoded into a message"""
+
+
+class FrameTooLarge(Exception):
+    """Raised when an inbound frame exceeds WS_MAX_FRAME_BYTES"""
+
+    def __init__(self, size: int, limit: int):
+        super().__init__(f"Frame of {size} bytes exceeds the {limit} byte limit")
+        self.size = size
+        self.limit = limit
+
+
+class JsonCodec:
+    """The original wire format: verbose JSON in text frames"""
+
+    name = "json"
+    subprotocol = "chat.v1.json"
+    binary = False
+    room_key = "room"
+
+    def encode(self, message: dict) -> str:
+        # Same output as Starlette's send_json
+        return json.dumps(message, separators=(",", ":"))
+
+    def decode(self, data: Frame) -> dict:
+        try:
+            message = json.loads(data)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise CodecError(str(e))
+        if not isinstance(message, dict):
+            raise CodecError("Expected a JSON object")
+        return message
+
+    def batch(self, frames: List[str]) -> str:
+        """Wrap already-encoded frames as {"type": "batch", "frames": [...]} without re-serializing them"""
+        return '{"type":"batch","frames":[' + ",".join(frames) + "]}"
+
+    def tag(self, frame: str, room: str) -> str:
+        """Add the room key to an encoded object by splicing it in front of the other keys"""
+        head = '{"' + self.room_key + '":' + json.dumps(room)
+        return head + "}" if frame == "{}" else head + "," + frame[1:]
+
+
+# Short keys shared by the compact codecs
+COMPACT_KEYS = {
+    "type": "t",
+    "user": "u",
+    "message": "m",
+    "timestamp": "ts",
+    "security_info": "si",
+    "warning": "w",
+    "terminated": "x",
+    "error": "e",
+    "encrypted": "c",
+    "room": "r",
+    "seq": "s",
+    "epoch": "ep",
+    "msg_id": "i",
+    "frames": "f",
+    "presence": "p",
+    "typing": "k",
+    "read": "rd",
+}
+EXPANDED_KEYS = {short: full for full, short in COMPACT_KEYS.items()}
+
+
+def iso_to_millis(timestamp: str) -> Optional[int]:
+    """Server timestamps are naive UTC ISO strings; send them as epoch milliseconds"""
+    try:
+        parsed = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def compact_message(message: dict, raw_ciphertext: bool = False) -> Dict[str, Any]:
+    """
+    Trim a message to the compact schema: short keys, integer timestamps, and no
+    constant fields. "encrypted": true and the default security_info are implied;
+    only a non-encrypted message carries "c": false. With raw_ciphertext the
+    base64 ciphertext is decoded to bytes (binary codecs only).
+    """
+    compact: Dict[str, Any] = {}
+    encrypted = message.get("encrypted", False)
+    for key, value in message.items():
+        if key == "encrypted" and value:
+            continue
+        if key == "security_info" and value == DEFAULT_SECURITY_INFO:
+            continue
+        if key == "message" and raw_ciphertext and encrypted and isinstance(value, str):
+            try:
+                value = base64.b64decode(value, validate=True)
+            except ValueError:
+                pass  # encrypt_message fell back to plain text
+        elif key == "timestamp" and isinstance(value, str):
+            value = iso_to_millis(value) or value
+        compact[COMPACT_KEYS.get(key, key)] = value
+    return compact
+
+
+def expand_message(message: dict) -> dict:
+    return {EXPANDED_KEYS.get(key, key): value for key, value in message.items()}
+
+
+class CompactJsonCodec(JsonCodec):
+    """
+    JSON text frames in the compact schema, for clients that want smaller
+    frames without a MessagePack decoder. Ciphertext stays base64.
+    """
+
+    name = "compact"
+    subprotocol = "chat.v1.compact"
+    room_key = "r"
+
+    def encode(self, message: dict) -> str:
+        return super().encode(compact_message(message))
+
+    def decode(self, data: Frame) -> dict:
+        return expand_message(super().decode(data))
+
+    def batch(self, frames: List[str]) -> str:
+        return '{"t":"batch","f":[' + ",".join(frames) + "]}"
+
+
+class MsgpackCodec:
+    """
+    MessagePack in binary frames with the compact schema. Ciphertext travels
+    as raw bytes instead of base64 text.
+    """
+
+    name = "msgpack"
+    subprotocol = "chat.v1.msgpack"
+    binary = True
+
+    def __init__(self, max_frame_bytes: int = WS_MAX_FRAME_BYTES):
+        self.max_frame_bytes = max_frame_bytes
+
+    def encode(self, message: dict) -> bytes:
+        return msgpack.packb(compact_message(message, raw_ciphertext=True), use_bin_type=True)
+
+    def decode(self, data: Frame) -> dict:
+        if isinstance(data, str):
+            raise CodecError("Expected a binary frame")
+        try:
+            message = msgpack.unpackb(
+                data,
+                raw=False,
+                max_str_len=self.max_frame_bytes,
+                max_bin_len=self.max_frame_bytes,
+                max_array_len=1024,
+                max_map_len=64,
+            )
+        except Exception as e:
+            raise CodecError(str(e))
+        if not isinstance(message, dict):
+            raise CodecError("Expected a MessagePack map")
+        return expand_message(message)
+
+    def batch(self, frames: List[bytes]) -> bytes:
+        """{"t": "batch", "f": [...]} built by splicing the already-packed frames into an array"""
+        count = len(frames)
+        if count < 16:
+            header = bytes([0x90 | count])
+        elif count < 0x10000:
+            header = b"\xdc" + count.to_bytes(2, "big")
+        else:
+            header = b"\xdd" + count.to_bytes(4, "big")
+        return _BATCH_PREFIX + header + b"".join(frames)
+
+    def tag(self, frame: bytes, room: str) -> bytes:
+        """Add "r": room to an encoded map; small maps just get their header bumped"""
+        if 0x80 <= frame[0] < 0x8f:
+            return bytes([frame[0] + 1]) + msgpack.packb("r") + msgpack.packb(room) + frame[1:]
+        message = msgpack.unpackb(frame, raw=False)
+        return msgpack.packb({"r": room, **message}, use_bin_type=True)
+
+
+if msgpack is not None:
+    # Two-entry map: "t" -> "batch", then the "f" key; the frame array follows
+    _BATCH_PREFIX = b"\x82" + msgpack.packb("t") + msgpack.packb("batch") + msgpack.packb("f")
+
+JSON_CODEC = JsonCodec()
+COMPACT_CODEC = CompactJsonCodec()
+CODECS: Dict[str, Any] = {JSON_CODEC.name: JSON_CODEC, COMPACT_CODEC.name: COMPACT_CODEC}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+SUBPROTOCOLS = {codec.subprotocol: codec for codec in CODECS.values()}
+
+
+def negotiate_codec(websocket: WebSocket) -> Tuple[Any, Optional[str]]:
+    """
+    Pick a codec for a new connection. Clients offer Sec-WebSocket-Protocol
+    values (chat.v1.msgpack, chat.v1.compact, chat.v1.json) or pass ?codec=. Returns the
+    codec and the subprotocol to accept, if one was offered. JSON is the default.
+    """
+    for offered in websocket.scope.get("subprotocols") or []:
+        codec = SUBPROTOCOLS.get(offered)
+        if codec is not None:
+            return codec, offered
+    requested = websocket.query_params.get("codec")
+    if requested:
+        if requested in CODECS:
+            return CODECS[requested], None
+        logger.info(f"Client asked for unavailable codec '{requested}', using JSON")
+    return JSON_CODEC, None
+
+
+async def receive_frame(websocket: WebSocket, max_bytes: int = WS_MAX_FRAME_BYTES) -> Frame:
+    """Receive one text or binary frame, checking its size before anything decodes it"""
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        data = message.get("bytes")
+        if data is None:
+            data = message.get("text")
+        if data is None:
+            continue
+        if len(data) > max_bytes:
+            raise FrameTooLarge(len(data), max_bytes)
+        return data
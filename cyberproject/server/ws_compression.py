@@ -0,0 +1,66 @@
+import os
+import logging
+import warnings
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+# permessage-deflate settings for /ws/ connections. Window bits bound the
+# per-connection zlib memory (2 ** bits bytes each way); level trades CPU for size.
+WS_DEFLATE = os.getenv("WS_DEFLATE", "true").lower() == "true"
+WS_DEFLATE_NO_CONTEXT_TAKEOVER = os.getenv("WS_DEFLATE_NO_CONTEXT_TAKEOVER", "false").lower() == "true"
+try:
+    WS_DEFLATE_LEVEL = min(9, max(0, int(os.getenv("WS_DEFLATE_LEVEL", "6"))))
+    WS_DEFLATE_MEM_LEVEL = min(9, max(1, int(os.getenv("WS_DEFLATE_MEM_LEVEL", "5"))))
+    WS_DEFLATE_WINDOW_BITS = min(15, max(9, int(os.getenv("WS_DEFLATE_WINDOW_BITS", "12"))))
+except ValueError:
+    WS_DEFLATE_LEVEL, WS_DEFLATE_MEM_LEVEL, WS_DEFLATE_WINDOW_BITS = 6, 5, 12
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+        from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+except ImportError:  # websockets not installed; uvicorn falls back to wsproto
+    ServerPerMessageDeflateFactory = None
+    WebSocketProtocol = None
+
+
+def deflate_extensions(enabled: bool = WS_DEFLATE, level: int = WS_DEFLATE_LEVEL,
+                       window_bits: int = WS_DEFLATE_WINDOW_BITS, mem_level: int = WS_DEFLATE_MEM_LEVEL,
+                       no_context_takeover: bool = WS_DEFLATE_NO_CONTEXT_TAKEOVER) -> List:
+    """Extension factories offered during the handshake; empty when compression is off"""
+    if not enabled or ServerPerMessageDeflateFactory is None:
+        return []
+    return [
+        ServerPerMessageDeflateFactory(
+            server_no_context_takeover=no_context_takeover,
+            client_no_context_takeover=no_context_takeover,
+            server_max_window_bits=window_bits,
+            client_max_window_bits=window_bits,
+            compress_settings={"level": level, "memLevel": mem_level},
+        )
+    ]
+
+
+if WebSocketProtocol is not None:
+    class DeflateWebSocketProtocol(WebSocketProtocol):
+        """
+        uvicorn's websockets protocol, but negotiating permessage-deflate with the
+        WS_DEFLATE_* settings instead of library defaults. Pass it as uvicorn's
+        ws= option (see server/serve.py).
+        """
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.available_extensions = deflate_extensions()
+else:
+    DeflateWebSocketProtocol = None
+
+
+def uvicorn_ws_option():
+    """Value for uvicorn's ws= option: the tuned protocol when available, else auto"""
+    if DeflateWebSocketProtocol is None:
+        logger.warning("websockets is not installed; permessage-deflate settings are ignored")
+        return "auto"
+    return DeflateWebSocketProtocol